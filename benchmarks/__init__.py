@@ -0,0 +1,5 @@
+"""
+Нагрузочные тесты и бенчмарки: фейковые модель и Telegram, синтетический корпус, сценарии.
+
+Запуск: python -m benchmarks.run --help (из корня репозитория)
+"""
@@ -0,0 +1,152 @@
+"""
+Синтетические данные для бенчмарков: регламенты (.docx и чанки), вопросы, сотрудники.
+
+Всё детерминировано seed: один и тот же масштаб даёт один и тот же корпус на любой машине.
+"""
+
+import csv
+import os
+import random
+from typing import Dict, List, Tuple
+
+# Темы по отделам: метка отдела совпадает с bot.DEPARTMENT_TAGS, чтобы работала префильтрация
+TOPICS: Dict[str, List[str]] = {
+    'hr': ['отпуск', 'больничный', 'командировка', 'премия', 'аттестация', 'увольнение', 'график'],
+    'ит': ['пароль', 'vpn', 'почта', 'принтер', 'ноутбук', 'доступ', 'инцидент'],
+    'бухгалтерия': ['аванс', 'отчёт', 'счёт', 'выплата', 'налог', 'авансовый', 'чек'],
+    'продажи': ['договор', 'скидка', 'клиент', 'заявка', 'прайс', 'отгрузка', 'возврат'],
+    'безопасность': ['пропуск', 'охрана', 'доступ', 'инструктаж', 'эвакуация', 'камера', 'ключ'],
+}
+
+ACTIONS = ['оформляет', 'согласует', 'подаёт', 'проверяет', 'продлевает', 'отменяет', 'регистрирует']
+OBJECTS = ['заявление', 'служебную записку', 'заявку в портале', 'форму', 'запрос руководителю', 'акт']
+TERMS = ['в течение трёх рабочих дней', 'не позднее пятницы', 'до конца месяца', 'в день обращения',
+         'за две недели', 'по согласованию с руководителем']
+DOC_TYPES = ['Регламент', 'Инструкция', 'Часто задаваемые вопросы', 'Руководство', 'Процедура']
+
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов',
+            'Новиков', 'Морозов', 'Волков', 'Алексеев', 'Зайцев', 'Павлов', 'Семёнов']
+NAMES = ['Иван', 'Пётр', 'Алексей', 'Сергей', 'Андрей', 'Дмитрий', 'Михаил', 'Николай', 'Олег', 'Юрий']
+PATRONYMICS = ['Иванович', 'Петрович', 'Сергеевич', 'Андреевич', 'Николаевич', 'Олегович', 'Юрьевич']
+POSITIONS = ['специалист', 'ведущий специалист', 'менеджер', 'инженер', 'руководитель группы']
+
+# Масштабы корпуса: (документов, абзацев в документе)
+SCALES: Dict[str, Tuple[int, int]] = {
+    'small': (5, 20),
+    'medium': (50, 40),
+    'large': (500, 60),
+}
+
+
+def _date(rng: random.Random) -> str:
+    return f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(2021, 2025)}"
+
+
+def paragraph(rng: random.Random, dept: str) -> str:
+    topic = rng.choice(TOPICS[dept])
+    sentences = []
+    for _ in range(rng.randint(3, 6)):
+        sentences.append(
+            f"Для вопроса «{topic}» сотрудник отдела {dept} {rng.choice(ACTIONS)} "
+            f"{rng.choice(OBJECTS)} {rng.choice(TERMS)}"
+        )
+    if rng.random() < 0.3:
+        sentences.append(f"Редакция от {_date(rng)}")
+    return '. '.join(sentences) + '.'
+
+
+def generate_documents(n_docs: int, paragraphs: int, seed: int = 42) -> List[Dict]:
+    """[{filename, title, department, paragraphs: [...], table: [[...], ...]}]"""
+    rng = random.Random(seed)
+    departments = list(TOPICS)
+    documents = []
+    for i in range(n_docs):
+        dept = departments[i % len(departments)]
+        doc_type = rng.choice(DOC_TYPES)
+        documents.append({
+            'filename': f"sop_{i:04d}.docx",
+            'title': f"{doc_type} отдела {dept} №{i + 1}",
+            'department': dept,
+            'paragraphs': [paragraph(rng, dept) for _ in range(paragraphs)],
+            'table': [[topic, rng.choice(TERMS)] for topic in rng.sample(TOPICS[dept], 3)],
+        })
+    return documents
+
+
+def generate_chunks(n: int, seed: int = 42) -> Tuple[List[str], List[Dict]]:
+    """Готовые чанки с метаданными в формате /index (без .docx и разбиения)"""
+    rng = random.Random(seed)
+    departments = list(TOPICS)
+    texts, metadata = [], []
+    for i in range(n):
+        dept = departments[i % len(departments)]
+        texts.append(paragraph(rng, dept))
+        metadata.append({'department': dept, 'doc_type': 'regulation', 'filename': f"sop_{i // 50:04d}.docx"})
+    return texts, metadata
+
+
+def write_docx(document: Dict, path: str):
+    from docx import Document
+    doc = Document()
+    doc.add_heading(document['title'], level=1)
+    for text in document['paragraphs']:
+        doc.add_paragraph(text)
+    table = doc.add_table(rows=0, cols=2)
+    for left, right in document['table']:
+        cells = table.add_row().cells
+        cells[0].text = left
+        cells[1].text = right
+    doc.save(path)
+
+
+def write_corpus(directory: str, scale: str = 'small', seed: int = 42) -> List[str]:
+    """Пишет .docx выбранного масштаба в directory, возвращает пути"""
+    n_docs, paragraphs = SCALES[scale]
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for document in generate_documents(n_docs, paragraphs, seed):
+        path = os.path.join(directory, document['filename'])
+        write_docx(document, path)
+        paths.append(path)
+    return paths
+
+
+def generate_questions(n: int, seed: int = 42) -> List[str]:
+    """Вопросы по темам корпуса (длиннее 20 символов — бот включает расширение запроса)"""
+    rng = random.Random(seed)
+    departments = list(TOPICS)
+    questions = []
+    for i in range(n):
+        dept = departments[i % len(departments)]
+        topic = rng.choice(TOPICS[dept])
+        questions.append(f"Как сотрудник {rng.choice(ACTIONS)} {rng.choice(OBJECTS)} по теме {topic}?")
+    return questions
+
+
+def generate_employees(n: int, seed: int = 42) -> List[Dict]:
+    """Сотрудники с уникальными табельными в формате выгрузки 1С"""
+    rng = random.Random(seed)
+    departments = list(TOPICS)
+    return [{
+        'employee_id': f"BN-{i:06d}",
+        'full_name': f"{rng.choice(SURNAMES)} {rng.choice(NAMES)} {rng.choice(PATRONYMICS)}",
+        'department': f"Отдел {departments[i % len(departments)]}",
+        'position': rng.choice(POSITIONS),
+    } for i in range(n)]
+
+
+def write_employees_csv(employees: List[Dict], path: str):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['employee_id', 'full_name', 'department', 'position'])
+        writer.writeheader()
+        writer.writerows(employees)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Синтетический корпус .docx для бенчмарков')
+    parser.add_argument('directory')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    print(f"Создано документов: {len(write_corpus(args.directory, args.scale, args.seed))}")
@@ -0,0 +1,161 @@
+"""
+Детерминированные заглушки моделей для model_service: Llama с заданной скоростью
+генерации, эмбеддер на хешировании слов и cross-encoder по пересечению слов.
+
+install_fake_models() подменяет модули llama_cpp и sentence_transformers до импорта
+model_service — остальной код сервиса (FAISS, BM25, эндпоинты, метрики) работает как есть.
+"""
+
+import hashlib
+import re
+import sys
+import time
+import types
+from typing import Iterator, List, Sequence, Union
+
+import numpy as np
+
+_WORD = re.compile(r'\w+')
+
+
+def _words(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class FakeLlama:
+    """Имитация llama_cpp.Llama: обработка промпта и выдача токенов с заданной скоростью.
+
+    Одно слово промпта считается одним токеном. Ответ детерминирован по промпту.
+    """
+
+    tokens_per_sec = 30.0
+    prompt_tokens_per_sec = 400.0
+    answer_tokens = 64
+
+    def __init__(self, model_path: str = '', **kwargs):
+        self.model_path = model_path
+        self.n_ctx = kwargs.get('n_ctx', 2048)
+
+    def tokenize(self, text: bytes) -> List[int]:
+        return [_seed(w) % 32000 for w in _words(text.decode('utf-8', errors='ignore'))]
+
+    def _answer(self, prompt: str, max_tokens: int) -> List[str]:
+        words = _words(prompt)
+        if 'перефразируй' in words:
+            # Расширение запроса в боте ждёт пронумерованные варианты
+            question = re.search(r'"([^"]+)"', prompt)
+            base = question.group(1) if question else 'вопрос'
+            return [f" {base} подробнее\n2.", f" Порядок: {base}"]
+        rng = np.random.default_rng(_seed(prompt))
+        vocab = words[-200:] or ['ответ']
+        count = max(1, min(max_tokens, self.answer_tokens))
+        return [' ' + vocab[i] for i in rng.integers(0, len(vocab), size=count)]
+
+    def _stream(self, prompt: str, max_tokens: int) -> Iterator[dict]:
+        time.sleep(len(_words(prompt)) / self.prompt_tokens_per_sec)
+        for i, piece in enumerate(self._answer(prompt, max_tokens)):
+            if i:
+                time.sleep(1.0 / self.tokens_per_sec)
+            yield {"choices": [{"text": piece}]}
+
+    def __call__(self, prompt: str, max_tokens: int = 128, stream: bool = False, **kwargs):
+        if stream:
+            return self._stream(prompt, max_tokens)
+        pieces = [chunk["choices"][0]["text"] for chunk in self._stream(prompt, max_tokens)]
+        return {"choices": [{"text": "".join(pieces)}], "usage": {"completion_tokens": len(pieces)}}
+
+
+class FakeSentenceTransformer:
+    """Эмбеддинги «мешка слов» через хеширование: близкие по словам тексты близки по косинусу."""
+
+    dim = 384
+    seconds_per_text = 0.0
+
+    def __init__(self, name: str = '', **kwargs):
+        self.name = name
+
+    def encode(self, texts: Union[str, Sequence[str]], convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if self.seconds_per_text:
+            time.sleep(self.seconds_per_text * len(texts))
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in _words(text):
+                h = _seed(word)
+                out[row, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        return out[0] if single else out
+
+
+class RandomEmbedder:
+    """Случайные векторы (один генератор на процесс): только для замеров скорости, релевантность бессмысленна."""
+
+    dim = 384
+    seed = 0
+
+    def __init__(self, name: str = '', **kwargs):
+        self.name = name
+        self._rng = np.random.default_rng(self.seed)
+
+    def encode(self, texts: Union[str, Sequence[str]], convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        n = 1 if single else len(texts)
+        out = self._rng.standard_normal((n, self.dim), dtype=np.float32)
+        return out[0] if single else out
+
+
+class FakeCrossEncoder:
+    """Скор пары — доля слов запроса, встречающихся в документе."""
+
+    seconds_per_pair = 0.0
+
+    def __init__(self, name: str = '', **kwargs):
+        self.name = name
+
+    def predict(self, pairs: Sequence[tuple], **kwargs) -> np.ndarray:
+        if self.seconds_per_pair:
+            time.sleep(self.seconds_per_pair * len(pairs))
+        scores = []
+        for query, doc in pairs:
+            q = set(_words(query))
+            scores.append(len(q & set(_words(doc))) / len(q) if q else 0.0)
+        return np.array(scores, dtype=np.float32)
+
+
+def cos_sim(a, b) -> np.ndarray:
+    a = np.atleast_2d(np.asarray(a, dtype=np.float32))
+    b = np.atleast_2d(np.asarray(b, dtype=np.float32))
+    a = a / (np.linalg.norm(a, axis=1, keepdims=True) + 1e-12)
+    b = b / (np.linalg.norm(b, axis=1, keepdims=True) + 1e-12)
+    return a @ b.T
+
+
+def install_fake_llama():
+    """Подменяет только llama_cpp (эмбеддинги и реранкер остаются настоящими)"""
+    llama_cpp = types.ModuleType('llama_cpp')
+    llama_cpp.Llama = FakeLlama
+    sys.modules['llama_cpp'] = llama_cpp
+
+
+def install_fake_models(tokens_per_sec: float = 30.0, prompt_tokens_per_sec: float = 400.0,
+                        answer_tokens: int = 64, embed_ms: float = 0.0, rerank_ms: float = 0.0):
+    """Подменяет llama_cpp и sentence_transformers в sys.modules (вызывать до импорта model_service)"""
+    FakeLlama.tokens_per_sec = tokens_per_sec
+    FakeLlama.prompt_tokens_per_sec = prompt_tokens_per_sec
+    FakeLlama.answer_tokens = answer_tokens
+    FakeSentenceTransformer.seconds_per_text = embed_ms / 1000.0
+    FakeCrossEncoder.seconds_per_pair = rerank_ms / 1000.0
+
+    install_fake_llama()
+    util = types.ModuleType('sentence_transformers.util')
+    util.cos_sim = cos_sim
+    sentence_transformers = types.ModuleType('sentence_transformers')
+    sentence_transformers.SentenceTransformer = FakeSentenceTransformer
+    sentence_transformers.CrossEncoder = FakeCrossEncoder
+    sentence_transformers.util = util
+    sys.modules['sentence_transformers'] = sentence_transformers
+    sys.modules['sentence_transformers.util'] = util
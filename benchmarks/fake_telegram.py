@@ -0,0 +1,97 @@
+"""
+Фейковый Telegram для aiogram: сессия бота без сети и генератор входящих апдейтов.
+
+Обработчики из bot.setup_handlers работают как в проде — через Dispatcher.feed_update,
+а все вызовы Bot API (сообщения, правки прогресс-бара, скачивание файлов) попадают в
+FakeTelegramSession с заданной задержкой «сети».
+"""
+
+import asyncio
+import itertools
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Document, File, Message, Update, User
+
+
+class FakeTelegramSession(BaseSession):
+    """Отвечает на методы Bot API локально и запоминает, что бот отправил в каждый чат."""
+
+    def __init__(self, latency: float = 0.03, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.sent: Dict[int, List[str]] = defaultdict(list)
+        self.files: Dict[str, bytes] = {}
+        self._message_ids = itertools.count(1_000_000)
+
+    def _message(self, chat_id: int, text: Optional[str], message_id: Optional[int] = None) -> Message:
+        return Message(
+            message_id=message_id or next(self._message_ids),
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type='private'),
+            text=text,
+        )
+
+    async def make_request(self, bot, method, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if name == 'SendMessage':
+            self.sent[int(method.chat_id)].append(method.text)
+            return self._message(int(method.chat_id), method.text)
+        if name == 'EditMessageText':
+            return self._message(int(method.chat_id), method.text, method.message_id)
+        if name == 'GetFile':
+            return File(file_id=method.file_id, file_unique_id=method.file_id,
+                        file_size=len(self.files.get(method.file_id, b'')), file_path=f"documents/{method.file_id}")
+        if name == 'GetMe':
+            return User(id=1, is_bot=True, first_name='benchmark', username='benchmark_bot')
+        return True
+
+    async def stream_content(self, url: str, *args, chunk_size: int = 65536, **kwargs):
+        self.calls['download'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = self.files.get(url.rsplit('/', 1)[-1], b'')
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    async def close(self):
+        return None
+
+    def last_text(self, chat_id: int) -> str:
+        texts = self.sent.get(chat_id)
+        return texts[-1] if texts else ''
+
+
+class UpdateFactory:
+    """Входящие апдейты от пользователей (личные чаты: chat_id == user_id)."""
+
+    def __init__(self, session: FakeTelegramSession):
+        self.session = session
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields) -> Update:
+        message = Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(),
+            chat=Chat(id=user_id, type='private'),
+            from_user=User(id=user_id, is_bot=False, first_name=f"user{user_id}"),
+            **fields,
+        )
+        return Update(update_id=next(self._update_ids), message=message)
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._message(user_id, text=text)
+
+    def document(self, user_id: int, file_name: str, content: bytes) -> Update:
+        file_id = f"file{next(self._update_ids)}"
+        self.session.files[file_id] = content
+        return self._message(user_id, document=Document(
+            file_id=file_id, file_unique_id=file_id, file_name=file_name, file_size=len(content)
+        ))
@@ -0,0 +1,126 @@
+"""
+Время импорта модулей процесса бота по `python -X importtime`: общее время, самые
+тяжёлые модули и пакеты верхнего уровня.
+
+    python -m benchmarks.import_time --modules main,bot,database --output imports.json
+
+Каждый прогон — отдельный чистый процесс во временном каталоге (config.ensure_directories
+создаёт каталоги в текущем); в отчёт идёт медиана по --repeat прогонам.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from benchmarks.run import _commit
+
+DEFAULT_MODULES = 'main,bot,database,config'
+# Строка вида "import time:       self [us] |  cumulative | imported package"
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """(модуль, self мкс, cumulative мкс, глубина вложенности)"""
+    rows = []
+    for line in stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2))
+    return rows
+
+
+def _run_once(module: str, workdir: str, env: Dict[str, str]) -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=workdir, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        lines = [l for l in proc.stderr.splitlines() if not l.startswith('import time:')]
+        raise RuntimeError(lines[-1] if lines else f"код выхода {proc.returncode}")
+    return wall, parse_importtime(proc.stderr)
+
+
+def measure(module: str, repeat: int, top: int, workdir: str, env: Dict[str, str]) -> dict:
+    walls, totals = [], []
+    self_us: Dict[str, List[int]] = defaultdict(list)
+    cumulative_us: Dict[str, List[int]] = defaultdict(list)
+    for _ in range(repeat):
+        wall, rows = _run_once(module, workdir, env)
+        walls.append(wall)
+        own = next((cum for name, _, cum, depth in rows if name == module and depth == 0), 0)
+        totals.append(own)
+        for name, self_time, cum, _ in rows:
+            self_us[name].append(self_time)
+            cumulative_us[name].append(cum)
+
+    # Пакет верхнего уровня = сумма self-времени его модулей (aiogram.types.* -> aiogram)
+    packages: Dict[str, float] = defaultdict(float)
+    for name, values in self_us.items():
+        packages[name.split('.')[0]] += statistics.median(values)
+    heaviest = sorted(cumulative_us, key=lambda n: statistics.median(cumulative_us[n]), reverse=True)
+    return {
+        'module': module,
+        'import_ms': round(statistics.median(totals) / 1000, 1),
+        'process_wall_ms': round(statistics.median(walls) * 1000, 1),
+        'modules_imported': len(self_us),
+        'top_cumulative_ms': [
+            {'module': n, 'ms': round(statistics.median(cumulative_us[n]) / 1000, 1)}
+            for n in heaviest if n != module][:top],
+        'top_packages_ms': [
+            {'package': p, 'ms': round(us / 1000, 1)}
+            for p, us in sorted(packages.items(), key=lambda kv: kv[1], reverse=True)[:top]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время импорта модулей бота (python -X importtime)')
+    parser.add_argument('--modules', default=DEFAULT_MODULES, help='модули через запятую')
+    parser.add_argument('--repeat', type=int, default=5, help='прогонов на модуль (берётся медиана)')
+    parser.add_argument('--top', type=int, default=15, help='сколько самых тяжёлых модулей и пакетов выводить')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tgbot-imports-')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    # Bot() проверяет формат токена уже при импорте bot.py
+    env.setdefault('API_TOKEN', '123456:benchmark')
+    results = []
+    for module in (m for m in args.modules.split(',') if m):
+        print(f"{module}...", file=sys.stderr)
+        try:
+            results.append(measure(module, max(1, args.repeat), args.top, workdir, env))
+        except RuntimeError as e:
+            results.append({'module': module, 'error': str(e)})
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'params': {'repeat': args.repeat, 'top': args.top},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Микробенчмарк поиска model_service: построение индекса, память, размер на диске и
+задержка запросов по режимам (search, search_v2, только BM25, только dense, пакетный dense).
+
+    python -m benchmarks.retrieval_bench --scales 10000,100000,1000000 --output retrieval.json
+
+Каждый масштаб считается в отдельном процессе, чтобы пиковый RSS не смешивался между ними.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from benchmarks import corpus
+from benchmarks.run import _commit, percentile
+
+MODES = ('search', 'search_v2', 'bm25', 'dense', 'dense_batch')
+DEFAULT_SCALES = '10000,100000,1000000'
+
+
+def _rss_mb() -> float:
+    """Текущий RSS процесса, МБ"""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return round(pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+
+
+def _peak_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _resolve_embedder(name: str) -> str:
+    if name != 'auto':
+        return name
+    try:
+        import sentence_transformers  # noqa: F401
+        return 'model'
+    except ImportError:
+        return 'random'
+
+
+def _install_models(args):
+    """Реальные модели (--embedder model) или заглушки; LLM всегда фейковая — поиску она не нужна"""
+    from benchmarks import fake_models
+    if args.embedder == 'model':
+        import sentence_transformers
+        fake_models.install_fake_llama()
+        return sentence_transformers.SentenceTransformer, sentence_transformers.CrossEncoder
+    fake_models.install_fake_models(rerank_ms=args.rerank_ms)
+    fake_models.RandomEmbedder.dim = fake_models.FakeSentenceTransformer.dim = args.dim
+    fake_models.RandomEmbedder.seed = args.seed
+    embedder = fake_models.RandomEmbedder if args.embedder == 'random' else fake_models.FakeSentenceTransformer
+    return embedder, fake_models.FakeCrossEncoder
+
+
+def _measure(fn: Callable, items: list, budget: float, per_call: int = 1) -> dict:
+    """Задержка на запрос (для пакетов — на запрос внутри пакета); останавливается по бюджету
+    времени, но не раньше 5 вызовов"""
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        latencies.append((time.perf_counter() - start) / per_call)
+        if len(latencies) >= 5 and time.perf_counter() - started > budget:
+            break
+    wall = time.perf_counter() - started
+    ms = [x * 1000 for x in latencies]
+    return {
+        'queries': len(ms) * per_call,
+        'p50_ms': round(percentile(ms, 0.50), 3),
+        'p95_ms': round(percentile(ms, 0.95), 3),
+        'p99_ms': round(percentile(ms, 0.99), 3),
+        'mean_ms': round(sum(ms) / len(ms), 3),
+        'qps': round(len(ms) * per_call / wall, 2) if wall > 0 else None,
+    }
+
+
+def run_scale(args) -> dict:
+    """Один масштаб в текущем процессе (вызывается из дочернего процесса)"""
+    embedder_cls, cross_encoder_cls = _install_models(args)
+    os.chdir(args.workdir)
+    import numpy as np
+    import model_service as ms
+    import shared_index
+
+    result: Dict[str, object] = {'chunks': args.chunks, 'embedder': args.embedder}
+    start = time.perf_counter()
+    try:
+        ms.embedding_model = embedder_cls(args.model_name or ms.EMBEDDING_MODEL_NAME)
+        ms.cross_encoder = cross_encoder_cls(args.cross_encoder or ms.CROSS_ENCODER_MODEL)
+    except Exception as e:
+        # Весов нет (офлайн, не скачаны) — меряем на случайных векторах
+        from benchmarks.fake_models import FakeCrossEncoder, RandomEmbedder
+        print(f"Модели недоступны ({e}), используются случайные векторы", file=sys.stderr)
+        ms.embedding_model, ms.cross_encoder = RandomEmbedder(), FakeCrossEncoder()
+        result['embedder'] = 'random'
+    result['model_load_sec'] = round(time.perf_counter() - start, 3)
+    # Модели подставлены напрямую, без фоновой загрузки сервиса — открываем эндпоинты поиска
+    for name in ('embedder', 'cross_encoder', 'index'):
+        ms.component_state[name]['status'] = 'ready'
+
+    texts, metadata = corpus.generate_chunks(args.chunks, args.seed)
+    queries = corpus.generate_questions(args.queries, args.seed)
+    rss_before = _rss_mb()
+    loop = asyncio.new_event_loop()
+    start = time.perf_counter()
+    loop.run_until_complete(ms.index_docs(ms.IndexRequest(documents=texts, metadata=metadata)))
+    result['index_build_sec'] = round(time.perf_counter() - start, 3)
+    del texts, metadata
+    result['rss_mb'] = _rss_mb()
+    result['index_rss_mb'] = round(result['rss_mb'] - rss_before, 1)
+    result['disk_bytes'] = shared_index.disk_bytes(ms.INDEX_DIR) or None
+    start = time.perf_counter()
+    result['index_load_ok'] = loop.run_until_complete(ms.load_index_from_disk())
+    result['index_load_sec'] = round(time.perf_counter() - start, 3)
+
+    k = args.top_k
+
+    def dense(q: str):
+        q_emb = ms.embedding_model.encode([q], convert_to_numpy=True)
+        ms._dense_candidates(q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12), k * 3, None)
+
+    def dense_batch(batch: List[str]):
+        q_emb = ms.embedding_model.encode(batch, convert_to_numpy=True)
+        q_norm = q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
+        ms.dense_index.search(q_norm.astype('float32'), k * 3)
+
+    size = max(1, min(args.batch_size, len(queries)))
+    batches = [queries[i:i + size] for i in range(0, len(queries) - size + 1, size)]
+
+    modes = {
+        'search': (lambda q: loop.run_until_complete(ms.search(ms.SearchRequest(query=q, top_k=k))), queries, 1),
+        'search_v2': (lambda q: loop.run_until_complete(ms.search_v2(ms.SearchRequest(query=q, top_k=k))), queries, 1),
+        'bm25': (lambda q: ms._bm25_candidates(q, k * 3, None), queries, 1),
+        'dense': (dense, queries, 1),
+        'dense_batch': (dense_batch, batches, size),
+    }
+    result['modes'] = {}
+    for name in args.modes:
+        fn, items, per_call = modes[name]
+        result['modes'][name] = _measure(fn, items, args.budget, per_call)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    loop.close()
+    return result
+
+
+def _child_command(args, chunks: int, workdir: str) -> List[str]:
+    command = [
+        sys.executable, '-m', 'benchmarks.retrieval_bench', '--worker', '--chunks', str(chunks),
+        '--workdir', workdir, '--embedder', args.embedder, '--dim', str(args.dim), '--queries', str(args.queries),
+        '--batch-size', str(args.batch_size), '--top-k', str(args.top_k), '--budget', str(args.budget),
+        '--rerank-ms', str(args.rerank_ms), '--seed', str(args.seed), '--modes', ','.join(args.modes),
+    ]
+    if args.model_name:
+        command += ['--model-name', args.model_name]
+    if args.cross_encoder:
+        command += ['--cross-encoder', args.cross_encoder]
+    return command
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарк поиска model_service')
+    parser.add_argument('--scales', default=DEFAULT_SCALES, help='размеры корпуса в чанках через запятую')
+    parser.add_argument('--embedder', choices=('auto', 'model', 'hash', 'random'), default='auto',
+                        help='model — sentence_transformers, hash — хеш слов, random — случайные векторы; '
+                             'auto — model, если пакет установлен')
+    parser.add_argument('--model-name', help='модель эмбеддингов (по умолчанию EMBEDDING_MODEL_NAME)')
+    parser.add_argument('--cross-encoder', help='cross-encoder для search_v2 (по умолчанию CROSS_ENCODER_MODEL)')
+    parser.add_argument('--dim', type=int, default=384, help='размерность векторов заглушек')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=32, help='запросов в пакете для dense_batch')
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=30.0, help='секунд на режим (минимум 5 запросов)')
+    parser.add_argument('--rerank-ms', type=float, default=0.0, help='задержка заглушки cross-encoder на пару')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help='каталог для индексов (по умолчанию временный)')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--chunks', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.modes = [m for m in args.modes.split(',') if m]
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"неизвестные режимы: {', '.join(sorted(unknown))}")
+
+    if args.worker:
+        print(json.dumps(run_scale(args), ensure_ascii=False))
+        return
+
+    args.embedder = _resolve_embedder(args.embedder)
+    base_dir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='tgbot-retrieval-')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    results = []
+    for chunks in (int(s) for s in args.scales.split(',') if s):
+        workdir = os.path.join(base_dir, str(chunks))
+        os.makedirs(workdir, exist_ok=True)
+        print(f"{chunks} чанков...", file=sys.stderr)
+        proc = subprocess.run(_child_command(args, chunks, workdir), env=env, cwd=REPO_DIR,
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines()
+            results.append({'chunks': chunks, 'error': lines[-1] if lines else f"код выхода {proc.returncode}"})
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'workdir', 'worker', 'chunks')},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Нагрузочные сценарии бота: настоящие обработчики (bot.setup_handlers) через Dispatcher,
+фейковый Telegram и model_service с фейковыми моделями в отдельном процессе.
+
+    python -m benchmarks.run --scenario all --users 20 --output bench.json
+
+Результат — JSON с p50/p95/p99, пропускной способностью и исходами по каждому сценарию,
+плюс коммит и параметры машины, чтобы сравнивать прогоны между коммитами.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from benchmarks import corpus
+
+SCENARIOS = ('question_burst', 'upload_during_traffic', 'mass_registration')
+ADMIN_ID = 1
+# Диапазоны ID пользователей по сценариям, чтобы сценарии одного прогона не пересекались
+USER_ID_BASE = {'question_burst': 100_000, 'upload_during_traffic': 200_000, 'mass_registration': 300_000}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Перцентиль с линейной интерполяцией (q от 0 до 1)"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = math.floor(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(latencies: List[float], errors: int, wall: float) -> dict:
+    ms = [x * 1000 for x in latencies]
+
+    def r(value):
+        return round(value, 2) if value is not None else None
+
+    return {
+        'count': len(ms),
+        'errors': errors,
+        'p50_ms': r(percentile(ms, 0.50)),
+        'p95_ms': r(percentile(ms, 0.95)),
+        'p99_ms': r(percentile(ms, 0.99)),
+        'mean_ms': r(sum(ms) / len(ms)) if ms else None,
+        'max_ms': r(max(ms)) if ms else None,
+        'throughput_per_sec': round(len(ms) / wall, 3) if wall > 0 else None,
+    }
+
+
+class Recorder:
+    """Задержки и ошибки по именованным метрикам одного сценария"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.outcomes: Counter = Counter()
+        self.started = time.perf_counter()
+
+    async def timed(self, name: str, coro) -> bool:
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            self.errors[name] += 1
+            self.outcomes[f"error:{type(e).__name__}"] += 1
+            return False
+        self.latencies[name].append(time.perf_counter() - start)
+        return True
+
+    def report(self) -> dict:
+        wall = time.perf_counter() - self.started
+        names = set(self.latencies) | set(self.errors)
+        return {
+            'wall_sec': round(wall, 3),
+            'metrics': {name: summarize(self.latencies[name], self.errors[name], wall) for name in sorted(names)},
+            'outcomes': dict(self.outcomes),
+        }
+
+
+class Context:
+    def __init__(self, bot_module, dp, session, factory, args):
+        self.bot_module = bot_module
+        self.dp = dp
+        self.session = session
+        self.factory = factory
+        self.args = args
+
+    async def feed(self, update):
+        await self.dp.feed_update(self.bot_module.bot, update)
+
+
+def _question_outcome(ctx: Context, user_id: int) -> str:
+    text = ctx.session.last_text(user_id)
+    if text.startswith('Вопрос:'):
+        return 'answered'
+    if text.startswith('Я не уверен'):
+        return 'not_found'
+    if any(text == reply for _, reply in ctx.bot_module.QUESTION_REJECT_MESSAGES.values()):
+        return 'queue_rejected'
+    return 'other'
+
+
+async def _question_traffic(ctx: Context, recorder: Recorder, base: int):
+    """Каждый пользователь задаёт свои вопросы последовательно, пользователи — одновременно"""
+    args = ctx.args
+    users = [base + i for i in range(args.users)]
+    for i, user_id in enumerate(users):
+        await ctx.bot_module.authorize_user(user_id, {
+            'name': f"Пользователь {i}", 'employee_id': f"Q-{user_id}",
+            'department': f"Отдел {list(corpus.TOPICS)[i % len(corpus.TOPICS)]}", 'position': 'специалист',
+            'verified_at': datetime.now().strftime('%Y-%m-%d %H:%M'),
+        })
+    questions = corpus.generate_questions(args.users * args.questions_per_user, args.seed + base)
+
+    async def user_flow(index: int, user_id: int):
+        for q in questions[index::args.users]:
+            await ctx.feed(ctx.factory.text(user_id, '/ask'))
+            if await recorder.timed('question', ctx.feed(ctx.factory.text(user_id, q))):
+                recorder.outcomes[_question_outcome(ctx, user_id)] += 1
+
+    await asyncio.gather(*(user_flow(i, u) for i, u in enumerate(users)))
+
+
+async def question_burst(ctx: Context) -> dict:
+    recorder = Recorder()
+    await _question_traffic(ctx, recorder, USER_ID_BASE['question_burst'])
+    return recorder.report()
+
+
+async def upload_during_traffic(ctx: Context) -> dict:
+    """Админ загружает .docx (переиндексация всего корпуса), пока пользователи задают вопросы"""
+    args = ctx.args
+    recorder = Recorder()
+    _, paragraphs = corpus.SCALES[args.scale]
+    documents = corpus.generate_documents(args.uploads, paragraphs, args.seed + 1)
+
+    async def uploads():
+        for i, document in enumerate(documents):
+            buffer = io.BytesIO()
+            corpus.write_docx(document, buffer)
+            await ctx.feed(ctx.factory.text(ADMIN_ID, '/train'))
+            update = ctx.factory.document(ADMIN_ID, f"upload_{i:03d}.docx", buffer.getvalue())
+            if await recorder.timed('upload', ctx.feed(update)):
+                ok = ctx.session.last_text(ADMIN_ID).startswith('✅')
+                recorder.outcomes['upload_ok' if ok else 'upload_failed'] += 1
+
+    await asyncio.gather(uploads(), _question_traffic(ctx, recorder, USER_ID_BASE['upload_during_traffic']))
+    return recorder.report()
+
+
+async def mass_registration(ctx: Context) -> dict:
+    """Одновременная регистрация: /start → ФИО → табельный; часть пользователей ошибается в табельном"""
+    args = ctx.args
+    bot_module = ctx.bot_module
+    recorder = Recorder()
+    employees = corpus.generate_employees(args.users, args.seed)
+    # Кэш сотрудников прогрет заранее: меряем установившийся режим, а не первую синхронизацию
+    await bot_module.sync_with_1c()
+    base = USER_ID_BASE['mass_registration']
+
+    async def steps(user_id: int, full_name: str, employee_id: str):
+        for text in ('/start', full_name, employee_id):
+            if not await recorder.timed('registration_step', ctx.feed(ctx.factory.text(user_id, text))):
+                raise RuntimeError('registration step failed')
+
+    async def user_flow(i: int, emp: dict):
+        user_id = base + i
+        wrong = args.bad_registration_ratio and i % round(1 / args.bad_registration_ratio) == 0
+        employee_id = f"XX-{i:06d}" if wrong else emp['employee_id']
+        if await recorder.timed('registration', steps(user_id, emp['full_name'], employee_id)):
+            recorder.outcomes['registered' if await bot_module.is_authorized(user_id) else 'rejected'] += 1
+
+    await asyncio.gather(*(user_flow(i, emp) for i, emp in enumerate(employees)))
+    return recorder.report()
+
+
+SCENARIO_FUNCS = {
+    'question_burst': question_burst,
+    'upload_during_traffic': upload_during_traffic,
+    'mass_registration': mass_registration,
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_model_service(args, workdir: str) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    log = open(os.path.join(workdir, 'model_service.log'), 'wb')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.stub_model_service', '--port', str(port),
+        '--tokens-per-sec', str(args.tokens_per_sec), '--prompt-tokens-per-sec', str(args.prompt_tokens_per_sec),
+        '--answer-tokens', str(args.answer_tokens), '--embed-ms', str(args.embed_ms), '--rerank-ms', str(args.rerank_ms),
+    ], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"model_service завершился при старте, см. {log.name}")
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1) as resp:
+                status = json.loads(resp.read()).get('status')
+            # Модели грузятся в фоне после открытия порта — ждём готовности всех компонентов
+            if status == 'ok':
+                return process, url
+            if status == 'error':
+                process.terminate()
+                raise RuntimeError(f"model_service не загрузил модели, см. {log.name}")
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"model_service не ответил за {args.startup_timeout} с, см. {log.name}")
+
+
+def prepare_environment(args, workdir: str, model_url: str):
+    """Окружение бота задаётся до импорта config: временная БД, фейковый токен, выгрузка 1С"""
+    employees_path = os.path.join(workdir, 'employees.csv')
+    corpus.write_employees_csv(corpus.generate_employees(args.users, args.seed), employees_path)
+    os.environ.update({
+        'API_TOKEN': '123456:benchmark',
+        'ADMIN_CHAT_ID': str(ADMIN_ID),
+        'DATABASE_PATH': os.path.join(workdir, 'benchmark.db'),
+        'MODEL_SERVICE_URL': model_url,
+        'ONEC_EXPORT_PATH': employees_path,
+    })
+    os.environ.setdefault('STATE_BACKEND', 'memory')
+    # docs/, logs/, models/ в config заданы относительными путями
+    os.chdir(workdir)
+    corpus.write_corpus(os.path.join(workdir, 'docs'), args.scale, args.seed)
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', '-C', REPO_DIR, 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_scenarios(args, scenarios: List[str]) -> dict:
+    import logging
+    from aiogram import Dispatcher
+    import bot as bot_module
+    from database import init_db, close_db, close_db_pools
+    from benchmarks.fake_telegram import FakeTelegramSession, UpdateFactory
+
+    logging.getLogger().setLevel(args.log_level)
+    session = FakeTelegramSession(latency=args.telegram_latency_ms / 1000.0)
+    bot_module.bot.session = session
+    await init_db()
+    bot_module.STATE.start()
+    dp = Dispatcher()
+    bot_module.setup_handlers(dp)
+    ctx = Context(bot_module, dp, session, UpdateFactory(session), args)
+    try:
+        start = time.perf_counter()
+        chunks = await bot_module.rebuild_service_index_from_docs()
+        setup = {'index_chunks': chunks, 'index_build_sec': round(time.perf_counter() - start, 3)}
+        results = {}
+        for name in scenarios:
+            calls_before = Counter(session.calls)
+            results[name] = await SCENARIO_FUNCS[name](ctx)
+            results[name]['telegram_calls'] = dict(Counter(session.calls) - calls_before)
+        return {'setup': setup, 'scenarios': results}
+    finally:
+        await bot_module.progress_manager.close()
+        await bot_module.STATE.close()
+        await close_db_pools()
+        await close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочные сценарии бота с фейковыми Telegram и LLM')
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--scale', choices=sorted(corpus.SCALES), default='small', help='размер корпуса документов')
+    parser.add_argument('--users', type=int, default=20, help='одновременных пользователей')
+    parser.add_argument('--questions-per-user', type=int, default=3)
+    parser.add_argument('--uploads', type=int, default=3, help='загрузок .docx в upload_during_traffic')
+    parser.add_argument('--bad-registration-ratio', type=float, default=0.1, help='доля регистраций с неверным табельным')
+    parser.add_argument('--telegram-latency-ms', type=float, default=30.0, help='задержка каждого вызова Bot API')
+    parser.add_argument('--tokens-per-sec', type=float, default=30.0)
+    parser.add_argument('--prompt-tokens-per-sec', type=float, default=400.0)
+    parser.add_argument('--answer-tokens', type=int, default=64)
+    parser.add_argument('--embed-ms', type=float, default=0.0)
+    parser.add_argument('--rerank-ms', type=float, default=0.0)
+    parser.add_argument('--model-url', help='уже запущенный model_service (вместо фейкового)')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help='рабочий каталог (по умолчанию временный)')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='tgbot-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    scenarios = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+
+    process = None
+    model_url = args.model_url
+    if not model_url:
+        process, model_url = start_model_service(args, workdir)
+    try:
+        prepare_environment(args, workdir, model_url)
+        result = asyncio.run(run_scenarios(args, scenarios))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'workdir', 'log_level')},
+        'model_service': 'external' if args.model_url else 'fake',
+        'workdir': workdir,
+        **result,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+model_service с фейковыми моделями: настоящий FastAPI, FAISS и BM25, без весов и GPU.
+
+    python -m benchmarks.stub_model_service --port 8000 --tokens-per-sec 30
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_models import install_fake_models
+
+
+def main():
+    parser = argparse.ArgumentParser(description='model_service с детерминированными заглушками моделей')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--tokens-per-sec', type=float, default=30.0, help='скорость декодирования')
+    parser.add_argument('--prompt-tokens-per-sec', type=float, default=400.0, help='скорость обработки промпта')
+    parser.add_argument('--answer-tokens', type=int, default=64, help='длина ответа в токенах')
+    parser.add_argument('--embed-ms', type=float, default=0.0, help='задержка эмбеддинга на текст')
+    parser.add_argument('--rerank-ms', type=float, default=0.0, help='задержка cross-encoder на пару')
+    args = parser.parse_args()
+
+    install_fake_models(args.tokens_per_sec, args.prompt_tokens_per_sec, args.answer_tokens,
+                        args.embed_ms, args.rerank_ms)
+    import uvicorn
+    import model_service
+    uvicorn.run(model_service.app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
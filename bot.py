@@ -1,29 +1,46 @@
 import logging
 from aiogram import Bot, types, Dispatcher
 from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 import os
 import asyncio
-from typing import List, Dict, Optional, Set
+from typing import Iterable, List, Dict, Optional, Set, Tuple
 from datetime import datetime, timedelta
 from database import (verify_employee, log_registration_attempt, get_registration_attempts, get_all_employees,
-                     log_qa_session, save_feedback, log_unanswered_question, get_analytics_stats, get_popular_questions)
-from llm_client import LLMClient
-from docx import Document
+                     log_qa_session, save_feedback, log_unanswered_question, get_analytics_stats, get_popular_questions,
+                     get_search_comparison, get_unclustered_questions, get_unanswered_clusters, save_unanswered_clusters)
+from llm_client import LLMClient, TokenLimitExceeded
 import re
 from collections import defaultdict
-from config import API_TOKEN, ADMIN_CHAT_ID, DOCS_DIR as DOCUMENTS_DIR, LOGS_DIR, ONEC_EXPORT_PATH, CONFIDENCE_THRESHOLD, DATABASE_PATH, USE_SEARCH_V2, SEARCH_V2_PERCENTAGE
-from onec_sync import load_employees_from_file
+from config import ensure_directories, API_TOKEN, ADMIN_CHAT_ID, DOCS_DIR as DOCUMENTS_DIR, LOGS_DIR, ONEC_EXPORT_PATH, CONFIDENCE_THRESHOLD, DATABASE_PATH, USE_SEARCH_V2, SEARCH_V2_PERCENTAGE, DEDUP_THRESHOLD, SEARCH_DEPARTMENT_FILTER, NAME_MATCH_THRESHOLD, VERIFY_NEGATIVE_TTL, UNANSWERED_CLUSTER_THRESHOLD, UNANSWERED_CLUSTER_BATCH, UNANSWERED_CLUSTER_INTERVAL_SEC, STATE_TTL_SEC, STATE_MAX_ENTRIES, STATE_SWEEP_INTERVAL_SEC, STATE_BACKEND, STATE_NEAR_CACHE_TTL_SEC, STATE_REDIS_PREFIX, PROGRESS_EDIT_INTERVAL_SEC, PROGRESS_GLOBAL_EDITS_PER_SEC, QUESTION_MAX_CONCURRENT, QUESTION_PER_USER_LIMIT, QUESTION_MAX_WAIT_SEC, ADMIN_API_TOKEN, PROFILE_MAX_SEC, PROFILES_DIR, SLOW_REQUEST_THRESHOLD_SEC, PROFILER_SAMPLE_INTERVAL_MS, CONTEXT_MAX_CHUNKS
+from onec_sync import iter_employees_from_file, export_fingerprint, export_unchanged
+from dedup import MinHashDeduplicator
+from name_index import NameIndex, name_similarity
+from question_clusters import QuestionCluster, assign_clusters
+from state_store import TTLStore, sweep_all, memory_report
+from state_backend import create_state_backend
 import time
 from progress_bars import ProgressManager
+from question_scheduler import QuestionScheduler, QuestionRejected
+from tracing import SpanLog, current_trace_id, new_trace, record, span, stage_timings, trace_headers
+from profiler import ProfilerBusy, SlowRequestCapture, profile_for
 from aiogram.filters import Text
 
 # Конфигурация для LLM (через сервис)
 MAX_LENGTH = 2048
 MAX_NEW_TOKENS = 512
 
+# Рабочие каталоги (docs, logs, models, backups) — до настройки логов в файл
+ensure_directories()
+
 # Глобальные переменные для клиентов
 llm_client = LLMClient()
+# Спаны обработки вопросов (logs/traces_bot.jsonl), trace ID уходит в model_service
+SPAN_LOG = SpanLog('bot', LOGS_DIR)
+# Стеки вопросов, обработка которых заняла дольше SLOW_REQUEST_THRESHOLD_SEC (logs/profiles/bot)
+SLOW_CAPTURE = SlowRequestCapture(os.path.join(PROFILES_DIR, 'bot'), SLOW_REQUEST_THRESHOLD_SEC,
+                                  PROFILER_SAMPLE_INTERVAL_MS / 1000)
 
 auth_logger = logging.getLogger(__name__)
 
@@ -42,7 +59,7 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=API_TOKEN)
 
 # Инициализация менеджера прогресс-баров
-progress_manager = ProgressManager(bot)
+progress_manager = ProgressManager(bot, PROGRESS_EDIT_INTERVAL_SEC, PROGRESS_GLOBAL_EDITS_PER_SEC)
 
 # Клавиатуры
 main_kb = ReplyKeyboardMarkup(
@@ -86,73 +103,145 @@ def normalize_employee_id(text: str) -> str:
 EMPLOYEES_CACHE: Dict[str, dict] = {}
 # Индекс по нормализованному ID
 EMPLOYEES_BY_NORM_ID: Dict[str, dict] = {}
-
-# Попытки регистрации и состояния пользователей
-REGISTRATION_ATTEMPTS: Dict[int, Dict[str, any]] = {}
+# Нечёткий индекс по ФИО (подменяется вместе с кэшем)
+EMPLOYEES_NAME_INDEX = NameIndex()
+# Недавние отказы внешней БД: (norm_id, norm_name), живут VERIFY_NEGATIVE_TTL
+VERIFY_NEGATIVE_CACHE = TTLStore('verify_negative', ttl=VERIFY_NEGATIVE_TTL, max_size=STATE_MAX_ENTRIES)
+
+# Состояние пользователей (авторизация, шаги диалога, попытки регистрации) — в общем
+# бэкенде STATE_BACKEND, чтобы переживать перезапуск и работать с несколькими репликами
+STATE = create_state_backend(STATE_BACKEND, max_size=STATE_MAX_ENTRIES, cache_ttl=STATE_NEAR_CACHE_TTL_SEC,
+                             redis_prefix=STATE_REDIS_PREFIX, unbounded=('auth',))
 MAX_ATTEMPTS = 3
 RETRY_COMMANDS = ['retry', 'повтор', 'заново']
-USER_STATES: Dict[int, Dict[str, any]] = {}
-AUTHORIZED_USERS: Set[int] = set()
-AUTHORIZED_INFO: Dict[int, Dict[str, str]] = {}
 
 async def set_user_state(user_id: int, key: str, value: str):
-    state = USER_STATES.get(user_id, {})
+    state = await STATE.get('user_state', str(user_id)) or {}
     state[key] = value
-    USER_STATES[user_id] = state
+    await STATE.set('user_state', str(user_id), state, STATE_TTL_SEC)
 
 async def get_user_state(user_id: int, key: str) -> Optional[str]:
-    return USER_STATES.get(user_id, {}).get(key)
+    return (await STATE.get('user_state', str(user_id)) or {}).get(key)
 
 async def clear_user_state(user_id: int):
-    if user_id in USER_STATES:
-        del USER_STATES[user_id]
+    await STATE.delete('user_state', str(user_id))
+
+async def get_authorized_info(user_id: int) -> Optional[Dict[str, str]]:
+    return await STATE.get('auth', str(user_id))
+
+async def is_authorized(user_id: int) -> bool:
+    return await get_authorized_info(user_id) is not None
+
+async def authorize_user(user_id: int, info: Dict[str, str]):
+    await STATE.set('auth', str(user_id), info)
+
+async def periodic_state_sweep():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL_SEC)
+        try:
+            removed = sweep_all() + await STATE.purge_expired()
+            if removed:
+                logger.debug(f"Очистка состояния: удалено {removed} просроченных записей")
+        except Exception as e:
+            logger.error(f"Ошибка в periodic_state_sweep: {e}")
+
+async def get_registration_attempts_today(user_id: int) -> Optional[dict]:
+    # Счётчик за день — суток жизни хватает
+    return await STATE.get('attempts', str(user_id))
 
 async def can_try_registration(user_id: int) -> bool:
     now_key = datetime.now().strftime('%Y%m%d')
-    data = REGISTRATION_ATTEMPTS.get(user_id)
+    data = await get_registration_attempts_today(user_id)
     if not data or data.get('date') != now_key:
         return True
     return data.get('count', 0) < MAX_ATTEMPTS
 
 async def inc_registration_attempt(user_id: int):
     now_key = datetime.now().strftime('%Y%m%d')
-    data = REGISTRATION_ATTEMPTS.get(user_id)
+    data = await get_registration_attempts_today(user_id)
     if not data or data.get('date') != now_key:
-        REGISTRATION_ATTEMPTS[user_id] = {'date': now_key, 'count': 1}
+        data = {'date': now_key, 'count': 1}
     else:
         data['count'] = data.get('count', 0) + 1
-        REGISTRATION_ATTEMPTS[user_id] = data
+    await STATE.set('attempts', str(user_id), data, 86400)
 
 async def get_next_attempt_time(user_id: int) -> str:
-    data = REGISTRATION_ATTEMPTS.get(user_id)
+    data = await get_registration_attempts_today(user_id)
     if not data:
         return "сейчас"
     next_day = datetime.strptime(data['date'], '%Y%m%d') + timedelta(days=1)
     return next_day.strftime('%d.%m.%Y в %H:%M')
 
+# Поля сотрудника, изменение которых считается изменением записи
+EMPLOYEE_FIELDS = ('full_name', 'department', 'position')
+# Сколько ID из каждой категории изменений выводить в лог
+SYNC_DIFF_LOG_LIMIT = 20
+
+def build_employee_index(employees: Iterable[Dict]) -> Tuple[Dict[str, dict], Dict[str, dict], NameIndex]:
+    """Строит новый кэш, индекс по нормализованному ID и индекс ФИО в стороне от текущих"""
+    cache: Dict[str, dict] = {}
+    by_norm_id: Dict[str, dict] = {}
+    for emp in employees:
+        emp_id = emp['employee_id']
+        cache[emp_id] = emp
+        norm = normalize_employee_id(emp_id)
+        emp['norm_id'] = norm
+        emp['norm_name'] = normalize_name(emp.get('full_name', ''))
+        by_norm_id[norm] = emp
+    return cache, by_norm_id, NameIndex.build(cache.values())
+
+def swap_employee_index(cache: Dict[str, dict], by_norm_id: Dict[str, dict], name_index: NameIndex, source: str):
+    """Атомарно подменяет кэш сотрудников и логирует только изменения"""
+    global EMPLOYEES_CACHE, EMPLOYEES_BY_NORM_ID, EMPLOYEES_NAME_INDEX
+    old = EMPLOYEES_CACHE
+    added = sorted(cache.keys() - old.keys())
+    removed = sorted(old.keys() - cache.keys())
+    changed = sorted(
+        emp_id for emp_id in cache.keys() & old.keys()
+        if any(cache[emp_id].get(f) != old[emp_id].get(f) for f in EMPLOYEE_FIELDS)
+    )
+    # Одно присваивание без await: обработчики видят либо старый, либо новый индекс целиком
+    EMPLOYEES_CACHE, EMPLOYEES_BY_NORM_ID, EMPLOYEES_NAME_INDEX = cache, by_norm_id, name_index
+    # Справочник обновился — прежние отказы могли устареть
+    VERIFY_NEGATIVE_CACHE.clear()
+    logger.info(f"Синхронизация сотрудников ({source}): всего {len(cache)}, "
+                f"добавлено {len(added)}, удалено {len(removed)}, изменено {len(changed)}")
+    for label, ids in (("добавлены", added), ("удалены", removed), ("изменены", changed)):
+        if ids:
+            tail = f" и ещё {len(ids) - SYNC_DIFF_LOG_LIMIT}" if len(ids) > SYNC_DIFF_LOG_LIMIT else ""
+            logger.info(f"Сотрудники {label}: {', '.join(ids[:SYNC_DIFF_LOG_LIMIT])}{tail}")
+
 async def load_employees_from_file_to_cache() -> int:
     if not ONEC_EXPORT_PATH:
         return 0
     try:
-        rows = await load_employees_from_file(ONEC_EXPORT_PATH)
-        EMPLOYEES_CACHE.clear()
-        EMPLOYEES_BY_NORM_ID.clear()
-        for emp in rows:
-            emp_id = emp['employee_id']
-            EMPLOYEES_CACHE[emp_id] = emp
-            norm = normalize_employee_id(emp_id)
-            emp['norm_id'] = norm
-            emp['norm_name'] = normalize_name(emp.get('full_name', ''))
-            EMPLOYEES_BY_NORM_ID[norm] = emp
-        logger.info(f"Импортировано из файла: {len(rows)} записей")
-        return len(rows)
+        previous = IC_CACHE.get("export_fingerprint")
+        fingerprint = await asyncio.to_thread(export_fingerprint, ONEC_EXPORT_PATH, previous)
+        if fingerprint is None:
+            logger.warning(f"Файл выгрузки 1С не найден: {ONEC_EXPORT_PATH}")
+            return 0
+        if EMPLOYEES_CACHE and export_unchanged(previous, fingerprint):
+            IC_CACHE["export_fingerprint"] = fingerprint
+            logger.info("Выгрузка 1С не изменилась, разбор пропущен")
+            return len(EMPLOYEES_CACHE)
+        # Разбор и построение индекса — в отдельном потоке, чтобы не блокировать обработку сообщений
+        cache, by_norm_id, name_index = await asyncio.to_thread(
+            lambda: build_employee_index(iter_employees_from_file(ONEC_EXPORT_PATH))
+        )
+        if not cache:
+            logger.warning("Выгрузка 1С пуста, текущий кэш сохранён")
+            return 0
+        swap_employee_index(cache, by_norm_id, name_index, "файл")
+        IC_CACHE["export_fingerprint"] = fingerprint
+        return len(cache)
     except Exception as e:
         logger.error(f"Ошибка загрузки сотрудников из файла: {e}")
         return 0
 
 IC_CACHE = {
     "last_sync": None,
-    "sync_in_progress": False
+    "sync_in_progress": False,
+    "export_fingerprint": None
 }
 
 async def sync_with_1c():
@@ -166,14 +255,9 @@ async def sync_with_1c():
             success = cnt > 0
         else:
             employees = await get_all_employees()
-            EMPLOYEES_CACHE.clear()
-            EMPLOYEES_BY_NORM_ID.clear()
-            for emp in employees:
-                EMPLOYEES_CACHE[emp["employee_id"]] = emp
-                norm = normalize_employee_id(emp["employee_id"])
-                emp['norm_id'] = norm
-                emp['norm_name'] = normalize_name(emp.get('full_name', ''))
-                EMPLOYEES_BY_NORM_ID[norm] = emp
+            if employees:
+                cache, by_norm_id, name_index = await asyncio.to_thread(build_employee_index, employees)
+                swap_employee_index(cache, by_norm_id, name_index, "БД")
             success = len(EMPLOYEES_CACHE) > 0
         if success:
             IC_CACHE["last_sync"] = datetime.now()
@@ -207,6 +291,46 @@ async def periodic_sync():
             logger.error(f"Ошибка в periodic_sync: {e}")
             await asyncio.sleep(300)
 
+async def cluster_unanswered_questions() -> int:
+    """Раскладывает новые неотвеченные вопросы по кластерам; эмбеддинги — одним запросом на пакет."""
+    questions = await get_unclustered_questions(UNANSWERED_CLUSTER_BATCH)
+    if not questions:
+        return 0
+    embeddings = await llm_client.create_embeddings([q for _, q in questions])
+    if not embeddings or len(embeddings) != len(questions):
+        return 0
+    clusters = [QuestionCluster.from_row(*row) for row in await get_unanswered_clusters()]
+    # Сравнение с центроидами — чистый Python, уносим из цикла событий
+    assignments = await asyncio.to_thread(
+        assign_clusters, clusters, questions, embeddings, UNANSWERED_CLUSTER_THRESHOLD
+    )
+    if not await save_unanswered_clusters(clusters, assignments):
+        return 0
+    return len(assignments)
+
+async def periodic_unanswered_clustering():
+    while True:
+        try:
+            processed = await cluster_unanswered_questions()
+            if processed:
+                logger.info(f"Кластеризовано неотвеченных вопросов: {processed}")
+            # Есть полный пакет — вероятно, очередь не разобрана, продолжаем сразу
+            if processed < UNANSWERED_CLUSTER_BATCH:
+                await asyncio.sleep(UNANSWERED_CLUSTER_INTERVAL_SEC)
+        except Exception as e:
+            logger.error(f"Ошибка в periodic_unanswered_clustering: {e}")
+            await asyncio.sleep(UNANSWERED_CLUSTER_INTERVAL_SEC)
+
+def _cached_verification(emp: dict, employee_id: str, score: float) -> dict:
+    return {
+        "verified": True,
+        "department": emp.get("department", ""),
+        "position": emp.get("position", ""),
+        "employee_id": emp.get("employee_id", employee_id),
+        "from_cache": True,
+        "name_score": round(score, 3)
+    }
+
 async def verify_user_in_1c(full_name: str, employee_id: str) -> Optional[dict]:
     try:
         if not IC_CACHE["last_sync"] or datetime.now() - IC_CACHE["last_sync"] > timedelta(hours=1):
@@ -214,16 +338,26 @@ async def verify_user_in_1c(full_name: str, employee_id: str) -> Optional[dict]:
         norm_id = normalize_employee_id(employee_id)
         norm_name = normalize_name(full_name)
         emp = EMPLOYEES_BY_NORM_ID.get(norm_id)
-        if emp and emp.get('norm_name') == norm_name:
-            return {
-                "verified": True,
-                "department": emp.get("department", ""),
-                "position": emp.get("position", ""),
-                "employee_id": emp.get("employee_id", employee_id),
-                "from_cache": True
-            }
+        if emp:
+            # Табельный найден: ФИО сверяем нечётко (Ё/Е, опечатки, инициалы) без обращения к БД
+            if emp.get('norm_name') == norm_name:
+                return _cached_verification(emp, employee_id, 1.0)
+            score = name_similarity(full_name, emp.get('full_name', ''), NAME_MATCH_THRESHOLD)
+            if score >= NAME_MATCH_THRESHOLD:
+                return _cached_verification(emp, employee_id, score)
+            logger.info(f"ФИО не совпало с кэшем для ID {employee_id}: score={score:.2f}")
+            return {"verified": False, "from_cache": True}
+        if EMPLOYEES_NAME_INDEX.best(full_name, NAME_MATCH_THRESHOLD):
+            # Кэш мог отстать от БД (сменился табельный, однофамилец), поэтому не отказываем, а проверяем в БД
+            logger.info(f"ФИО {full_name} найдено в кэше с другим табельным, проверяем ID {employee_id} в БД")
+        # Промах кэша по табельному: идём в БД, но не чаще раза в VERIFY_NEGATIVE_TTL для той же пары
+        key = (norm_id, norm_name)
+        if key in VERIFY_NEGATIVE_CACHE:
+            return {"verified": False, "negative_cache": True}
         result = await verify_employee(full_name, employee_id)
         logger.info(f"Employee verification result for {full_name} (ID: {employee_id}): {result}")
+        if not result.get('verified') and 'error' not in result:
+            VERIFY_NEGATIVE_CACHE[key] = True
         return result
     except Exception as e:
         logger.error(f"Employee verification error: {e}")
@@ -233,6 +367,8 @@ async def verify_user_in_1c(full_name: str, employee_id: str) -> Optional[dict]:
 
 def extract_text_from_docx(file_path: str) -> str:
     try:
+        # python-docx (с lxml) нужен только при индексации — не тянем его в старт бота
+        from docx import Document
         doc = Document(file_path)
         full_text = []
         for para in doc.paragraphs:
@@ -270,6 +406,21 @@ def split_text_into_chunks(text: str, chunk_size: int = 500) -> List[str]:
         chunks.append(' '.join(current_chunk))
     return chunks
 
+# Метки отделов в метаданных чанков и синонимы из справочника сотрудников
+DEPARTMENT_TAGS = ['hr', 'ит', 'бухгалтерия', 'продажи', 'маркетинг', 'администрация', 'безопасность']
+DEPARTMENT_ALIASES = {'it': 'ит', 'кадр': 'hr', 'персонал': 'hr', 'продаж': 'продажи', 'финанс': 'бухгалтерия'}
+
+def department_tag(department: str) -> Optional[str]:
+    """Приводит отдел сотрудника (например, «IT отдел») к метке из DEPARTMENT_TAGS"""
+    dept = (department or '').lower()
+    for tag in DEPARTMENT_TAGS:
+        if tag in dept:
+            return tag
+    for alias, tag in DEPARTMENT_ALIASES.items():
+        if alias in dept:
+            return tag
+    return None
+
 def extract_metadata_from_text(text: str) -> Dict[str, str]:
     """Извлекает метаданные из текста документа"""
     metadata = {}
@@ -286,8 +437,7 @@ def extract_metadata_from_text(text: str) -> Dict[str, str]:
         metadata['doc_type'] = 'document'
     
     # Ищем упоминания отделов
-    departments = ['hr', 'ит', 'бухгалтерия', 'продажи', 'маркетинг', 'администрация', 'безопасность']
-    for dept in departments:
+    for dept in DEPARTMENT_TAGS:
         if dept in text_lower:
             metadata['department'] = dept
             break
@@ -404,18 +554,53 @@ def smart_chunk_documents(text: str, filename: str = "") -> List[Dict]:
     logger.info(f"Документ разбит на {len(chunks)} чанков (тип: {doc_type})")
     return chunks
 
-async def generate_response(query: str, context: str = "") -> str:
+async def usage_identity(user_id: int) -> dict:
+    """Кто спрашивает — model_service ведёт учёт и лимиты токенов по пользователю и отделу"""
+    if not user_id:
+        return {}
+    return {"telegram_id": user_id, "department": (await get_authorized_info(user_id) or {}).get('department', '')}
+
+async def generate_response(query: str, context_hits: List[dict],
+                            user_id: int = 0) -> Tuple[Optional[str], List[dict]]:
+    """Ответ и хиты, попавшие в контекст: model_service упаковывает их в бюджет токенов
+    (CONTEXT_TOKEN_BUDGET) и сообщает, какие взял. None — найденное не поместилось в контекст,
+    и отвечать без опоры на документы нельзя"""
     try:
-        response = await llm_client.generate(query=query, context=context, max_tokens=MAX_NEW_TOKENS)
-        if response is None:
-            return "Извините, произошла ошибка при обработке вашего запроса."
-        return response
+        with span('generate'):
+            result = await llm_client.generate_answer(query=query, context_chunks=context_hits,
+                                                      max_tokens=MAX_NEW_TOKENS, require_context=bool(context_hits),
+                                                      **await usage_identity(user_id))
+        if result is None:
+            return "Извините, произошла ошибка при обработке вашего запроса.", []
+        used = result.get('context_used')
+        if used is None:
+            return result['response'], context_hits
+        used_hits = [context_hits[i] for i in used if 0 <= i < len(context_hits)]
+        if context_hits and not used_hits:
+            return None, []
+        return result['response'], used_hits
+    except TokenLimitExceeded:
+        # Отказ по лимиту — не ответ: обработчик вопроса сообщит о нём без записи в qa_sessions
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации ответа: {e}")
-        return "Извините, произошла ошибка при обработке вашего запроса."
+        return "Извините, произошла ошибка при обработке вашего запроса.", []
 
 # Для хранения сессий Q&A и связывания с feedback
-QA_SESSIONS: Dict[int, int] = {}  # message_id -> qa_session_id
+QA_SESSIONS = TTLStore('qa_sessions', ttl=86400, max_size=STATE_MAX_ENTRIES)  # message_id -> qa_session_id
+
+# Очередь вопросов: не больше QUESTION_MAX_CONCURRENT генераций одновременно (по мощности model_service)
+question_scheduler = QuestionScheduler(QUESTION_MAX_CONCURRENT, QUESTION_PER_USER_LIMIT, QUESTION_MAX_WAIT_SEC)
+# Причина снятия вопроса -> (текст прогресс-бара, ответ пользователю); 'quota' — месячный лимит токенов
+QUESTION_REJECT_MESSAGES = {
+    'limit': ("⏳ Предыдущий вопрос ещё обрабатывается",
+              "Дождитесь ответа на предыдущий вопрос, затем задайте следующий через /ask."),
+    'cancelled': ("⏹️ Вопрос отменён", "Вопрос отменён. Задайте новый через /ask."),
+    'expired': ("⌛ Слишком долгое ожидание в очереди",
+                "Сейчас много вопросов, ваш снят с очереди. Задайте его снова через /ask."),
+    'quota': ("⛔ Лимит токенов исчерпан",
+              "Лимит запросов к модели на этот месяц исчерпан. Обратитесь к администратору."),
+}
 
 # A/B тестирование и конфигурация
 # USE_SEARCH_V2 и SEARCH_V2_PERCENTAGE берём из config.py
@@ -427,7 +612,7 @@ def _sanitize_filename(name: str) -> str:
     name = re.sub(r"[^\w\-\.]+", "_", name)
     return name.strip("._") or f"doc_{int(datetime.now().timestamp())}.docx"
 
-async def expand_query(original_query: str) -> List[str]:
+async def expand_query(original_query: str, user_id: int = 0) -> List[str]:
     """Расширение запроса: генерация альтернативных формулировок"""
     try:
         # Генерируем перефразировки
@@ -441,7 +626,8 @@ async def expand_query(original_query: str) -> List[str]:
         response = await llm_client.generate(
             query=rephrase_prompt,
             max_tokens=150,
-            temperature=0.3
+            temperature=0.3,
+            **await usage_identity(user_id)
         )
         
         if response:
@@ -474,7 +660,17 @@ def should_use_search_v2(user_id: int) -> bool:
     # A/B тест: определённый процент пользователей на новой версии
     return (user_id % 100) < SEARCH_V2_PERCENTAGE
 
-async def search_documents(query: str, user_id: int = 0, use_expansion: bool = True) -> tuple:
+async def build_search_filters(user_id: int) -> Optional[dict]:
+    """Фильтр поиска по отделу пользователя (общие документы без метки отдела остаются)"""
+    if not SEARCH_DEPARTMENT_FILTER:
+        return None
+    tag = department_tag((await get_authorized_info(user_id) or {}).get('department', ''))
+    if not tag:
+        return None
+    return {"departments": [tag], "include_untagged": True}
+
+async def search_documents(query: str, user_id: int = 0, use_expansion: bool = True,
+                           filters: Optional[dict] = None) -> tuple:
     """Универсальная функция поиска с выбором версии и расширением запросов"""
     try:
         search_version = "v2" if should_use_search_v2(user_id) else "v1"
@@ -483,7 +679,8 @@ async def search_documents(query: str, user_id: int = 0, use_expansion: bool = T
         # Query expansion для улучшения результатов
         queries_to_search = [query]
         if use_expansion and len(query) > 20:  # Расширяем только длинные запросы
-            queries_to_search = await expand_query(query)
+            with span('expand_query'):
+                queries_to_search = await expand_query(query, user_id)
         
         all_hits = []
         confidence_scores = []
@@ -491,44 +688,50 @@ async def search_documents(query: str, user_id: int = 0, use_expansion: bool = T
         import aiohttp
         async with aiohttp.ClientSession() as session:
             for search_query in queries_to_search:
-                async with session.post(f"{llm_client.base_url}{endpoint}", 
-                                      json={"query": search_query, "top_k": 3}) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        hits = data.get('hits', [])
-                        if hits:
-                            all_hits.extend(hits)
-                            confidence_scores.extend([h['score'] for h in hits])
+                with span('search_request'):
+                    async with session.post(f"{llm_client.base_url}{endpoint}", headers=trace_headers(),
+                                          json={"query": search_query, "top_k": 3, "filters": filters}) as resp:
+                        if resp.status == 200:
+                            data = await resp.json()
+                            hits = data.get('hits', [])
+                            if hits:
+                                all_hits.extend(hits)
+                                confidence_scores.extend([h['score'] for h in hits])
         
-        # Дедупликация по тексту и ранжирование
+        # Почти-дубликаты схлопнуты при индексации, здесь убираем только
+        # повторы одного и того же чанка из разных формулировок запроса
         seen_texts = set()
         unique_hits = []
         for hit in all_hits:
-            text_hash = hash(hit['text'][:100])  # Хеш первых 100 символов
+            text_hash = hash(hit['text'])
             if text_hash not in seen_texts:
                 seen_texts.add(text_hash)
                 unique_hits.append(hit)
         
-        # Сортируем по скору и берём топ-3
+        # Сортируем по скору; сколько из них войдёт в промпт, решает бюджет токенов в model_service
         unique_hits.sort(key=lambda x: x['score'], reverse=True)
-        final_hits = unique_hits[:3]
+        final_hits = unique_hits[:CONTEXT_MAX_CHUNKS]
         
         if final_hits:
-            top_context = "\n\n".join(h['text'] for h in final_hits)
-            sources_block = f"\n\nИсточники ({search_version}):\n" + "\n".join([f"— {round(h['score'],3)}" for h in final_hits])
-            top_score = final_hits[0]['score']
-            
-            return top_context, sources_block, top_score, True, search_version
+            return final_hits, final_hits[0]['score'], True, search_version
         else:
-            return "", "", 0.0, False, search_version
+            return [], 0.0, False, search_version
             
     except Exception as e:
         logger.error(f"Ошибка в search_documents: {e}")
-        return "", "", 0.0, False, "error"
+        return [], 0.0, False, "error"
+
+def format_sources(hits: List[dict], search_version: str) -> str:
+    if not hits:
+        return ""
+    return f"\n\nИсточники ({search_version}):\n" + "\n".join([
+        f"— {round(h['score'],3)}" + (f" ({', '.join(h['sources'][:3])})" if h.get('sources') else "")
+        for h in hits
+    ])
 
 async def rebuild_service_index_from_docs() -> int:
     try:
-        documents: List[str] = []
+        all_chunks: List[Dict] = []
         for fname in os.listdir(DOCUMENTS_DIR):
             if not any(fname.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
                 continue
@@ -537,12 +740,22 @@ async def rebuild_service_index_from_docs() -> int:
             if not text:
                 continue
             # Используем умное разбиение с метаданными
-            smart_chunks = smart_chunk_documents(text, fname)
-            # Извлекаем только текст для индексации (пока что)
-            chunk_texts = [chunk['text'] for chunk in smart_chunks if chunk['text'].strip()]
-            documents.extend(chunk_texts)
+            smart_chunks = [chunk for chunk in smart_chunk_documents(text, fname) if chunk['text'].strip()]
+            all_chunks.extend(smart_chunks)
             
-            logger.info(f"Обработан {fname}: {len(chunk_texts)} чанков")
+            logger.info(f"Обработан {fname}: {len(smart_chunks)} чанков")
+        
+        # Схлопываем повторяющиеся между документами фрагменты (шаблонные абзацы регламентов)
+        unique_chunks = MinHashDeduplicator(threshold=DEDUP_THRESHOLD).deduplicate(all_chunks)
+        if len(unique_chunks) < len(all_chunks):
+            logger.info(f"Почти-дубликатов схлопнуто: {len(all_chunks) - len(unique_chunks)} "
+                        f"(осталось {len(unique_chunks)} из {len(all_chunks)})")
+        documents: List[str] = [chunk['text'] for chunk in unique_chunks]
+        # Метаданные уходят в сервис для префильтрации поиска (отдел, тип, даты, источники)
+        metadata: List[Dict] = [
+            {key: chunk['metadata'].get(key) for key in ('doc_type', 'department', 'dates', 'filename', 'sources')}
+            for chunk in unique_chunks
+        ]
             
         if not documents:
             logger.info("Нет документов для индексации")
@@ -550,7 +763,7 @@ async def rebuild_service_index_from_docs() -> int:
             
         import aiohttp
         async with aiohttp.ClientSession() as session:
-            async with session.post(f"{llm_client.base_url}/index", json={"documents": documents}) as resp:
+            async with session.post(f"{llm_client.base_url}/index", json={"documents": documents, "metadata": metadata}) as resp:
                 if resp.status != 200:
                     err = await resp.text()
                     logger.error(f"Ошибка при обращении к /index: {err}")
@@ -573,6 +786,29 @@ def create_feedback_keyboard(qa_session_id: int) -> InlineKeyboardMarkup:
     ])
     return keyboard
 
+# Задачи, навешивающие кнопки фидбека после коммита сессии (ссылки держим до завершения)
+_FEEDBACK_TASKS: Set[asyncio.Task] = set()
+
+async def attach_feedback_keyboard(chat_id: int, message_id: int, qa_session: Optional[asyncio.Future],
+                                   search_version: str, response_time_ms: int):
+    """Ждёт ID сессии из очереди записи и добавляет к уже отправленному ответу кнопки фидбека"""
+    qa_session_id = 0
+    try:
+        if qa_session is not None:
+            qa_session_id = await qa_session
+    except Exception as e:
+        logger.error(f"Сессия Q&A не записана, ответ останется без кнопок фидбека: {e}")
+    SPAN_LOG.write(qa_session_id=qa_session_id, version=search_version, total_ms=response_time_ms)
+    if not qa_session_id:
+        return
+    # Сохраняем связь сообщения и сессии для обработки фидбека
+    QA_SESSIONS[message_id] = qa_session_id
+    try:
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id,
+                                            reply_markup=create_feedback_keyboard(qa_session_id))
+    except Exception as e:
+        logger.error(f"Ошибка добавления кнопок фидбека: {e}")
+
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 
 def setup_handlers(dp: Dispatcher):
@@ -582,7 +818,7 @@ def setup_handlers(dp: Dispatcher):
         if not API_TOKEN:
             await message.answer('❌ Не задан API_TOKEN. Укажите его в .env')
             return
-        if user_id in AUTHORIZED_USERS:
+        if await is_authorized(user_id):
             await message.answer('Добро пожаловать! Вы авторизованы.', reply_markup=main_kb)
             return
         if await can_try_registration(user_id):
@@ -604,6 +840,7 @@ def setup_handlers(dp: Dispatcher):
     async def cancel_handler(message: types.Message):
         user_id = message.from_user.id
         await clear_user_state(user_id)
+        question_scheduler.cancel_user(user_id)
         await message.answer('Операция отменена. Используйте /start для регистрации.', reply_markup=ReplyKeyboardRemove())
 
     # Русская кнопка «Отмена»
@@ -614,10 +851,10 @@ def setup_handlers(dp: Dispatcher):
     @dp.message(Command('status'))
     async def status_handler(message: types.Message):
         user_id = message.from_user.id
-        if user_id not in AUTHORIZED_USERS:
+        if not await is_authorized(user_id):
             await message.answer('❌ Недоступно до завершения регистрации. Используйте /start.')
             return
-        info = AUTHORIZED_INFO.get(user_id, {})
+        info = (await get_authorized_info(user_id) or {})
         await message.answer(
             f"👤 ФИО: {info.get('name','-')}\n"
             f"🔢 Табельный: {info.get('employee_id','-')}\n"
@@ -637,6 +874,35 @@ def setup_handlers(dp: Dispatcher):
             reply_markup=ReplyKeyboardRemove()
         )
 
+    # ====== Админ: профиль CPU бота или model_service ======
+    @dp.message(Command('profile'))
+    async def profile_handler(message: types.Message):
+        if message.from_user.id != ADMIN_CHAT_ID:
+            await message.answer('❌ Команда доступна только администратору.')
+            return
+        # /profile [секунд] [bot|model]
+        args = (message.text or '').split()[1:]
+        seconds = next((int(a) for a in args if a.isdigit()), 10)
+        seconds = max(1, min(seconds, PROFILE_MAX_SEC))
+        target = 'model' if 'model' in args else 'bot'
+        await message.answer(f"⏱️ Профилирую {target} {seconds} с...")
+        if target == 'bot':
+            try:
+                data = (await profile_for(seconds)).encode('utf-8')
+            except ProfilerBusy:
+                await message.answer('❌ Профилирование уже идёт.')
+                return
+        else:
+            data = await llm_client.profile(seconds, ADMIN_API_TOKEN)
+        if not data:
+            await message.answer('❌ Не удалось снять профиль (нет сэмплов или не задан ADMIN_API_TOKEN).')
+            return
+        filename = f"{target}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+        await message.answer_document(
+            BufferedInputFile(data, filename=filename),
+            caption='Collapsed stacks: flamegraph.pl, speedscope.app или inferno'
+        )
+
     @dp.message(lambda m: m.document is not None)
     async def handle_document_upload(message: types.Message):
         try:
@@ -683,7 +949,7 @@ def setup_handlers(dp: Dispatcher):
     @dp.message(lambda message: message.text and message.text.lower() in RETRY_COMMANDS)
     async def retry_registration(message: types.Message):
         user_id = message.from_user.id
-        if user_id in AUTHORIZED_USERS:
+        if await is_authorized(user_id):
             await message.answer('Вы уже зарегистрированы.', reply_markup=main_kb)
             return
         if await can_try_registration(user_id):
@@ -709,7 +975,8 @@ def setup_handlers(dp: Dispatcher):
         user_id = message.from_user.id
         step = await get_user_state(user_id, 'step')
         if not step:
-            return
+            # Не в регистрации — сообщение достаётся следующим обработчикам (/ask, вопросы)
+            raise SkipHandler()
         if step == 'name':
             name_parts = message.text.strip().split()
             if len(name_parts) != 3:
@@ -733,14 +1000,13 @@ def setup_handlers(dp: Dispatcher):
             verification_result = await verify_user_in_1c(name, employee_id)
             if verification_result and verification_result.get('verified'):
                 await clear_user_state(user_id)
-                AUTHORIZED_USERS.add(user_id)
-                AUTHORIZED_INFO[user_id] = {
+                await authorize_user(user_id, {
                     'name': name,
                     'employee_id': employee_id,
                     'department': verification_result.get('department',''),
                     'position': verification_result.get('position',''),
                     'verified_at': datetime.now().strftime('%Y-%m-%d %H:%M')
-                }
+                })
                 await log_registration_attempt(user_id, name, employee_id, True)
                 # Уведомление админу о успешной регистрации
                 await send_admin_notification(
@@ -763,7 +1029,7 @@ def setup_handlers(dp: Dispatcher):
             else:
                 await inc_registration_attempt(user_id)
                 await log_registration_attempt(user_id, name or '', employee_id, False)
-                attempts = REGISTRATION_ATTEMPTS.get(user_id, {}).get('count', 0)
+                attempts = (await get_registration_attempts_today(user_id) or {}).get('count', 0)
                 # Уведомление админу о неудачной попытке
                 await send_admin_notification(
                     f"❌ Неудачная попытка регистрации\n"
@@ -792,7 +1058,7 @@ def setup_handlers(dp: Dispatcher):
     @dp.message(Command('ask'))
     async def ask_handler(message: types.Message):
         user_id = message.from_user.id
-        if user_id not in AUTHORIZED_USERS:
+        if not await is_authorized(user_id):
             await message.answer("❌ Вы не авторизованы! Используйте /start для регистрации.")
             return
         # Запоминаем авторизованного пользователя и включаем режим ожидания вопроса
@@ -812,7 +1078,7 @@ def setup_handlers(dp: Dispatcher):
     @dp.message(lambda message: True)
     async def process_question(message: types.Message):
         user_id = message.from_user.id
-        if user_id not in AUTHORIZED_USERS:
+        if not await is_authorized(user_id):
             return
         awaiting = await get_user_state(user_id, 'awaiting_question')
         if not awaiting:
@@ -821,99 +1087,152 @@ def setup_handlers(dp: Dispatcher):
         await set_user_state(user_id, 'awaiting_question', '0')
         
         start_time = time.time()
+        # Окно профиля медленного вопроса начинается со слота: ожидание в очереди не в счёт
+        started = None
+        # Трасса вопроса: trace ID уходит в model_service, этапы пишутся в qa_sessions и span-лог
+        new_trace()
         
-        # Запускаем прогресс-бар
-        await progress_manager.start_progress(user_id, "🤔 Анализирую ваш вопрос...")
+        # Прогресс-бар привязан к чату: запускаем его только после проверки лимита пользователя,
+        # иначе отклонённый вопрос остановил бы бар ещё выполняющегося предыдущего
+        progress_started = False
+        
+        async def start_progress(text: str):
+            nonlocal progress_started
+            if not progress_started:
+                progress_started = True
+                await progress_manager.start_progress(user_id, text)
+        
+        async def show_queue_position(position: int):
+            text = f"⏳ Вы в очереди: {position}-й"
+            if progress_started:
+                await progress_manager.update_progress(user_id, 0.1, text)
+            else:
+                await start_progress(text)
         
         try:
-            import aiohttp
-            top_context = ""
-            sources_block = ""
-            # conf_threshold = 0.12  # заменено на использование CONFIDENCE_THRESHOLD из config.py
-            confidence_score = 0.0
-            context_found = False
+            # Ждём своей очереди: общий лимит генераций и справедливый порядок между пользователями
+            queued_at = time.perf_counter()
+            async with question_scheduler.slot(user_id, show_queue_position):
+                record('queue_wait', queued_at, time.perf_counter() - queued_at)
+                started = time.monotonic()
+                await start_progress("🤔 Анализирую ваш вопрос...")
+                try:
+                    import aiohttp
+                    context_hits: List[dict] = []
+                    # conf_threshold = 0.12  # заменено на использование CONFIDENCE_THRESHOLD из config.py
+                    confidence_score = 0.0
+                    context_found = False
             
-            # Обновляем прогресс - поиск контекста
-            await progress_manager.update_progress(user_id, 0.3, "💭 Ищу информацию в документах...")
+                    # Обновляем прогресс - поиск контекста
+                    await progress_manager.update_progress(user_id, 0.3, "💭 Ищу информацию в документах...")
             
-            try:
-                # Используем универсальную функцию поиска
-                top_context, sources_block, confidence_score, context_found, search_version = await search_documents(message.text, user_id)
+                    try:
+                        # Используем универсальную функцию поиска
+                        with span('search'):
+                            context_hits, confidence_score, context_found, search_version = await search_documents(
+                                message.text, user_id, filters=await build_search_filters(user_id)
+                            )
                 
-                if not context_found:
-                    # Логируем как неотвеченный вопрос
-                    user_info = AUTHORIZED_INFO.get(user_id, {})
-                    await log_unanswered_question(
-                        user_id, 
-                        message.text, 
-                        f"Department: {user_info.get('department', '')}, Position: {user_info.get('position', '')}"
-                    )
-                    await progress_manager.error_progress(user_id, "❌ Информация не найдена")
-                    await message.answer(
-                        "Я не уверен в ответе. Уточните вопрос или добавьте деталей (дата, подразделение, документ)."
-                    )
-                    return
+                        if not context_found:
+                            # Логируем как неотвеченный вопрос
+                            user_info = (await get_authorized_info(user_id) or {})
+                            await log_unanswered_question(
+                                user_id, 
+                                message.text, 
+                                f"Department: {user_info.get('department', '')}, Position: {user_info.get('position', '')}"
+                            )
+                            await progress_manager.error_progress(user_id, "❌ Информация не найдена")
+                            await message.answer(
+                                "Я не уверен в ответе. Уточните вопрос или добавьте деталей (дата, подразделение, документ)."
+                            )
+                            return
                 
-                if confidence_score < CONFIDENCE_THRESHOLD:
-                    # Логируем как неотвеченный вопрос
-                    user_info = AUTHORIZED_INFO.get(user_id, {})
-                    await log_unanswered_question(
-                        user_id, 
-                        message.text, 
-                        f"Department: {user_info.get('department', '')}, Position: {user_info.get('position', '')}, Search: {search_version}"
-                    )
-                    await progress_manager.error_progress(user_id, f"❌ Низкая уверенность ({search_version})")
-                    await message.answer(
-                        f"Я не уверен в ответе (поиск: {search_version}). Уточните вопрос или добавьте деталей (дата, подразделение, документ)."
-                    )
-                    return
-            except Exception as e:
-                logger.error(f"Ошибка поиска контекста: {e}")
-
-            # Обновляем прогресс - генерация ответа
-            await progress_manager.update_progress(user_id, 0.7, "✨ Формирую ответ...")
+                        if confidence_score < CONFIDENCE_THRESHOLD:
+                            # Логируем как неотвеченный вопрос
+                            user_info = (await get_authorized_info(user_id) or {})
+                            await log_unanswered_question(
+                                user_id, 
+                                message.text, 
+                                f"Department: {user_info.get('department', '')}, Position: {user_info.get('position', '')}, Search: {search_version}"
+                            )
+                            await progress_manager.error_progress(user_id, f"❌ Низкая уверенность ({search_version})")
+                            await message.answer(
+                                f"Я не уверен в ответе (поиск: {search_version}). Уточните вопрос или добавьте деталей (дата, подразделение, документ)."
+                            )
+                            return
+                    except Exception as e:
+                        logger.error(f"Ошибка поиска контекста: {e}")
+
+                    # Обновляем прогресс - генерация ответа
+                    await progress_manager.update_progress(user_id, 0.7, "✨ Формирую ответ...")
             
-            context = top_context
-            response = await generate_response(message.text, context)
+                    response, used_hits = await generate_response(message.text, context_hits, user_id)
+                    if response is None:
+                        # Найденные фрагменты не поместились в бюджет контекста — как «не найдено»
+                        user_info = (await get_authorized_info(user_id) or {})
+                        await log_unanswered_question(
+                            user_id,
+                            message.text,
+                            f"Department: {user_info.get('department', '')}, Position: {user_info.get('position', '')}, Search: {search_version}, Context: dropped"
+                        )
+                        await progress_manager.error_progress(user_id, "❌ Информация не найдена")
+                        await message.answer(
+                            "Я не уверен в ответе. Уточните вопрос или добавьте деталей (дата, подразделение, документ)."
+                        )
+                        return
+                    sources_block = format_sources(used_hits, search_version)
             
-            # Завершаем прогресс-бар
-            await progress_manager.complete_progress(user_id, "✅ Ответ готов!")
+                    # Завершаем прогресс-бар
+                    await progress_manager.complete_progress(user_id, "✅ Ответ готов!")
             
-            # Замеряем время ответа
-            response_time_ms = int((time.time() - start_time) * 1000)
+                    # Замеряем время ответа
+                    response_time_ms = int((time.time() - start_time) * 1000)
             
-            # Логируем сессию Q&A с информацией о версии поиска
-            user_info = AUTHORIZED_INFO.get(user_id, {})
-            qa_session_id = await log_qa_session(
-                telegram_id=user_id,
-                user_name=user_info.get('name', message.from_user.full_name or ''),
-                employee_id=user_info.get('employee_id', ''),
-                question=message.text,
-                answer=f"[{search_version}] {response}",  # Помечаем версию поиска
-                response_time_ms=response_time_ms,
-                confidence_score=confidence_score,
-                context_found=context_found
-            )
-            
-            # Отправляем ответ с кнопками фидбека
-            feedback_kb = create_feedback_keyboard(qa_session_id)
-            sent_msg = await message.answer(
-                f"Вопрос: {message.text}\n\n"
-                f"Ответ: {response}{sources_block}",
-                reply_markup=feedback_kb
-            )
+                    # Логируем сессию Q&A с информацией о версии поиска
+                    user_info = (await get_authorized_info(user_id) or {})
+                    qa_session = await log_qa_session(
+                        telegram_id=user_id,
+                        user_name=user_info.get('name', message.from_user.full_name or ''),
+                        employee_id=user_info.get('employee_id', ''),
+                        question=message.text,
+                        answer=f"[{search_version}] {response}",  # Помечаем версию поиска
+                        response_time_ms=response_time_ms,
+                        confidence_score=confidence_score,
+                        context_found=context_found,
+                        search_version=search_version,
+                        stage_timings=stage_timings()
+                    )
             
-            # Сохраняем связь сообщения и сессии для обработки фидбека
-            if qa_session_id:
-                QA_SESSIONS[sent_msg.message_id] = qa_session_id
+                    # Ответ уходит сразу, не дожидаясь записи в БД; кнопки фидбека
+                    # появятся, когда сессия закоммитится и получит ID
+                    sent_msg = await message.answer(
+                        f"Вопрос: {message.text}\n\n"
+                        f"Ответ: {response}{sources_block}"
+                    )
+                    task = asyncio.create_task(attach_feedback_keyboard(
+                        message.chat.id, sent_msg.message_id, qa_session, search_version, response_time_ms
+                    ))
+                    _FEEDBACK_TASKS.add(task)
+                    task.add_done_callback(_FEEDBACK_TASKS.discard)
                 
-        except Exception as e:
-            logger.error(f"Ошибка при обработке вопроса: {e}")
-            await progress_manager.error_progress(user_id, "❌ Произошла ошибка")
-            await message.answer(
-                "😔 Извините, произошла ошибка при обработке вашего вопроса. Попробуйте позже.",
-                reply_markup=main_kb
-            )
+                except TokenLimitExceeded:
+                    raise
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке вопроса: {e}")
+                    await progress_manager.error_progress(user_id, "❌ Произошла ошибка")
+                    await message.answer(
+                        "😔 Извините, произошла ошибка при обработке вашего вопроса. Попробуйте позже.",
+                        reply_markup=main_kb
+                    )
+        except (QuestionRejected, TokenLimitExceeded) as e:
+            reason = e.reason if isinstance(e, QuestionRejected) else 'quota'
+            progress_text, reply_text = QUESTION_REJECT_MESSAGES[reason]
+            if progress_started:
+                await progress_manager.error_progress(user_id, progress_text)
+            await message.answer(reply_text, reply_markup=main_kb)
+        finally:
+            if started is not None:
+                await SLOW_CAPTURE.check(started, f"question_{current_trace_id()}")
 
     # Обработчик callback для кнопок фидбека
     @dp.callback_query(lambda c: c.data and c.data.startswith('feedback_'))
@@ -945,7 +1264,7 @@ def setup_handlers(dp: Dispatcher):
     # Команда /help
     @dp.message(Command('help'))
     async def help_handler(message: types.Message):
-        if message.from_user.id not in AUTHORIZED_USERS:
+        if not await is_authorized(message.from_user.id):
             await message.answer("❌ Недоступно до завершения регистрации. Используйте /start.")
             return
         help_text = (
@@ -1009,7 +1328,15 @@ def setup_handlers(dp: Dispatcher):
                     report_lines.append(f'{i}. "{short_q}" ({freq}x)')
                 report_lines.append('')
             
-            # Неотвеченные вопросы
+            # Неотвеченные темы (кластеры похожих формулировок)
+            if stats.get('unanswered_clusters'):
+                report_lines.append('❓ <b>Неотвеченные темы:</b>')
+                for question, variants, freq in stats['unanswered_clusters'][:5]:
+                    short_q = question[:50] + '...' if len(question) > 50 else question
+                    report_lines.append(f'• "{short_q}" ({freq}x, формулировок: {variants})')
+                report_lines.append('')
+            
+            # Неотвеченные вопросы, ещё не попавшие в кластеры
             if stats.get('unanswered_questions'):
                 report_lines.append('❓ <b>Неотвеченные вопросы:</b>')
                 for question, freq in stats['unanswered_questions'][:5]:
@@ -1017,6 +1344,12 @@ def setup_handlers(dp: Dispatcher):
                     report_lines.append(f'• "{short_q}" ({freq}x)')
                 report_lines.append('')
             
+            # Объём состояния бота в памяти
+            report_lines.append('🧠 <b>Состояние в памяти:</b>')
+            for store in memory_report():
+                report_lines.append(f'• {store["name"]}: {store["size"]} зап., ~{store["bytes"] // 1024} КБ')
+            report_lines.append('')
+            
             # Популярные вопросы за месяц
             if popular_questions:
                 report_lines.append('📅 <b>Топ вопросов за месяц:</b>')
@@ -1049,44 +1382,12 @@ def setup_handlers(dp: Dispatcher):
         
         try:
             # Анализируем логи за последние 7 дней
-            import aiosqlite
-            async with aiosqlite.connect(DATABASE_PATH) as db:
-                # Статистика v1 (без префикса [v2])
-                async with db.execute(
-                    """SELECT 
-                        COUNT(*) as total,
-                        AVG(response_time_ms) as avg_time,
-                        AVG(confidence_score) as avg_confidence
-                    FROM qa_sessions 
-                    WHERE created_at >= datetime('now', '-7 days')
-                    AND (answer NOT LIKE '[v2]%' OR answer IS NULL)"""
-                ) as cursor:
-                    v1_stats = await cursor.fetchone()
-                
-                # Статистика v2 (с префиксом [v2])
-                async with db.execute(
-                    """SELECT 
-                        COUNT(*) as total,
-                        AVG(response_time_ms) as avg_time,
-                        AVG(confidence_score) as avg_confidence
-                    FROM qa_sessions 
-                    WHERE created_at >= datetime('now', '-7 days')
-                    AND answer LIKE '[v2]%'"""
-                ) as cursor:
-                    v2_stats = await cursor.fetchone()
-                
-                # Фидбек по версиям
-                async with db.execute(
-                    """SELECT 
-                        CASE WHEN qa.answer LIKE '[v2]%' THEN 'v2' ELSE 'v1' END as version,
-                        SUM(CASE WHEN f.rating = 1 THEN 1 ELSE 0 END) as likes,
-                        SUM(CASE WHEN f.rating = -1 THEN 1 ELSE 0 END) as dislikes
-                    FROM feedback f
-                    JOIN qa_sessions qa ON f.qa_session_id = qa.id
-                    WHERE qa.created_at >= datetime('now', '-7 days')
-                    GROUP BY version"""
-                ) as cursor:
-                    feedback_stats = await cursor.fetchall()
+            comparison = await get_search_comparison(days=7)
+            if not comparison:
+                raise RuntimeError("нет данных сравнения")
+            v1_stats = comparison['v1']
+            v2_stats = comparison['v2']
+            feedback_stats = comparison['feedback']
             
             # Формируем отчёт
             report_lines = [
@@ -1,56 +1,166 @@
+"""
+Настройки из окружения и .env.
+
+Значения читаются один раз, при первом обращении к любой настройке (from config import X
+или config.X), и дальше берутся из кэша. Импорт модуля ничего не читает и не создаёт:
+рабочие каталоги создаёт ensure_directories() при старте процесса.
+"""
+
 import os
-from dotenv import load_dotenv
-
-# Загружаем переменные окружения
-load_dotenv()
-
-# Telegram Bot
-API_TOKEN = os.getenv('API_TOKEN') or ''
-ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', '0'))
-
-# Model Service
-MODEL_SERVICE_URL = os.getenv('MODEL_SERVICE_URL', 'http://localhost:8000')
-# Путь к GGUF модели для сервиса модели (используется model_service.py)
-GGUF_MODEL_PATH = os.getenv('GGUF_MODEL_PATH', 'models/model-gigachat_20b_q6_0.gguf')
-
-# RAG Configuration
-EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'paraphrase-multilingual-MiniLM-L12-v2')
-CROSS_ENCODER_MODEL = os.getenv('CROSS_ENCODER_MODEL', 'cross-encoder/ms-marco-MiniLM-L-12-v2')
-USE_SEARCH_V2 = os.getenv('USE_SEARCH_V2', 'false').lower() == 'true'
-SEARCH_V2_PERCENTAGE = int(os.getenv('SEARCH_V2_PERCENTAGE', '30'))  # % пользователей на новой версии
-CONFIDENCE_THRESHOLD = float(os.getenv('CONFIDENCE_THRESHOLD', '0.12'))  # Порог уверенности для ответов
-
-# Database (SQLite for logs); External employees DB
-DATABASE_PATH = os.getenv('DATABASE_PATH', 'employees.db')
-# MySQL
-MYSQL_HOST = os.getenv('MYSQL_HOST', '')
-MYSQL_PORT = int(os.getenv('MYSQL_PORT', '3306'))
-MYSQL_DB = os.getenv('MYSQL_DB', '')
-MYSQL_USER = os.getenv('MYSQL_USER', '')
-MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD', '')
-# MS SQL Server
-MSSQL_DSN = os.getenv('MSSQL_DSN', '')  # предпочтительно DSN (настроенный в odbc.ini)
-MSSQL_HOST = os.getenv('MSSQL_HOST', '')
-MSSQL_PORT = int(os.getenv('MSSQL_PORT', '1433'))
-MSSQL_DB = os.getenv('MSSQL_DB', '')
-MSSQL_USER = os.getenv('MSSQL_USER', '')
-MSSQL_PASSWORD = os.getenv('MSSQL_PASSWORD', '')
-
-# Logging
-LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
-
-# Redis
-REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+from functools import lru_cache
+from typing import Any, Dict
+
 
 # Directories
 DOCS_DIR = 'docs'
 LOGS_DIR = 'logs'
 MODELS_DIR = 'models'
 BACKUPS_DIR = 'backups'
+ARCHIVE_DIR = os.path.join(BACKUPS_DIR, 'archive')
+PROFILES_DIR = os.path.join(LOGS_DIR, 'profiles')
+
+
+@lru_cache(maxsize=None)
+def _settings() -> Dict[str, Any]:
+    from dotenv import load_dotenv
+
+    # Загружаем переменные окружения
+    load_dotenv()
+
+    # Telegram Bot
+    API_TOKEN = os.getenv('API_TOKEN') or ''
+    ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', '0'))
+
+    # Model Service
+    MODEL_SERVICE_URL = os.getenv('MODEL_SERVICE_URL', 'http://localhost:8000')
+    # Путь к GGUF модели для сервиса модели (используется model_service.py)
+    GGUF_MODEL_PATH = os.getenv('GGUF_MODEL_PATH', 'models/model-gigachat_20b_q6_0.gguf')
+    LLAMA_CTX = int(os.getenv('LLAMA_CTX', '2048'))
+    LLAMA_THREADS = int(os.getenv('LLAMA_THREADS', '4'))
+    LLAMA_BATCH = int(os.getenv('LLAMA_BATCH', '256'))
+    LLAMA_GPU_LAYERS = int(os.getenv('LLAMA_GPU_LAYERS', '32'))
+    # Воркеры API model_service; при нескольких воркерах LLM живёт в inference_server за unix-сокетом
+    MODEL_SERVICE_WORKERS = int(os.getenv('MODEL_SERVICE_WORKERS', '1'))
+    # Пусто — LLM в процессе сервиса (только при одном воркере)
+    LLM_SOCKET_PATH = os.getenv('LLM_SOCKET_PATH', '')
+    LLM_CONNECT_TIMEOUT_SEC = int(os.getenv('LLM_CONNECT_TIMEOUT_SEC', '900'))
+
+    # RAG Configuration
+    EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'paraphrase-multilingual-MiniLM-L12-v2')
+    CROSS_ENCODER_MODEL = os.getenv('CROSS_ENCODER_MODEL', 'cross-encoder/ms-marco-MiniLM-L-12-v2')
+    USE_SEARCH_V2 = os.getenv('USE_SEARCH_V2', 'false').lower() == 'true'
+    SEARCH_V2_PERCENTAGE = int(os.getenv('SEARCH_V2_PERCENTAGE', '30'))  # % пользователей на новой версии
+    CONFIDENCE_THRESHOLD = float(os.getenv('CONFIDENCE_THRESHOLD', '0.12'))  # Порог уверенности для ответов
+    # Префильтр поиска по отделу пользователя (чанки без метки отдела остаются доступны)
+    SEARCH_DEPARTMENT_FILTER = os.getenv('SEARCH_DEPARTMENT_FILTER', 'false').lower() == 'true'
+    DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.85'))  # Жаккар, выше которого чанки считаются дубликатами
+
+    # Database (SQLite for logs); External employees DB
+    DATABASE_PATH = os.getenv('DATABASE_PATH', 'employees.db')
+    # SQLite: один пишущий коннект + пул читающих, WAL
+    SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '3'))
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+    SQLITE_STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', '256'))
+    # Отложенная запись логов (QA, фидбек, регистрации): сброс раз в N мс или по M записей
+    WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', '200'))
+    WRITE_BEHIND_MAX_BATCH = int(os.getenv('WRITE_BEHIND_MAX_BATCH', '100'))
+    WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '10000'))
+    # Период фонового обновления дневных агрегатов аналитики
+    ROLLUP_INTERVAL_SEC = int(os.getenv('ROLLUP_INTERVAL_SEC', '60'))
+    # Хранение логов: строки старше RETENTION_DAYS уходят в архив (0 — хранить всё)
+    RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '180'))
+    RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '1000'))
+    RETENTION_INTERVAL_SEC = int(os.getenv('RETENTION_INTERVAL_SEC', '86400'))
+    # Перевод старой БД в auto_vacuum=INCREMENTAL полным VACUUM: держит пишущую блокировку
+    # на всё время и требует свободного места ~2× размера БД, поэтому только по явному согласию
+    SQLITE_VACUUM_CONVERT = os.getenv('SQLITE_VACUUM_CONVERT', 'false').lower() == 'true'
+    # Кластеризация неотвеченных вопросов (косинус эмбеддингов)
+    UNANSWERED_CLUSTER_THRESHOLD = float(os.getenv('UNANSWERED_CLUSTER_THRESHOLD', '0.8'))
+    UNANSWERED_CLUSTER_BATCH = int(os.getenv('UNANSWERED_CLUSTER_BATCH', '64'))
+    UNANSWERED_CLUSTER_INTERVAL_SEC = int(os.getenv('UNANSWERED_CLUSTER_INTERVAL_SEC', '300'))
+    # MySQL
+    MYSQL_HOST = os.getenv('MYSQL_HOST', '')
+    MYSQL_PORT = int(os.getenv('MYSQL_PORT', '3306'))
+    MYSQL_DB = os.getenv('MYSQL_DB', '')
+    MYSQL_USER = os.getenv('MYSQL_USER', '')
+    MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD', '')
+    # MS SQL Server
+    MSSQL_DSN = os.getenv('MSSQL_DSN', '')  # предпочтительно DSN (настроенный в odbc.ini)
+    MSSQL_HOST = os.getenv('MSSQL_HOST', '')
+    MSSQL_PORT = int(os.getenv('MSSQL_PORT', '1433'))
+    MSSQL_DB = os.getenv('MSSQL_DB', '')
+    MSSQL_USER = os.getenv('MSSQL_USER', '')
+    MSSQL_PASSWORD = os.getenv('MSSQL_PASSWORD', '')
+    # Пулы соединений к MSSQL/MySQL (общие на процесс)
+    DB_POOL_MINSIZE = int(os.getenv('DB_POOL_MINSIZE', '1'))
+    DB_POOL_MAXSIZE = int(os.getenv('DB_POOL_MAXSIZE', '5'))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '3600'))  # сек, пересоздание долгоживущих соединений
+    DB_POOL_HEALTHCHECK_SEC = int(os.getenv('DB_POOL_HEALTHCHECK_SEC', '60'))  # проверка пула после простоя
+
+    # Logging
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+    # Redis
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+    # 1C Export (Variant A): path to CSV/JSON export file
+    ONEC_EXPORT_PATH = os.getenv('ONEC_EXPORT_PATH', '')
+    # Порог похожести ФИО при проверке по кэшу сотрудников (1.0 — только точное совпадение)
+    NAME_MATCH_THRESHOLD = float(os.getenv('NAME_MATCH_THRESHOLD', '0.9'))
+    # Сколько секунд помнить отказ внешней БД для пары ФИО/табельный
+    VERIFY_NEGATIVE_TTL = int(os.getenv('VERIFY_NEGATIVE_TTL', '600'))
+    # Состояние пользователей в памяти: время жизни диалога, предел записей на хранилище, период очистки
+    STATE_TTL_SEC = int(os.getenv('STATE_TTL_SEC', '3600'))
+    STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', '10000'))
+    STATE_SWEEP_INTERVAL_SEC = int(os.getenv('STATE_SWEEP_INTERVAL_SEC', '300'))
+    # Где хранить сессии пользователей: memory | sqlite | redis (для нескольких реплик — sqlite/redis)
+    STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+    # Сколько секунд реплика доверяет локальной копии состояния без подтверждения из бэкенда
+    STATE_NEAR_CACHE_TTL_SEC = int(os.getenv('STATE_NEAR_CACHE_TTL_SEC', '30'))
+    STATE_REDIS_PREFIX = os.getenv('STATE_REDIS_PREFIX', 'tgbot')
+    # Частота правок прогресс-бара: не чаще раза в N секунд на чат и не более M правок в секунду всего
+    PROGRESS_EDIT_INTERVAL_SEC = float(os.getenv('PROGRESS_EDIT_INTERVAL_SEC', '1.0'))
+    PROGRESS_GLOBAL_EDITS_PER_SEC = float(os.getenv('PROGRESS_GLOBAL_EDITS_PER_SEC', '25'))
+    # Очередь вопросов: одновременных генераций (по мощности model_service), вопросов на пользователя, макс. ожидание
+    QUESTION_MAX_CONCURRENT = int(os.getenv('QUESTION_MAX_CONCURRENT', '2'))
+    QUESTION_PER_USER_LIMIT = int(os.getenv('QUESTION_PER_USER_LIMIT', '1'))
+    QUESTION_MAX_WAIT_SEC = int(os.getenv('QUESTION_MAX_WAIT_SEC', '180'))
+    # Профилирование: токен админ-эндпоинтов model_service (пусто — эндпоинты выключены), предел длительности
+    ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+    PROFILE_MAX_SEC = int(os.getenv('PROFILE_MAX_SEC', '120'))
+    # Постоянный сэмплинг стеков: профиль сохраняется для запросов дольше порога без учёта очереди
+    # (0 — выключено). Порог — выброс, а не обычный ответ: генерация на CPU сама идёт десятки секунд
+    SLOW_REQUEST_THRESHOLD_SEC = float(os.getenv('SLOW_REQUEST_THRESHOLD_SEC', '120'))
+    PROFILER_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILER_SAMPLE_INTERVAL_MS', '20'))
+    # Прогрев model_service при старте: пробные запросы к каждой модели до открытия эндпоинтов (вопросы через |)
+    MODEL_WARMUP = os.getenv('MODEL_WARMUP', 'true').lower() == 'true'
+    WARMUP_QUERIES = [q.strip() for q in os.getenv(
+        'WARMUP_QUERIES', 'Как оформить отпуск?|Где взять справку о доходах?|Кто согласует командировку?'
+    ).split('|') if q.strip()]
+    # Бюджет токенов контекста в промпте (0 — всё окно модели за вычетом ответа) и сколько чанков бот передаёт
+    CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1024'))
+    CONTEXT_MAX_CHUNKS = int(os.getenv('CONTEXT_MAX_CHUNKS', '5'))
+    # Журнал расхода токенов model_service (SQLite, общий для воркеров): сброс раз в N мс, период агрегатов
+    USAGE_DB_PATH = os.getenv('USAGE_DB_PATH', os.path.join(MODELS_DIR, 'usage.db'))
+    USAGE_FLUSH_MS = int(os.getenv('USAGE_FLUSH_MS', '1000'))
+    USAGE_ROLLUP_INTERVAL_SEC = int(os.getenv('USAGE_ROLLUP_INTERVAL_SEC', '60'))
+    # Месячные лимиты выходных токенов на пользователя и на отдел (0 — без лимита)
+    USER_MONTHLY_TOKEN_LIMIT = int(os.getenv('USER_MONTHLY_TOKEN_LIMIT', '0'))
+    DEPARTMENT_MONTHLY_TOKEN_LIMIT = int(os.getenv('DEPARTMENT_MONTHLY_TOKEN_LIMIT', '0'))
+
+    return {name: value for name, value in locals().items() if name.isupper()}
+
+
+def __getattr__(name: str) -> Any:
+    settings = _settings()
+    if name not in settings:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # Дальше настройки берутся из globals() модуля, минуя __getattr__
+    globals().update(settings)
+    return settings[name]
 
-# 1C Export (Variant A): path to CSV/JSON export file
-ONEC_EXPORT_PATH = os.getenv('ONEC_EXPORT_PATH', '')
 
-# Создаем необходимые директории
-for directory in [DOCS_DIR, LOGS_DIR, MODELS_DIR, BACKUPS_DIR]:
-    os.makedirs(directory, exist_ok=True) 
\ No newline at end of file
+def ensure_directories():
+    """Создаёт рабочие каталоги; вызывается процессами бота и сервиса при старте"""
+    for directory in [DOCS_DIR, LOGS_DIR, MODELS_DIR, BACKUPS_DIR]:
+        os.makedirs(directory, exist_ok=True)
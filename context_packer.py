@@ -0,0 +1,123 @@
+"""
+Сборка контекста для генерации в пределах бюджета токенов.
+
+Чанки приходят по убыванию ценности (скор поиска). Чанк, который помещается в остаток
+бюджета, берётся целиком; длинный — окном из соседних предложений вокруг предложения,
+лучше всего совпадающего с вопросом; то, что не влезло, попадает в dropped и уходит
+в трассу. Токены считает переданная функция (токенизатор модели); для чанков индекса
+число токенов известно заранее и передаётся в token_counts.
+"""
+
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+# Окно короче этого не берём: обрывок из пары слов только отнимает prompt eval
+MIN_WINDOW_TOKENS = 32
+SEPARATOR = '\n\n'
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…;])\s+|\n+')
+_WORD = re.compile(r'\w+')
+# Длина «основы» слова: грубое отсечение окончаний, чтобы «отпуск» совпало с «отпуска»
+_STEM = 5
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_END.split(text) if s and s.strip()]
+
+
+def _stems(text: str) -> Set[str]:
+    return {w[:_STEM] for w in _WORD.findall(text.lower()) if len(w) > 2}
+
+
+class PackedContext:
+    """Результат упаковки: части контекста (индекс чанка, текст, токены, токены исходного чанка)
+    и выброшенные чанки (индекс, токены)"""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.parts: List[Tuple[int, str, int, int]] = []
+        self.dropped: List[Tuple[int, int]] = []
+
+    @property
+    def text(self) -> str:
+        return SEPARATOR.join(text for _, text, _, _ in self.parts)
+
+    @property
+    def tokens(self) -> int:
+        return sum(tokens for _, _, tokens, _ in self.parts)
+
+    @property
+    def used(self) -> List[int]:
+        return [index for index, _, _, _ in self.parts]
+
+    @property
+    def trimmed(self) -> List[int]:
+        return [index for index, _, tokens, original in self.parts if tokens < original]
+
+    def summary(self, ids: Optional[Sequence] = None) -> Dict:
+        """Сводка для трассы; ids — внешние идентификаторы чанков (например, chunk_id индекса)"""
+        name = (lambda i: ids[i]) if ids is not None else (lambda i: i)
+        return {
+            'budget': self.budget,
+            'tokens': self.tokens,
+            'used': [name(i) for i in self.used],
+            'trimmed': [[name(i), tokens, original] for i, _, tokens, original in self.parts if tokens < original],
+            'dropped': [[name(i), tokens] for i, tokens in self.dropped],
+            'dropped_tokens': sum(tokens for _, tokens in self.dropped),
+        }
+
+
+def _window(query_stems: Set[str], text: str, budget: int,
+            count_tokens: Callable[[str], int]) -> Optional[Tuple[str, int]]:
+    """Самое совпадающее с вопросом предложение и соседи вокруг него в пределах budget"""
+    sentences = split_sentences(text)
+    if len(sentences) < 2:
+        return None
+    costs = [count_tokens(s) for s in sentences]
+    matches = [_stems(s) & query_stems for s in sentences]
+    # Редкое в чанке слово вопроса весит больше, чем встречающееся в каждом предложении
+    frequency = Counter(stem for m in matches for stem in m)
+    overlap = [sum(1 / frequency[stem] for stem in m) for m in matches]
+    # Без совпадений — начало чанка (заголовок и первые пункты)
+    best = max(range(len(sentences)), key=lambda i: (overlap[i], -i))
+    if costs[best] > budget:
+        return None
+    lo = hi = best
+    used = costs[best]
+    while True:
+        options = []
+        if lo > 0 and used + costs[lo - 1] <= budget:
+            options.append((overlap[lo - 1], 0, lo - 1))
+        if hi + 1 < len(sentences) and used + costs[hi + 1] <= budget:
+            # При равенстве берём следующее предложение: продолжение пункта обычно важнее
+            options.append((overlap[hi + 1], 1, hi + 1))
+        if not options:
+            break
+        _, _, i = max(options)
+        lo, hi = min(lo, i), max(hi, i)
+        used += costs[i]
+    return ' '.join(sentences[lo:hi + 1]), used
+
+
+def pack(query: str, texts: Sequence[str], budget: int, count_tokens: Callable[[str], int],
+         token_counts: Optional[Sequence[Optional[int]]] = None,
+         min_window_tokens: int = MIN_WINDOW_TOKENS) -> PackedContext:
+    """Упаковывает texts (по убыванию ценности) в budget токенов"""
+    result = PackedContext(budget)
+    query_stems = _stems(query)
+    remaining = budget
+    for i, text in enumerate(texts):
+        known = token_counts[i] if token_counts is not None else None
+        tokens = known if known is not None and known >= 0 else count_tokens(text)
+        if tokens <= remaining:
+            result.parts.append((i, text, tokens, tokens))
+            remaining -= tokens
+            continue
+        window = _window(query_stems, text, remaining, count_tokens) if remaining >= min_window_tokens else None
+        if window:
+            result.parts.append((i, window[0], window[1], tokens))
+            remaining -= window[1]
+        else:
+            result.dropped.append((i, tokens))
+    return result
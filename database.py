@@ -1,11 +1,32 @@
 import sqlite3
-import aiofiles
+import hashlib
+import gzip
+import json
+import re
 import aiosqlite
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from datetime import datetime
+from typing import List, Optional
 import logging
-from config import DATABASE_PATH, MYSQL_HOST, MYSQL_PORT, MYSQL_DB, MYSQL_USER, MYSQL_PASSWORD, MSSQL_DSN, MSSQL_HOST, MSSQL_PORT, MSSQL_DB, MSSQL_USER, MSSQL_PASSWORD
+from config import (DATABASE_PATH, MYSQL_HOST, MYSQL_PORT, MYSQL_DB, MYSQL_USER, MYSQL_PASSWORD, MSSQL_DSN, MSSQL_HOST, MSSQL_PORT,
+                    MSSQL_DB, MSSQL_USER, MSSQL_PASSWORD, DB_POOL_MINSIZE, DB_POOL_MAXSIZE, DB_POOL_RECYCLE, DB_POOL_HEALTHCHECK_SEC,
+                    SQLITE_READ_POOL_SIZE, SQLITE_BUSY_TIMEOUT_MS, SQLITE_STATEMENT_CACHE,
+                    WRITE_BEHIND_FLUSH_MS, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_MAX_PENDING, ROLLUP_INTERVAL_SEC,
+                    RETENTION_DAYS, RETENTION_BATCH_SIZE, RETENTION_INTERVAL_SEC, ARCHIVE_DIR, SQLITE_VACUUM_CONVERT)
 import os
 
+@lru_cache(maxsize=None)
+def _zstandard():
+    """zstandard для сжатия архивов логов (импорт при первой архивации); без него — gzip"""
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:  # pragma: no cover
+        return None
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -66,6 +87,390 @@ CREATE TABLE IF NOT EXISTS unanswered_questions (
 );
 """
 
+# ===== Миграции схемы =====
+# Версия схемы хранится в PRAGMA user_version; каждая миграция идемпотентна.
+
+_WS_RE = re.compile(r"\s+")
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+
+def question_hash(question: str) -> str:
+    """Хеш нормализованного текста вопроса для группировки в аналитике.
+
+    Нормализация: нижний регистр, Ё→Е, пунктуация (в том числе «?» в конце) и лишние пробелы убраны.
+    """
+    norm = _PUNCT_RE.sub(" ", (question or "").lower().replace('ё', 'е'))
+    norm = _WS_RE.sub(" ", norm).strip()
+    return hashlib.sha1(norm.encode('utf-8')).hexdigest()[:16]
+
+async def _table_columns(db, table: str) -> set:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+async def _migration_1_search_version(db):
+    """search_version и question_hash в qa_sessions + индексы для аналитики"""
+    columns = await _table_columns(db, 'qa_sessions')
+    if 'search_version' not in columns:
+        await db.execute("ALTER TABLE qa_sessions ADD COLUMN search_version TEXT")
+    if 'question_hash' not in columns:
+        await db.execute("ALTER TABLE qa_sessions ADD COLUMN question_hash TEXT")
+    # Версия поиска раньше кодировалась префиксом ответа «[v2] ...»
+    await db.execute(
+        """UPDATE qa_sessions SET search_version = CASE
+            WHEN answer LIKE '[v2]%' THEN 'v2'
+            WHEN answer LIKE '[error]%' THEN 'error'
+            ELSE 'v1' END
+        WHERE search_version IS NULL"""
+    )
+    while True:
+        async with db.execute(
+            "SELECT id, question FROM qa_sessions WHERE question_hash IS NULL LIMIT 1000"
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        await db.executemany(
+            "UPDATE qa_sessions SET question_hash = ? WHERE id = ?",
+            [(question_hash(row[1]), row[0]) for row in rows]
+        )
+    await db.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_qa_sessions_created_at ON qa_sessions (created_at);
+        CREATE INDEX IF NOT EXISTS idx_qa_sessions_version_created ON qa_sessions (search_version, created_at);
+        CREATE INDEX IF NOT EXISTS idx_qa_sessions_question_hash ON qa_sessions (question_hash);
+        CREATE INDEX IF NOT EXISTS idx_feedback_qa_session_id ON feedback (qa_session_id);
+    """)
+
+async def _migration_2_rollups(db):
+    """Дневные агрегаты для /analytics и /compare_search"""
+    await db.executescript("""
+        CREATE TABLE IF NOT EXISTS qa_daily_rollup (
+            day TEXT NOT NULL,
+            search_version TEXT NOT NULL,
+            questions INTEGER NOT NULL DEFAULT 0,
+            with_context INTEGER NOT NULL DEFAULT 0,
+            sum_response_ms INTEGER NOT NULL DEFAULT 0,
+            response_count INTEGER NOT NULL DEFAULT 0,
+            sum_confidence REAL NOT NULL DEFAULT 0,
+            confidence_count INTEGER NOT NULL DEFAULT 0,
+            likes INTEGER NOT NULL DEFAULT 0,
+            dislikes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, search_version)
+        );
+        CREATE TABLE IF NOT EXISTS question_daily_rollup (
+            day TEXT NOT NULL,
+            question_hash TEXT NOT NULL,
+            question TEXT NOT NULL,
+            questions INTEGER NOT NULL DEFAULT 0,
+            sum_confidence REAL NOT NULL DEFAULT 0,
+            confidence_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, question_hash)
+        );
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+    """)
+
+async def _migration_3_unanswered_clusters(db):
+    """Хеш нормализованного текста и кластеры для неотвеченных вопросов"""
+    columns = await _table_columns(db, 'unanswered_questions')
+    if 'question_hash' not in columns:
+        await db.execute("ALTER TABLE unanswered_questions ADD COLUMN question_hash TEXT")
+    if 'cluster_id' not in columns:
+        await db.execute("ALTER TABLE unanswered_questions ADD COLUMN cluster_id INTEGER")
+    async with db.execute("SELECT id, question FROM unanswered_questions WHERE question_hash IS NULL") as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany(
+        "UPDATE unanswered_questions SET question_hash = ? WHERE id = ?",
+        [(question_hash(row[1]), row[0]) for row in rows]
+    )
+    await db.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_unanswered_hash ON unanswered_questions (question_hash, resolved);
+        CREATE INDEX IF NOT EXISTS idx_unanswered_cluster ON unanswered_questions (cluster_id);
+        CREATE TABLE IF NOT EXISTS unanswered_clusters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            centroid BLOB NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            representative TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+async def _migration_4_bot_state(db):
+    """Таблица общего состояния бота (state_backend.SQLiteStateBackend)"""
+    await db.executescript("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_bot_state_expires ON bot_state (expires_at) WHERE expires_at IS NOT NULL;
+    """)
+
+async def _migration_5_stage_timings(db):
+    """Разбивка времени ответа по этапам (JSON, мс) в qa_sessions"""
+    if 'stage_timings' not in await _table_columns(db, 'qa_sessions'):
+        await db.execute("ALTER TABLE qa_sessions ADD COLUMN stage_timings TEXT")
+
+async def _migration_6_rehash_questions(db):
+    """Пересчёт question_hash без пунктуации, слияние повторов неотвеченных вопросов и пересчёт их кластеров"""
+    await db.create_function('question_hash_v2', 1, question_hash, deterministic=True)
+    await db.execute("UPDATE qa_sessions SET question_hash = question_hash_v2(question)")
+    # Новая нормализация грубее старой, поэтому хеш текста-представителя годится для всей группы
+    await db.executescript("""
+        CREATE TEMP TABLE question_daily_rehash AS
+            SELECT day, question_hash_v2(question) AS question_hash, MAX(question) AS question,
+                   SUM(questions) AS questions, SUM(sum_confidence) AS sum_confidence,
+                   SUM(confidence_count) AS confidence_count
+            FROM question_daily_rollup GROUP BY 1, 2;
+        DELETE FROM question_daily_rollup;
+        INSERT INTO question_daily_rollup (day, question_hash, question, questions, sum_confidence, confidence_count)
+            SELECT day, question_hash, question, questions, sum_confidence, confidence_count FROM question_daily_rehash;
+        DROP TABLE question_daily_rehash;
+    """)
+    await db.execute("UPDATE unanswered_questions SET question_hash = question_hash_v2(question)")
+    # Открытые вопросы с одинаковым хешем сливаются в самую раннюю строку с суммарной частотой
+    await db.executescript("""
+        CREATE TEMP TABLE unanswered_merge AS
+            SELECT question_hash, MIN(id) AS keep_id, SUM(frequency) AS frequency, MAX(last_asked) AS last_asked,
+                   MIN(cluster_id) AS cluster_id
+            FROM unanswered_questions WHERE resolved = FALSE
+            GROUP BY question_hash HAVING COUNT(*) > 1;
+        UPDATE unanswered_questions SET
+            frequency = (SELECT m.frequency FROM unanswered_merge m WHERE m.keep_id = unanswered_questions.id),
+            last_asked = (SELECT m.last_asked FROM unanswered_merge m WHERE m.keep_id = unanswered_questions.id),
+            cluster_id = COALESCE(cluster_id,
+                (SELECT m.cluster_id FROM unanswered_merge m WHERE m.keep_id = unanswered_questions.id))
+        WHERE id IN (SELECT keep_id FROM unanswered_merge);
+        DELETE FROM unanswered_questions
+        WHERE resolved = FALSE
+          AND question_hash IN (SELECT question_hash FROM unanswered_merge)
+          AND id NOT IN (SELECT keep_id FROM unanswered_merge);
+        DROP TABLE unanswered_merge;
+    """)
+    # Размер кластера — число привязанных к нему вопросов: пересчитываем после удаления повторов,
+    # опустевшие кластеры удаляем, представителя из удалённых строк заменяем самым ранним вопросом кластера
+    await db.executescript("""
+        UPDATE unanswered_clusters SET
+            size = (SELECT COUNT(*) FROM unanswered_questions q WHERE q.cluster_id = unanswered_clusters.id),
+            updated_at = CURRENT_TIMESTAMP;
+        DELETE FROM unanswered_clusters WHERE size = 0;
+        UPDATE unanswered_clusters SET representative = (
+            SELECT q.question FROM unanswered_questions q WHERE q.cluster_id = unanswered_clusters.id ORDER BY q.id LIMIT 1
+        )
+        WHERE NOT EXISTS (
+            SELECT 1 FROM unanswered_questions q
+            WHERE q.cluster_id = unanswered_clusters.id AND q.question = unanswered_clusters.representative
+        );
+    """)
+
+MIGRATIONS = [
+    _migration_1_search_version,
+    _migration_2_rollups,
+    _migration_3_unanswered_clusters,
+    _migration_4_bot_state,
+    _migration_5_stage_timings,
+    _migration_6_rehash_questions,
+]
+
+async def _apply_migrations(db):
+    async with db.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Миграция схемы {number}: {migration.__doc__}")
+        await migration(db)
+        await db.execute(f"PRAGMA user_version = {number}")
+        await db.commit()
+
+# ===== Локальная SQLite: постоянные соединения =====
+# Один пишущий коннект (записи сериализуются блокировкой) и небольшой пул читающих.
+# WAL позволяет читателям не ждать писателя, synchronous=NORMAL убирает fsync на каждый коммит.
+
+_WRITER: Optional[aiosqlite.Connection] = None
+_READERS: Optional[asyncio.Queue] = None
+_READER_CONNECTIONS: List[aiosqlite.Connection] = []
+_WRITE_LOCK = asyncio.Lock()
+_OPEN_LOCK = asyncio.Lock()
+
+async def _open_connection(readonly: bool = False) -> aiosqlite.Connection:
+    # cached_statements — кэш подготовленных выражений sqlite3 на соединение
+    db = await aiosqlite.connect(DB_PATH, cached_statements=SQLITE_STATEMENT_CACHE)
+    await db.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT_MS)}")
+    if not readonly:
+        # Действует только для новой БД (до первой таблицы); старые переводит run_retention
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("PRAGMA journal_mode = WAL")
+    await db.execute("PRAGMA synchronous = NORMAL")
+    if readonly:
+        await db.execute("PRAGMA query_only = 1")
+    db.row_factory = aiosqlite.Row
+    return db
+
+async def _ensure_open():
+    global _WRITER, _READERS
+    if _WRITER is not None:
+        return
+    async with _OPEN_LOCK:
+        if _WRITER is not None:
+            return
+        writer = await _open_connection()
+        readers: asyncio.Queue = asyncio.Queue()
+        for _ in range(max(1, SQLITE_READ_POOL_SIZE)):
+            conn = await _open_connection(readonly=True)
+            _READER_CONNECTIONS.append(conn)
+            readers.put_nowait(conn)
+        _WRITER, _READERS = writer, readers
+
+@asynccontextmanager
+async def _write():
+    """Пишущее соединение; коммит при выходе, откат при исключении."""
+    await _ensure_open()
+    async with _WRITE_LOCK:
+        try:
+            yield _WRITER
+            await _WRITER.commit()
+        except BaseException:
+            await _WRITER.rollback()
+            raise
+
+@asynccontextmanager
+async def _read():
+    """Читающее соединение из пула."""
+    await _ensure_open()
+    db = await _READERS.get()
+    try:
+        yield db
+    finally:
+        _READERS.put_nowait(db)
+
+async def close_db():
+    """Дописывает очередь и закрывает соединения с SQLite (вызывается при остановке бота)."""
+    global _WRITER, _READERS
+    await write_behind.stop()
+    async with _OPEN_LOCK:
+        for conn in _READER_CONNECTIONS:
+            await conn.close()
+        _READER_CONNECTIONS.clear()
+        if _WRITER is not None:
+            await _WRITER.close()
+        _WRITER, _READERS = None, None
+
+# ===== Очередь отложенной записи (write-behind) =====
+
+class WriteBehindQueue:
+    """Буферизует записи логов и сбрасывает их одной транзакцией.
+
+    Сброс — каждые flush_interval секунд или при накоплении max_batch записей.
+    Записи, результат которых нужен вызывающему (ID сессии для кнопок фидбека), ставятся
+    через submit: он будит сброс и возвращает future, который разрешится после коммита.
+    ID выдаёт сама БД внутри пишущей транзакции, поэтому несколько процессов могут
+    писать в один файл.
+    """
+
+    def __init__(self, flush_interval: float, max_batch: int, max_pending: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._items: List[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def _enqueue(self, op, args, future: Optional[asyncio.Future]):
+        self.start()
+        self._items.append((op, args, future))
+        if len(self._items) >= self.max_pending:
+            await self.flush()
+        elif future is not None or len(self._items) >= self.max_batch:
+            self._wakeup.set()
+
+    async def put(self, op, *args):
+        """Ставит в очередь op(db, *args); при переполнении буфера сбрасывает его сразу."""
+        await self._enqueue(op, args, None)
+
+    async def submit(self, op, *args) -> asyncio.Future:
+        """Ставит op(db, *args) в ближайший сброс; future получит его результат после коммита.
+
+        Коммита не ждёт: запись уходит одной транзакцией вместе с накопленными (group commit).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._enqueue(op, args, future)
+        return future
+
+    @staticmethod
+    def _resolve(future: Optional[asyncio.Future], result=None, error: Optional[BaseException] = None):
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._items:
+                batch, self._items = self._items[:self.max_batch], self._items[self.max_batch:]
+                # Ещё не закоммиченная часть пакета
+                pending = batch
+                try:
+                    try:
+                        results = []
+                        async with _write() as db:
+                            for op, args, _ in batch:
+                                results.append(await op(db, *args))
+                        # Результаты отдаём только после коммита
+                        for (_, _, future), result in zip(batch, results):
+                            self._resolve(future, result)
+                    except Exception as e:
+                        # Транзакция откатилась — пишем по одной, чтобы потерять только битые записи
+                        logger.error(f"Ошибка пакетной записи ({len(batch)} записей): {e}")
+                        for n, (op, args, future) in enumerate(batch):
+                            pending = batch[n:]
+                            try:
+                                async with _write() as db:
+                                    result = await op(db, *args)
+                                self._resolve(future, result)
+                            except Exception as item_error:
+                                logger.error(f"Запись {op.__name__} потеряна: {item_error}")
+                                self._resolve(future, error=item_error)
+                except asyncio.CancelledError:
+                    # Транзакция откатилась — возвращаем незаписанное в начало очереди
+                    self._items[:0] = pending
+                    raise
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса очереди записи: {e}")
+
+    async def stop(self):
+        """Останавливает фоновый сброс и дописывает всё накопленное.
+
+        Фоновую задачу не отменяем: она досбрасывает текущий пакет и выходит сама.
+        """
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+write_behind = WriteBehindQueue(WRITE_BEHIND_FLUSH_MS / 1000.0, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_MAX_PENDING)
+
 # Тестовые данные
 TEST_DATA = [
     ("Иванов Иван Иванович", "E001", "IT отдел", "Программист"),
@@ -78,9 +483,9 @@ TEST_DATA = [
 async def init_db():
     """Инициализация базы данных"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _write() as db:
             await db.executescript(INIT_SQL)
-            await db.commit()
+            await _apply_migrations(db)
             
         logger.info("База данных успешно инициализирована")
         return True
@@ -91,7 +496,7 @@ async def init_db():
 async def populate_test_data():
     """Заполнение тестовыми данными"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _write() as db:
             # Проверяем, есть ли уже данные
             async with db.execute("SELECT COUNT(*) FROM employees") as cursor:
                 count = await cursor.fetchone()
@@ -104,7 +509,6 @@ async def populate_test_data():
                 "INSERT INTO employees (full_name, employee_id, department, position) VALUES (?, ?, ?, ?)",
                 TEST_DATA
             )
-            await db.commit()
             
         logger.info("Тестовые данные успешно добавлены")
         return True
@@ -117,25 +521,27 @@ async def populate_test_data():
 def _mssql_enabled() -> bool:
     return bool(MSSQL_DSN or (MSSQL_HOST and MSSQL_DB and MSSQL_USER))
 
-async def _mssql_get_pool():
+async def _mssql_create_pool():
     import aioodbc
     if MSSQL_DSN:
-        return await aioodbc.create_pool(dsn=MSSQL_DSN, autocommit=True, minsize=1, maxsize=5)
-    conn_str = (
-        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-        f"SERVER={MSSQL_HOST},{MSSQL_PORT};"
-        f"DATABASE={MSSQL_DB};"
-        f"UID={MSSQL_USER};PWD={MSSQL_PASSWORD};"
-        f"TrustServerCertificate=Yes;"
-    )
-    return await aioodbc.create_pool(dsn=conn_str, autocommit=True, minsize=1, maxsize=5)
+        dsn = MSSQL_DSN
+    else:
+        dsn = (
+            f"DRIVER={{ODBC Driver 18 for SQL Server}};"
+            f"SERVER={MSSQL_HOST},{MSSQL_PORT};"
+            f"DATABASE={MSSQL_DB};"
+            f"UID={MSSQL_USER};PWD={MSSQL_PASSWORD};"
+            f"TrustServerCertificate=Yes;"
+        )
+    return await aioodbc.create_pool(dsn=dsn, autocommit=True, minsize=DB_POOL_MINSIZE, maxsize=DB_POOL_MAXSIZE,
+                                     pool_recycle=DB_POOL_RECYCLE)
 
 # ===== MySQL helpers =====
 
 def _mysql_enabled() -> bool:
     return all([MYSQL_HOST, MYSQL_DB, MYSQL_USER]) and not _mssql_enabled()
 
-async def _mysql_get_pool():
+async def _mysql_create_pool():
     import aiomysql
     return await aiomysql.create_pool(
         host=MYSQL_HOST,
@@ -144,28 +550,123 @@ async def _mysql_get_pool():
         user=MYSQL_USER,
         password=MYSQL_PASSWORD,
         autocommit=True,
-        minsize=1,
-        maxsize=5,
+        minsize=DB_POOL_MINSIZE,
+        maxsize=DB_POOL_MAXSIZE,
+        pool_recycle=DB_POOL_RECYCLE,
         charset='utf8mb4'
     )
 
+# ===== Общие пулы внешних БД =====
+# Пулы создаются лениво один раз на процесс и переиспользуются всеми вызовами;
+# закрываются через close_db_pools() при остановке бота.
+
+_POOL_FACTORIES = {'mssql': _mssql_create_pool, 'mysql': _mysql_create_pool}
+_POOLS: dict = {}
+_POOL_LAST_OK: dict = {}
+_POOL_LOCK = asyncio.Lock()
+
+async def _close_pool(pool):
+    # aioodbc в части версий объявляет close() корутиной, aiomysql — обычным методом
+    closing = pool.close()
+    if asyncio.iscoroutine(closing):
+        await closing
+    await pool.wait_closed()
+
+async def _ping_pool(pool) -> bool:
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT 1")
+                await cur.fetchone()
+        return True
+    except Exception as e:
+        logger.warning(f"Проверка пула не прошла: {e}")
+        return False
+
+async def _drop_pool(kind: str, pool=None):
+    """Закрывает пул kind (вызывать под _POOL_LOCK). С pool — только если это всё ещё он:
+    запоздавшая ошибка не должна закрыть пул, который уже пересоздала другая корутина."""
+    current = _POOLS.get(kind)
+    if current is None or (pool is not None and current is not pool):
+        return
+    _POOLS.pop(kind, None)
+    _POOL_LAST_OK.pop(kind, None)
+    try:
+        await _close_pool(current)
+    except Exception as e:
+        logger.warning(f"Ошибка закрытия пула {kind}: {e}")
+
+async def _invalidate_pool(kind: str, pool=None):
+    async with _POOL_LOCK:
+        await _drop_pool(kind, pool)
+
+@lru_cache(maxsize=None)
+def _connection_errors(kind: str) -> tuple:
+    """Ошибки обрыва соединения, после которых пул пересоздаётся; ошибки SQL и данных сюда не входят"""
+    errors = [OSError, asyncio.TimeoutError]
+    try:
+        if kind == 'mssql':
+            import pyodbc
+            errors += [pyodbc.OperationalError, pyodbc.InterfaceError]
+        else:
+            import pymysql
+            errors += [pymysql.err.OperationalError, pymysql.err.InterfaceError]
+    except ImportError:  # pragma: no cover
+        pass
+    return tuple(errors)
+
+async def _get_pool(kind: str):
+    """Возвращает живой пул; после простоя дольше DB_POOL_HEALTHCHECK_SEC проверяет его SELECT 1."""
+    async with _POOL_LOCK:
+        pool = _POOLS.get(kind)
+        if pool is not None and time.monotonic() - _POOL_LAST_OK.get(kind, 0) > DB_POOL_HEALTHCHECK_SEC:
+            if not await _ping_pool(pool):
+                await _drop_pool(kind, pool)
+                pool = None
+        if pool is None:
+            pool = await _POOL_FACTORIES[kind]()
+            _POOLS[kind] = pool
+            logger.info(f"Создан пул соединений {kind} (min={DB_POOL_MINSIZE}, max={DB_POOL_MAXSIZE})")
+        _POOL_LAST_OK[kind] = time.monotonic()
+        return pool
+
+async def _with_pool(kind: str, run):
+    """Выполняет run(pool); при обрыве соединения пересоздаёт пул и повторяет один раз.
+
+    Прочие ошибки (SQL, данные) пробрасываются как есть: пул из-за них не закрывается.
+    """
+    pool = await _get_pool(kind)
+    try:
+        result = await run(pool)
+    except _connection_errors(kind) as e:
+        logger.warning(f"{kind}: обрыв соединения ({e}), переподключение")
+        await _invalidate_pool(kind, pool)
+        result = await run(await _get_pool(kind))
+    _POOL_LAST_OK[kind] = time.monotonic()
+    return result
+
+async def close_db_pools():
+    """Закрывает пулы внешних БД (вызывается при остановке бота)."""
+    for kind in list(_POOLS):
+        await _invalidate_pool(kind)
+
 async def verify_employee(full_name: str, employee_id: str) -> dict:
     """Проверка сотрудника: MSSQL -> MySQL -> SQLite."""
     # MSSQL
     if _mssql_enabled():
         try:
-            pool = await _mssql_get_pool()
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        SELECT department, position FROM employees
-                        WHERE full_name = ? AND employee_id = ?
-                        """,
-                        (full_name, employee_id)
-                    )
-                    row = await cur.fetchone()
-            await pool.close()
+            async def run(pool):
+                async with pool.acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(
+                            """
+                            SELECT department, position FROM employees
+                            WHERE full_name = ? AND employee_id = ?
+                            """,
+                            (full_name, employee_id)
+                        )
+                        return await cur.fetchone()
+            row = await _with_pool('mssql', run)
             if row:
                 department, position = row
                 return {
@@ -182,20 +683,19 @@ async def verify_employee(full_name: str, employee_id: str) -> dict:
     # MySQL
     if _mysql_enabled():
         try:
-            pool = await _mysql_get_pool()
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        SELECT department, position FROM employees
-                        WHERE full_name = %s AND employee_id = %s
-                        LIMIT 1
-                        """,
-                        (full_name, employee_id)
-                    )
-                    row = await cur.fetchone()
-            pool.close()
-            await pool.wait_closed()
+            async def run(pool):
+                async with pool.acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(
+                            """
+                            SELECT department, position FROM employees
+                            WHERE full_name = %s AND employee_id = %s
+                            LIMIT 1
+                            """,
+                            (full_name, employee_id)
+                        )
+                        return await cur.fetchone()
+            row = await _with_pool('mysql', run)
             if row:
                 department, position = row
                 return {
@@ -211,8 +711,7 @@ async def verify_employee(full_name: str, employee_id: str) -> dict:
 
     # SQLite fallback
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _read() as db:
             async with db.execute(
                 """SELECT * FROM employees 
                 WHERE full_name = ? AND employee_id = ?""",
@@ -231,17 +730,18 @@ async def verify_employee(full_name: str, employee_id: str) -> dict:
         logger.error(f"SQLite verify_employee error: {e}")
         return {"verified": False, "error": str(e)}
 
+async def _insert_registration_attempt(db, telegram_id: int, full_name: str, employee_id: str, success: bool):
+    await db.execute(
+        """INSERT INTO registration_attempts 
+        (telegram_id, full_name, employee_id, success) 
+        VALUES (?, ?, ?, ?)""",
+        (telegram_id, full_name, employee_id, success)
+    )
+
 async def log_registration_attempt(telegram_id: int, full_name: str, employee_id: str, success: bool):
-    """Логирование попытки регистрации (SQLite)."""
+    """Логирование попытки регистрации (SQLite, через очередь отложенной записи)."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                """INSERT INTO registration_attempts 
-                (telegram_id, full_name, employee_id, success) 
-                VALUES (?, ?, ?, ?)""",
-                (telegram_id, full_name, employee_id, success)
-            )
-            await db.commit()
+        await write_behind.put(_insert_registration_attempt, telegram_id, full_name, employee_id, success)
         return True
     except Exception as e:
         logger.error(f"Ошибка при логировании попытки регистрации: {e}")
@@ -250,8 +750,7 @@ async def log_registration_attempt(telegram_id: int, full_name: str, employee_id
 async def get_registration_attempts(telegram_id: int) -> list:
     """Получение истории попыток регистрации (SQLite)."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _read() as db:
             async with db.execute(
                 """SELECT * FROM registration_attempts 
                 WHERE telegram_id = ? 
@@ -266,8 +765,7 @@ async def get_registration_attempts(telegram_id: int) -> list:
 async def get_last_successful_registration(telegram_id: int) -> dict:
     """Возвращает последнюю успешную регистрацию пользователя (или пустой словарь)."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _read() as db:
             async with db.execute(
                 """SELECT full_name, employee_id FROM registration_attempts
                 WHERE telegram_id = ? AND success = 1
@@ -286,12 +784,12 @@ async def get_all_employees() -> list:
     # MSSQL
     if _mssql_enabled():
         try:
-            pool = await _mssql_get_pool()
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute("SELECT employee_id, full_name, department, position FROM employees")
-                    rows = await cur.fetchall()
-            await pool.close()
+            async def run(pool):
+                async with pool.acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute("SELECT employee_id, full_name, department, position FROM employees")
+                        return await cur.fetchall()
+            rows = await _with_pool('mssql', run)
             return [
                 {
                     "employee_id": r[0],
@@ -309,13 +807,12 @@ async def get_all_employees() -> list:
     if _mysql_enabled():
         try:
             import aiomysql
-            pool = await _mysql_get_pool()
-            async with pool.acquire() as conn:
-                async with conn.cursor(aiomysql.DictCursor) as cur:  # type: ignore
-                    await cur.execute("SELECT employee_id, full_name, department, position FROM employees")
-                    rows = await cur.fetchall()
-            pool.close()
-            await pool.wait_closed()
+            async def run(pool):
+                async with pool.acquire() as conn:
+                    async with conn.cursor(aiomysql.DictCursor) as cur:  # type: ignore
+                        await cur.execute("SELECT employee_id, full_name, department, position FROM employees")
+                        return await cur.fetchall()
+            rows = await _with_pool('mysql', run)
             return rows or []
         except Exception as e:
             logger.error(f"MySQL get_all_employees error: {e}")
@@ -323,8 +820,7 @@ async def get_all_employees() -> list:
 
     # SQLite fallback
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _read() as db:
             async with db.execute("SELECT * FROM employees") as cursor:
                 employees = await cursor.fetchall()
                 return [dict(emp) for emp in employees]
@@ -334,83 +830,429 @@ async def get_all_employees() -> list:
 
 # ========== АНАЛИТИКА И МЕТРИКИ ==========
 
+async def _insert_qa_session(db, telegram_id: int, user_name: str, employee_id: str, question: str,
+                             answer: str, response_time_ms: int, confidence_score: Optional[float], context_found: bool,
+                             search_version: Optional[str], stage_timings: Optional[str]) -> int:
+    cursor = await db.execute(
+        """INSERT INTO qa_sessions 
+        (telegram_id, user_name, employee_id, question, answer, response_time_ms, confidence_score, context_found,
+         search_version, question_hash, stage_timings)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (telegram_id, user_name, employee_id, question, answer, response_time_ms, confidence_score, context_found,
+         search_version, question_hash(question), stage_timings)
+    )
+    return cursor.lastrowid
+
 async def log_qa_session(telegram_id: int, user_name: str, employee_id: str, 
                         question: str, answer: str, response_time_ms: int, 
-                        confidence_score: float = None, context_found: bool = False) -> int:
-    """Логирование сессии Q&A. Возвращает ID сессии."""
+                        confidence_score: float = None, context_found: bool = False,
+                        search_version: str = None, stage_timings: Optional[dict] = None) -> Optional[asyncio.Future]:
+    """Логирование сессии Q&A без ожидания записи. Возвращает future с ID сессии, который
+    разрешится после коммита ближайшего сброса очереди (None — запись не поставлена).
+
+    stage_timings — время этапов в мс ({"queue_wait": ..., "search": ..., "generate": ...}).
+    """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                """INSERT INTO qa_sessions 
-                (telegram_id, user_name, employee_id, question, answer, response_time_ms, confidence_score, context_found)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                (telegram_id, user_name, employee_id, question, answer, response_time_ms, confidence_score, context_found)
-            )
-            await db.commit()
-            return cursor.lastrowid
+        if search_version is None:
+            search_version = 'v2' if (answer or '').startswith('[v2]') else 'v1'
+        timings = json.dumps(stage_timings, separators=(',', ':')) if stage_timings else None
+        return await write_behind.submit(_insert_qa_session, telegram_id, user_name, employee_id, question,
+                                         answer, response_time_ms, confidence_score, context_found, search_version,
+                                         timings)
     except Exception as e:
         logger.error(f"Ошибка при логировании QA сессии: {e}")
-        return 0
+        return None
+
+async def _insert_feedback(db, qa_session_id: int, telegram_id: int, rating: int, comment: Optional[str]):
+    await db.execute(
+        """INSERT INTO feedback (qa_session_id, telegram_id, rating, comment)
+        VALUES (?, ?, ?, ?)""",
+        (qa_session_id, telegram_id, rating, comment)
+    )
 
 async def save_feedback(qa_session_id: int, telegram_id: int, rating: int, comment: str = None) -> bool:
     """Сохранение фидбека пользователя (1 = лайк, -1 = дизлайк)."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                """INSERT INTO feedback (qa_session_id, telegram_id, rating, comment)
-                VALUES (?, ?, ?, ?)""",
-                (qa_session_id, telegram_id, rating, comment)
-            )
-            await db.commit()
+        await write_behind.put(_insert_feedback, qa_session_id, telegram_id, rating, comment)
         return True
     except Exception as e:
         logger.error(f"Ошибка при сохранении фидбека: {e}")
         return False
 
+async def _upsert_unanswered_question(db, telegram_id: int, question: str, user_context: str):
+    # Повтор (с точностью до регистра, пунктуации, пробелов и Ё/Е) увеличивает частоту — поиск по индексу хеша.
+    # Обновляется одна строка, даже если открытых с этим хешем несколько
+    q_hash = question_hash(question)
+    cursor = await db.execute(
+        "UPDATE unanswered_questions SET frequency = frequency + 1, last_asked = CURRENT_TIMESTAMP "
+        "WHERE id = (SELECT MIN(id) FROM unanswered_questions WHERE question_hash = ? AND resolved = FALSE)",
+        (q_hash,)
+    )
+    if cursor.rowcount == 0:
+        # Добавляем новый; кластер назначит фоновая задача
+        await db.execute(
+            "INSERT INTO unanswered_questions (telegram_id, question, user_context, question_hash) VALUES (?, ?, ?, ?)",
+            (telegram_id, question, user_context, q_hash)
+        )
+
 async def log_unanswered_question(telegram_id: int, question: str, user_context: str = "") -> bool:
     """Логирование неотвеченного вопроса с увеличением частоты при повторе."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Проверяем, есть ли уже такой вопрос
+        await write_behind.put(_upsert_unanswered_question, telegram_id, question, user_context)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при логировании неотвеченного вопроса: {e}")
+        return False
+
+async def get_unclustered_questions(limit: int = 64) -> list:
+    """Неотвеченные вопросы без кластера: [(id, question)]."""
+    try:
+        async with _read() as db:
             async with db.execute(
-                "SELECT id, frequency FROM unanswered_questions WHERE question = ? AND resolved = FALSE",
-                (question,)
+                "SELECT id, question FROM unanswered_questions "
+                "WHERE cluster_id IS NULL AND resolved = FALSE ORDER BY id LIMIT ?",
+                (limit,)
             ) as cursor:
-                existing = await cursor.fetchone()
-            
-            if existing:
-                # Увеличиваем частоту
-                await db.execute(
-                    "UPDATE unanswered_questions SET frequency = frequency + 1, last_asked = CURRENT_TIMESTAMP WHERE id = ?",
-                    (existing[0],)
-                )
-            else:
-                # Добавляем новый
+                return [(row[0], row[1]) for row in await cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка при получении вопросов для кластеризации: {e}")
+        return []
+
+async def get_unanswered_clusters() -> list:
+    """Все кластеры неотвеченных вопросов: [(id, centroid, size, representative)]."""
+    try:
+        async with _read() as db:
+            async with db.execute("SELECT id, centroid, size, representative FROM unanswered_clusters") as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка при получении кластеров вопросов: {e}")
+        return []
+
+async def save_unanswered_clusters(clusters: list, assignments: dict) -> bool:
+    """Сохраняет изменённые кластеры (id=None — новый) и привязку вопросов {id вопроса: кластер}."""
+    try:
+        async with _write() as db:
+            for cluster in clusters:
+                if not cluster.dirty:
+                    continue
+                centroid = cluster.centroid.tobytes()
+                if cluster.id is None:
+                    cursor = await db.execute(
+                        "INSERT INTO unanswered_clusters (centroid, size, representative) VALUES (?, ?, ?)",
+                        (centroid, cluster.size, cluster.representative)
+                    )
+                    cluster.id = cursor.lastrowid
+                else:
+                    await db.execute(
+                        "UPDATE unanswered_clusters SET centroid = ?, size = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                        (centroid, cluster.size, cluster.id)
+                    )
+                cluster.dirty = False
+            await db.executemany(
+                "UPDATE unanswered_questions SET cluster_id = ? WHERE id = ?",
+                [(cluster.id, question_id) for question_id, cluster in assignments.items()]
+            )
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении кластеров вопросов: {e}")
+        return False
+
+# ========== СОСТОЯНИЕ БОТА (bot_state) ==========
+
+async def state_get(namespace: str, key: str) -> Optional[str]:
+    async with _read() as db:
+        async with db.execute(
+            "SELECT value FROM bot_state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time())
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def state_set(namespace: str, key: str, value: str, expires_at: Optional[float] = None):
+    async with _write() as db:
+        await db.execute(
+            "INSERT INTO bot_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (namespace, key, value, expires_at)
+        )
+
+async def state_delete(namespace: str, key: str):
+    async with _write() as db:
+        await db.execute("DELETE FROM bot_state WHERE namespace = ? AND key = ?", (namespace, key))
+
+async def state_purge_expired() -> int:
+    async with _write() as db:
+        cursor = await db.execute(
+            "DELETE FROM bot_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+# ========== ДНЕВНЫЕ АГРЕГАТЫ (ROLLUPS) ==========
+# Новые строки qa_sessions/feedback добавляются к агрегатам инкрементально по водяной
+# отметке (последний учтённый id), отчёты читают только агрегаты.
+
+async def _rollup_watermark(db, name: str) -> int:
+    async with db.execute("SELECT last_id FROM rollup_state WHERE name = ?", (name,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+async def _set_rollup_watermark(db, name: str, last_id: int):
+    await db.execute(
+        "INSERT INTO rollup_state (name, last_id) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id",
+        (name, last_id)
+    )
+
+async def _rollup_qa_sessions(db, batch: int) -> int:
+    last_id = await _rollup_watermark(db, 'qa_sessions')
+    async with db.execute(
+        "SELECT MAX(id) FROM (SELECT id FROM qa_sessions WHERE id > ? ORDER BY id LIMIT ?)", (last_id, batch)
+    ) as cursor:
+        upper = (await cursor.fetchone())[0]
+    if upper is None:
+        return 0
+    await db.execute(
+        """INSERT INTO qa_daily_rollup
+            (day, search_version, questions, with_context, sum_response_ms, response_count, sum_confidence, confidence_count)
+        SELECT date(created_at), COALESCE(search_version, 'v1'), COUNT(*),
+               SUM(CASE WHEN context_found = 1 THEN 1 ELSE 0 END),
+               COALESCE(SUM(response_time_ms), 0), COUNT(response_time_ms),
+               COALESCE(SUM(confidence_score), 0), COUNT(confidence_score)
+        FROM qa_sessions WHERE id > ? AND id <= ?
+        GROUP BY date(created_at), COALESCE(search_version, 'v1')
+        ON CONFLICT(day, search_version) DO UPDATE SET
+            questions = questions + excluded.questions,
+            with_context = with_context + excluded.with_context,
+            sum_response_ms = sum_response_ms + excluded.sum_response_ms,
+            response_count = response_count + excluded.response_count,
+            sum_confidence = sum_confidence + excluded.sum_confidence,
+            confidence_count = confidence_count + excluded.confidence_count""",
+        (last_id, upper)
+    )
+    await db.execute(
+        """INSERT INTO question_daily_rollup (day, question_hash, question, questions, sum_confidence, confidence_count)
+        SELECT date(created_at), question_hash, MAX(question), COUNT(*),
+               COALESCE(SUM(confidence_score), 0), COUNT(confidence_score)
+        FROM qa_sessions WHERE id > ? AND id <= ? AND question_hash IS NOT NULL
+        GROUP BY date(created_at), question_hash
+        ON CONFLICT(day, question_hash) DO UPDATE SET
+            questions = questions + excluded.questions,
+            sum_confidence = sum_confidence + excluded.sum_confidence,
+            confidence_count = confidence_count + excluded.confidence_count""",
+        (last_id, upper)
+    )
+    await _set_rollup_watermark(db, 'qa_sessions', upper)
+    return upper - last_id
+
+async def _rollup_feedback(db, batch: int) -> int:
+    last_id = await _rollup_watermark(db, 'feedback')
+    async with db.execute(
+        "SELECT MAX(id) FROM (SELECT id FROM feedback WHERE id > ? ORDER BY id LIMIT ?)", (last_id, batch)
+    ) as cursor:
+        upper = (await cursor.fetchone())[0]
+    if upper is None:
+        return 0
+    # Оценка относится ко дню и версии исходной сессии, как в прежних отчётах
+    await db.execute(
+        """INSERT INTO qa_daily_rollup (day, search_version, likes, dislikes)
+        SELECT date(qa.created_at), COALESCE(qa.search_version, 'v1'),
+               SUM(CASE WHEN f.rating = 1 THEN 1 ELSE 0 END),
+               SUM(CASE WHEN f.rating = -1 THEN 1 ELSE 0 END)
+        FROM feedback f JOIN qa_sessions qa ON f.qa_session_id = qa.id
+        WHERE f.id > ? AND f.id <= ?
+        GROUP BY date(qa.created_at), COALESCE(qa.search_version, 'v1')
+        ON CONFLICT(day, search_version) DO UPDATE SET
+            likes = likes + excluded.likes,
+            dislikes = dislikes + excluded.dislikes""",
+        (last_id, upper)
+    )
+    await _set_rollup_watermark(db, 'feedback', upper)
+    return upper - last_id
+
+async def refresh_rollups(batch: int = 50000) -> int:
+    """Добавляет к агрегатам строки, появившиеся после прошлого обновления. Возвращает их число."""
+    total = 0
+    try:
+        while True:
+            async with _write() as db:
+                processed = await _rollup_qa_sessions(db, batch)
+                processed += await _rollup_feedback(db, batch)
+            total += processed
+            if processed == 0:
+                return total
+            # Большой хвост (первый запуск после миграции) — отдаём управление между пакетами
+            await asyncio.sleep(0)
+    except Exception as e:
+        logger.error(f"Ошибка обновления агрегатов: {e}")
+        return total
+
+async def periodic_rollups():
+    """Фоновое обновление дневных агрегатов."""
+    while True:
+        await write_behind.flush()
+        processed = await refresh_rollups()
+        if processed:
+            logger.debug(f"Агрегаты обновлены: {processed} новых строк")
+        await asyncio.sleep(ROLLUP_INTERVAL_SEC)
+
+# ========== ХРАНЕНИЕ И АРХИВАЦИЯ ЛОГОВ ==========
+# Строки старше RETENTION_DAYS выгружаются в сжатый JSONL (ARCHIVE_DIR) и удаляются
+# небольшими пакетами, чтобы не держать блокировку записи. Удаляются только строки,
+# уже учтённые в дневных агрегатах, поэтому отчёты за старые периоды не меняются.
+
+# (таблица, колонка времени, водяная отметка агрегатов или None)
+RETENTION_TABLES = [
+    ('feedback', 'created_at', 'feedback'),
+    ('qa_sessions', 'created_at', 'qa_sessions'),
+    ('registration_attempts', 'attempt_time', None),
+]
+
+class _ArchiveWriter:
+    """Сжатый JSONL-файл архива; каждый пакет сбрасывается на диск до удаления строк из БД."""
+
+    def __init__(self, table: str):
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        zstandard = _zstandard()
+        suffix = 'zst' if zstandard is not None else 'gz'
+        self.path = os.path.join(ARCHIVE_DIR, f"{table}_{stamp}.jsonl.{suffix}")
+        self._raw = open(self.path, 'wb')
+        if zstandard is not None:
+            self._stream = zstandard.ZstdCompressor(level=10).stream_writer(self._raw, closefd=False)
+        else:
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb')
+
+    def write_rows(self, rows: List[dict]):
+        data = ''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows)
+        self._stream.write(data.encode('utf-8'))
+        self._stream.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self):
+        self._stream.close()
+        self._raw.close()
+
+async def _archive_table(table: str, time_column: str, watermark: Optional[str], days: int, batch: int) -> int:
+    cutoff = (f'-{int(days)} days',)
+    async with _read() as db:
+        async with db.execute("SELECT datetime('now', ?)", cutoff) as cursor:
+            cutoff_ts = (await cursor.fetchone())[0]
+        upper = None
+        if watermark:
+            upper = await _rollup_watermark(db, watermark)
+    writer = None
+    archived = 0
+    last_id = 0
+    try:
+        while True:
+            query = f"SELECT * FROM {table} WHERE id > ? AND {time_column} < ?"
+            params = [last_id, cutoff_ts]
+            if upper is not None:
+                query += " AND id <= ?"
+                params.append(upper)
+            async with _read() as db:
+                async with db.execute(query + " ORDER BY id LIMIT ?", (*params, batch)) as cursor:
+                    rows = [dict(row) for row in await cursor.fetchall()]
+            if not rows:
+                break
+            if writer is None:
+                writer = _ArchiveWriter(table)
+            await asyncio.to_thread(writer.write_rows, rows)
+            ids = [row['id'] for row in rows]
+            async with _write() as db:
                 await db.execute(
-                    "INSERT INTO unanswered_questions (telegram_id, question, user_context) VALUES (?, ?, ?)",
-                    (telegram_id, question, user_context)
+                    f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(ids))})", ids
                 )
+            archived += len(rows)
+            last_id = ids[-1]
+            # Между пакетами блокировка записи свободна для логов бота
+            await asyncio.sleep(0)
+    finally:
+        if writer is not None:
+            await asyncio.to_thread(writer.close)
+            logger.info(f"Архив {table}: {archived} строк → {writer.path}")
+    return archived
+
+async def _incremental_vacuum(pages_per_step: int = 1000):
+    async with _write() as db:
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            mode = (await cursor.fetchone())[0]
+    if mode != 2:
+        # Перевод существующей БД в INCREMENTAL требует одного полного VACUUM: он блокирует
+        # все записи на время перестройки файла, поэтому выполняется только по SQLITE_VACUUM_CONVERT
+        if not SQLITE_VACUUM_CONVERT:
+            logger.info("auto_vacuum не INCREMENTAL — место в файле БД не освобождается; "
+                        "для однократного VACUUM задайте SQLITE_VACUUM_CONVERT=true")
+            return
+        logger.info("Однократный VACUUM для включения auto_vacuum=INCREMENTAL")
+        async with _write() as db:
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
             await db.commit()
-        return True
+            await db.execute("VACUUM")
+        return
+    while True:
+        async with _write() as db:
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                free_pages = (await cursor.fetchone())[0]
+            if free_pages == 0:
+                break
+            # incremental_vacuum освобождает страницы по мере чтения результата
+            async with db.execute(f"PRAGMA incremental_vacuum({int(pages_per_step)})") as cursor:
+                await cursor.fetchall()
+        await asyncio.sleep(0)
+    async with _write() as db:
+        async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+            await cursor.fetchall()
+
+async def run_retention(days: int = RETENTION_DAYS, batch: int = RETENTION_BATCH_SIZE) -> dict:
+    """Архивирует и удаляет логи старше days дней, затем освобождает место в файле БД."""
+    result = {}
+    if days <= 0:
+        return result
+    try:
+        await write_behind.flush()
+        # Всё, что будет удалено, должно сначала попасть в агрегаты
+        await refresh_rollups()
+        for table, time_column, watermark in RETENTION_TABLES:
+            result[table] = await _archive_table(table, time_column, watermark, days, batch)
+        await _incremental_vacuum()
     except Exception as e:
-        logger.error(f"Ошибка при логировании неотвеченного вопроса: {e}")
-        return False
+        logger.error(f"Ошибка задачи хранения логов: {e}")
+    return result
+
+async def periodic_retention():
+    """Фоновая архивация старых логов."""
+    while True:
+        result = await run_retention()
+        if any(result.values()):
+            logger.info(f"Хранение логов: архивировано {result}")
+        await asyncio.sleep(RETENTION_INTERVAL_SEC)
+
+def _day_window(days: int) -> str:
+    """Модификатор date('now', ?) для окна из days дней, включая сегодняшний"""
+    return f'-{max(int(days) - 1, 0)} days'
 
 async def get_analytics_stats(days: int = 7) -> dict:
-    """Получение статистики за последние N дней."""
+    """Получение статистики за последние N дней (по дневным агрегатам)."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        await refresh_rollups()
+        window = (_day_window(days),)
+        async with _read() as db:
             stats = {}
             
-            # Общая статистика Q&A
+            # Общая статистика Q&A и фидбек
             async with db.execute(
                 """SELECT 
-                    COUNT(*) as total_questions,
-                    AVG(response_time_ms) as avg_response_time,
-                    AVG(confidence_score) as avg_confidence,
-                    SUM(CASE WHEN context_found = 1 THEN 1 ELSE 0 END) as questions_with_context
-                FROM qa_sessions 
-                WHERE created_at >= datetime('now', '-{} days')""".format(days)
+                    COALESCE(SUM(questions), 0),
+                    SUM(sum_response_ms) * 1.0 / NULLIF(SUM(response_count), 0),
+                    SUM(sum_confidence) / NULLIF(SUM(confidence_count), 0),
+                    COALESCE(SUM(with_context), 0),
+                    COALESCE(SUM(likes), 0),
+                    COALESCE(SUM(dislikes), 0)
+                FROM qa_daily_rollup 
+                WHERE day >= date('now', ?)""",
+                window
             ) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -418,39 +1260,39 @@ async def get_analytics_stats(days: int = 7) -> dict:
                     stats['avg_response_time_ms'] = round(row[1] or 0)
                     stats['avg_confidence'] = round(row[2] or 0, 3)
                     stats['questions_with_context'] = row[3]
+                    stats['likes'] = row[4]
+                    stats['dislikes'] = row[5]
+                    total_feedback = stats['likes'] + stats['dislikes']
+                    stats['satisfaction_rate'] = round(stats['likes'] / total_feedback * 100, 1) if total_feedback > 0 else 0
             
             # Топ вопросов
             async with db.execute(
-                """SELECT question, COUNT(*) as frequency 
-                FROM qa_sessions 
-                WHERE created_at >= datetime('now', '-{} days')
-                GROUP BY question 
+                """SELECT MAX(question) as question, SUM(questions) as frequency 
+                FROM question_daily_rollup 
+                WHERE day >= date('now', ?)
+                GROUP BY question_hash 
                 ORDER BY frequency DESC 
-                LIMIT 5""".format(days)
+                LIMIT 5""",
+                window
             ) as cursor:
                 stats['top_questions'] = await cursor.fetchall()
             
-            # Фидбек
+            # Неотвеченные вопросы, сгруппированные по смыслу
             async with db.execute(
-                """SELECT 
-                    SUM(CASE WHEN rating = 1 THEN 1 ELSE 0 END) as likes,
-                    SUM(CASE WHEN rating = -1 THEN 1 ELSE 0 END) as dislikes
-                FROM feedback f
-                JOIN qa_sessions qa ON f.qa_session_id = qa.id
-                WHERE qa.created_at >= datetime('now', '-{} days')""".format(days)
+                """SELECT c.representative, COUNT(q.id) as variants, SUM(q.frequency) as frequency 
+                FROM unanswered_questions q JOIN unanswered_clusters c ON q.cluster_id = c.id 
+                WHERE q.resolved = FALSE 
+                GROUP BY c.id 
+                ORDER BY frequency DESC 
+                LIMIT 10"""
             ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    stats['likes'] = row[0] or 0
-                    stats['dislikes'] = row[1] or 0
-                    total_feedback = stats['likes'] + stats['dislikes']
-                    stats['satisfaction_rate'] = round(stats['likes'] / total_feedback * 100, 1) if total_feedback > 0 else 0
+                stats['unanswered_clusters'] = await cursor.fetchall()
             
-            # Неотвеченные вопросы
+            # Ещё не распределённые по кластерам
             async with db.execute(
                 """SELECT question, frequency 
                 FROM unanswered_questions 
-                WHERE resolved = FALSE 
+                WHERE resolved = FALSE AND cluster_id IS NULL 
                 ORDER BY frequency DESC, last_asked DESC 
                 LIMIT 10"""
             ) as cursor:
@@ -462,19 +1304,49 @@ async def get_analytics_stats(days: int = 7) -> dict:
         return {}
 
 async def get_popular_questions(limit: int = 10, days: int = 30) -> list:
-    """Получение самых популярных вопросов за период."""
+    """Получение самых популярных вопросов за период (по дневным агрегатам)."""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _read() as db:
             async with db.execute(
-                """SELECT question, COUNT(*) as frequency, AVG(confidence_score) as avg_confidence
-                FROM qa_sessions 
-                WHERE created_at >= datetime('now', '-{} days')
-                GROUP BY question 
+                """SELECT MAX(question) as question, SUM(questions) as frequency,
+                    SUM(sum_confidence) / NULLIF(SUM(confidence_count), 0) as avg_confidence
+                FROM question_daily_rollup 
+                WHERE day >= date('now', ?)
+                GROUP BY question_hash 
                 ORDER BY frequency DESC 
-                LIMIT ?""".format(days),
-                (limit,)
+                LIMIT ?""",
+                (_day_window(days), limit)
             ) as cursor:
                 return await cursor.fetchall()
     except Exception as e:
         logger.error(f"Ошибка при получении популярных вопросов: {e}")
-        return [] 
\ No newline at end of file
+        return []
+
+async def get_search_comparison(days: int = 7) -> dict:
+    """Сравнение версий поиска (v1/v2) за последние N дней по дневным агрегатам."""
+    try:
+        await refresh_rollups()
+        async with _read() as db:
+            async with db.execute(
+                """SELECT 
+                    search_version,
+                    COALESCE(SUM(questions), 0) as total,
+                    SUM(sum_response_ms) * 1.0 / NULLIF(SUM(response_count), 0) as avg_time,
+                    SUM(sum_confidence) / NULLIF(SUM(confidence_count), 0) as avg_confidence,
+                    COALESCE(SUM(likes), 0) as likes,
+                    COALESCE(SUM(dislikes), 0) as dislikes
+                FROM qa_daily_rollup
+                WHERE day >= date('now', ?) AND search_version IN ('v1', 'v2')
+                GROUP BY search_version""",
+                (_day_window(days),)
+            ) as cursor:
+                rows = {row[0]: row for row in await cursor.fetchall()}
+        empty = (0, None, None)
+        return {
+            'v1': tuple(rows['v1'][1:4]) if 'v1' in rows else empty,
+            'v2': tuple(rows['v2'][1:4]) if 'v2' in rows else empty,
+            'feedback': [(v, rows[v][4], rows[v][5]) for v in ('v1', 'v2') if v in rows and rows[v][4] + rows[v][5] > 0],
+        }
+    except Exception as e:
+        logger.error(f"Ошибка при сравнении версий поиска: {e}")
+        return {}
@@ -0,0 +1,125 @@
+"""
+Поиск почти-дубликатов чанков (MinHash + LSH) перед индексацией
+"""
+
+import hashlib
+import re
+from typing import Dict, List, Set
+
+_EMPTY = (1 << 64) - 1
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _shingles(text: str, size: int) -> Set[int]:
+    """Множество хешей словесных n-грамм (шинглов) текста"""
+    words = _WORD_RE.findall(text.lower().replace('ё', 'е'))
+    if not words:
+        return set()
+    if len(words) < size:
+        grams = [' '.join(words)]
+    else:
+        grams = [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return {
+        int.from_bytes(hashlib.blake2b(g.encode('utf-8'), digest_size=8).digest(), 'little')
+        for g in grams
+    }
+
+
+class MinHashDeduplicator:
+    """Схлопывает почти одинаковые чанки в один канонический.
+
+    Сигнатура строится one-permutation hashing'ом (один хеш на шингл, минимум
+    в каждой из num_perm корзин, пустые корзины заполняются соседними), поэтому
+    стоимость линейна по длине чанка. Сигнатура делится на полосы (LSH banding):
+    кандидатами считаются чанки, совпавшие хотя бы в одной полосе, после чего пара
+    проверяется точным Жаккаром по шинглам. Сравнение «все со всеми» не выполняется.
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 5):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm должен делиться на bands без остатка")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+    def signature(self, shingles: Set[int]) -> List[int]:
+        bins = [_EMPTY] * self.num_perm
+        for h in shingles:
+            b = h % self.num_perm
+            v = h // self.num_perm
+            if v < bins[b]:
+                bins[b] = v
+        if len(shingles) and _EMPTY in bins:
+            # Денсификация: пустая корзина берёт значение ближайшей непустой справа
+            for b in range(self.num_perm):
+                if bins[b] != _EMPTY:
+                    continue
+                for step in range(1, self.num_perm):
+                    donor = bins[(b + step) % self.num_perm]
+                    if donor != _EMPTY:
+                        bins[b] = donor + step
+                        break
+        return bins
+
+    def deduplicate(self, chunks: List[Dict]) -> List[Dict]:
+        """Возвращает канонические чанки в исходном порядке.
+
+        Канонический чанк — первый встретившийся в группе; в его metadata['sources']
+        собираются имена файлов всех схлопнутых копий, в metadata['duplicates'] —
+        их количество.
+        """
+        shingle_sets = [_shingles(c.get('text', ''), self.shingle_size) for c in chunks]
+        parent = list(range(len(chunks)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        buckets: Dict[tuple, List[int]] = {}
+        for i, sh in enumerate(shingle_sets):
+            if not sh:
+                continue
+            sig = self.signature(sh)
+            for b in range(self.bands):
+                key = (b, tuple(sig[b * self.rows:(b + 1) * self.rows]))
+                bucket = buckets.setdefault(key, [])
+                represented = False
+                for j in bucket:
+                    ri, rj = find(i), find(j)
+                    if ri == rj:
+                        represented = True
+                        continue
+                    inter = len(sh & shingle_sets[j])
+                    jaccard = inter / (len(sh) + len(shingle_sets[j]) - inter)
+                    if jaccard >= self.threshold:
+                        # Корнем остаётся чанк, встретившийся раньше
+                        parent[max(ri, rj)] = min(ri, rj)
+                        represented = True
+                # Группа уже представлена в корзине — копию не добавляем,
+                # чтобы массовый шаблонный текст не давал квадратичных сравнений
+                if not represented:
+                    bucket.append(i)
+
+        result: List[Dict] = []
+        canonical: Dict[int, Dict] = {}
+        for i, chunk in enumerate(chunks):
+            root = find(i)
+            source = chunk.get('metadata', {}).get('filename', '')
+            if root == i:
+                meta = dict(chunk.get('metadata', {}))
+                meta['sources'] = [source] if source else []
+                meta['duplicates'] = 0
+                canon = {**chunk, 'metadata': meta}
+                canonical[i] = canon
+                result.append(canon)
+            else:
+                meta = canonical[root]['metadata']
+                meta['duplicates'] += 1
+                if source and source not in meta['sources']:
+                    meta['sources'].append(source)
+        return result
@@ -0,0 +1,258 @@
+"""
+Отдельный процесс с LLM для многопроцессного model_service: GGUF-модель грузится один
+раз, а воркеры API обращаются к ней через unix-сокет (RemoteLlama).
+
+    python inference_server.py          # сокет — LLM_SOCKET_PATH
+
+Протокол — кадры «4 байта длины (big-endian) + JSON»:
+  {"op": "generate", "prompt", "max_tokens", "temperature", "top_p"} -> {"text": ...}* и {"done": true}
+  {"op": "tokenize", "text"} -> {"tokens": [...]}
+  {"op": "count_tokens", "texts": [...]} -> {"counts": [...]}
+  {"op": "ping"} -> {"ready": bool, "error": str | null, "load_sec": float | null}
+Ошибка любой операции — кадр {"error": "..."}.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from config import (ensure_directories, GGUF_MODEL_PATH, LLAMA_CTX, LLAMA_THREADS, LLAMA_BATCH, LLAMA_GPU_LAYERS,
+                    LLM_SOCKET_PATH, LOGS_DIR, MODEL_WARMUP, WARMUP_QUERIES)
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>I')
+# Ответ на ping, пока модель грузится; generate в это время получает ошибку
+_NOT_READY = 'Модель ещё загружается'
+
+
+class InferenceError(Exception):
+    """Ошибка, которую вернул inference_server"""
+
+
+def _encode(message: dict) -> bytes:
+    data = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    return _HEADER.pack(len(data)) + data
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError('inference_server закрыл соединение')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_frame(sock: socket.socket) -> dict:
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, size))
+
+
+# ===== Клиент =====
+
+class RemoteLlama:
+    """Клиент inference_server с той частью интерфейса llama_cpp.Llama, которой пользуется
+    model_service: вызов (в том числе stream=True) и tokenize(). Каждый вызов — своё
+    соединение, поэтому клиент можно звать из нескольких потоков."""
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        self.path = path
+        self.timeout = timeout
+
+    def _request(self, message: dict) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(_encode(message))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _call(self, message: dict) -> dict:
+        with self._request(message) as sock:
+            reply = _recv_frame(sock)
+        if 'error' in reply:
+            raise InferenceError(reply['error'])
+        return reply
+
+    def ping(self) -> dict:
+        with self._request({'op': 'ping'}) as sock:
+            return _recv_frame(sock)
+
+    def wait_ready(self, timeout: float, interval: float = 1.0) -> dict:
+        """Ждёт, пока сервер поднимется и загрузит модель"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                status = self.ping()
+                if status.get('ready'):
+                    return status
+                if status.get('error'):
+                    raise InferenceError(status['error'])
+            except OSError:
+                pass
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"inference_server ({self.path}) не готов за {timeout:.0f} с")
+            time.sleep(interval)
+
+    def tokenize(self, text: bytes) -> List[int]:
+        return self._call({'op': 'tokenize', 'text': text.decode('utf-8', errors='ignore')})['tokens']
+
+    def count_tokens(self, texts: List[str], batch: int = 512) -> List[int]:
+        """Число токенов для каждого текста: пакетами, а не соединением на текст"""
+        counts: List[int] = []
+        for i in range(0, len(texts), batch):
+            counts.extend(self._call({'op': 'count_tokens', 'texts': list(texts[i:i + batch])})['counts'])
+        return counts
+
+    def _stream(self, message: dict) -> Iterator[dict]:
+        with self._request(message) as sock:
+            while True:
+                frame = _recv_frame(sock)
+                if 'error' in frame:
+                    raise InferenceError(frame['error'])
+                if frame.get('done'):
+                    return
+                yield {"choices": [{"text": frame['text']}]}
+
+    def __call__(self, prompt: str, max_tokens: int = 128, temperature: float = 0.8, top_p: float = 0.95,
+                 echo: bool = False, stream: bool = False, **kwargs):
+        message = {'op': 'generate', 'prompt': prompt, 'max_tokens': max_tokens,
+                   'temperature': temperature, 'top_p': top_p}
+        if stream:
+            return self._stream(message)
+        pieces = [chunk["choices"][0]["text"] for chunk in self._stream(message)]
+        return {"choices": [{"text": "".join(pieces)}], "usage": {"completion_tokens": len(pieces)}}
+
+
+# ===== Сервер =====
+
+class InferenceServer:
+    def __init__(self, path: str):
+        self.path = path
+        self.llm = None
+        self.error: Optional[str] = None
+        self.load_sec: Optional[float] = None
+        # Модель одна — генерации идут по очереди
+        self._lock = asyncio.Lock()
+
+    def _load(self):
+        from llama_cpp import Llama
+        start = time.perf_counter()
+        logger.info(f"Загрузка GGUF модели {GGUF_MODEL_PATH}...")
+        llm = Llama(model_path=GGUF_MODEL_PATH, n_ctx=LLAMA_CTX, n_threads=LLAMA_THREADS, n_batch=LLAMA_BATCH,
+                    n_gpu_layers=LLAMA_GPU_LAYERS, verbose=False)
+        if MODEL_WARMUP and WARMUP_QUERIES:
+            llm(f"<s>[INST] {WARMUP_QUERIES[0]} [/INST]", max_tokens=1, echo=False)
+        self.llm = llm
+        self.load_sec = round(time.perf_counter() - start, 3)
+        logger.info(f"Модель готова за {self.load_sec} с")
+
+    async def load(self):
+        try:
+            await asyncio.to_thread(self._load)
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"Ошибка загрузки модели: {e}")
+
+    def _generate(self, message: dict, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue,
+                  cancelled: threading.Event):
+        try:
+            for chunk in self.llm(message['prompt'], max_tokens=message.get('max_tokens', 128),
+                                  temperature=message.get('temperature', 0.7), top_p=message.get('top_p', 0.95),
+                                  echo=False, stream=True):
+                if cancelled.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, {'text': chunk["choices"][0].get("text", "")})
+            loop.call_soon_threadsafe(queue.put_nowait, {'done': True})
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, {'error': str(e)})
+
+    async def _handle_generate(self, message: dict, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        async with self._lock:
+            worker = loop.run_in_executor(None, self._generate, message, loop, queue, cancelled)
+            try:
+                while True:
+                    frame = await queue.get()
+                    writer.write(_encode(frame))
+                    await writer.drain()
+                    if 'text' not in frame:
+                        break
+            finally:
+                # Клиент отключился — генерацию останавливаем, а не дописываем в пустоту
+                cancelled.set()
+                await worker
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+            message = json.loads(await reader.readexactly(size))
+            op = message.get('op')
+            if op == 'ping':
+                writer.write(_encode({'ready': self.llm is not None, 'error': self.error, 'load_sec': self.load_sec}))
+            elif self.llm is None:
+                writer.write(_encode({'error': self.error or _NOT_READY}))
+            elif op == 'generate':
+                await self._handle_generate(message, writer)
+            elif op == 'tokenize':
+                tokens = await asyncio.to_thread(self.llm.tokenize, message.get('text', '').encode('utf-8'))
+                writer.write(_encode({'tokens': list(tokens)}))
+            elif op == 'count_tokens':
+                counts = await asyncio.to_thread(
+                    lambda texts: [len(self.llm.tokenize(t.encode('utf-8'))) for t in texts], message.get('texts', []))
+                writer.write(_encode({'counts': counts}))
+            else:
+                writer.write(_encode({'error': f"Неизвестная операция: {op}"}))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса inference_server: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        logger.info(f"inference_server слушает {self.path}")
+        # Сокет открыт сразу: клиенты видят статус загрузки через ping
+        asyncio.create_task(self.load())
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    ensure_directories()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(os.path.join(LOGS_DIR, 'inference_server.log')),
+            logging.StreamHandler()
+        ]
+    )
+    if not LLM_SOCKET_PATH:
+        raise SystemExit("Не задан LLM_SOCKET_PATH")
+    asyncio.run(InferenceServer(LLM_SOCKET_PATH).serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,15 @@ import aiohttp
 import logging
 from typing import List, Optional
 from config import MODEL_SERVICE_URL
+from tracing import trace_headers
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class TokenLimitExceeded(Exception):
+    """model_service отказал в генерации: исчерпан месячный лимит токенов"""
+
 class LLMClient:
     def __init__(self, base_url: str = MODEL_SERVICE_URL):
         self.base_url = base_url.rstrip('/')
@@ -15,7 +19,7 @@ class LLMClient:
     async def health_check(self) -> dict:
         """Проверка здоровья сервиса"""
         async with aiohttp.ClientSession(timeout=self._timeout) as session:
-            async with session.get(f"{self.base_url}/health") as response:
+            async with session.get(f"{self.base_url}/health", headers=trace_headers()) as response:
                 return await response.json()
     
     async def generate(
@@ -24,28 +28,69 @@ class LLMClient:
         context: str = "",
         max_tokens: int = 512,
         temperature: float = 0.7,
-        top_p: float = 0.95
+        top_p: float = 0.95,
+        telegram_id: Optional[int] = None,
+        department: Optional[str] = None
     ) -> Optional[str]:
-        """Генерация ответа"""
+        """Генерация ответа; telegram_id и department — для учёта токенов в model_service"""
+        result = await self._generate({
+            "query": query,
+            "context": context,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "telegram_id": telegram_id,
+            "department": department
+        })
+        return result["response"] if result else None
+
+    async def generate_answer(
+        self,
+        query: str,
+        context_chunks: List[dict],
+        max_tokens: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.95,
+        telegram_id: Optional[int] = None,
+        department: Optional[str] = None,
+        require_context: bool = False
+    ) -> Optional[dict]:
+        """Ответ по найденным чанкам (text, score, chunk_id) — сервис сам упакует их в бюджет
+        токенов. Возвращает ответ /generate целиком: context_used — позиции в context_chunks
+        чанков, попавших в промпт. require_context — не генерировать, если не попал ни один."""
+        return await self._generate({
+            "query": query,
+            "context_chunks": [
+                {"text": c["text"], "score": c.get("score"), "chunk_id": c.get("chunk_id")} for c in context_chunks
+            ],
+            "require_context": require_context,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "telegram_id": telegram_id,
+            "department": department
+        })
+
+    async def _generate(self, payload: dict) -> Optional[dict]:
         try:
             async with aiohttp.ClientSession(timeout=self._timeout) as session:
                 async with session.post(
                     f"{self.base_url}/generate",
-                    json={
-                        "query": query,
-                        "context": context,
-                        "max_tokens": max_tokens,
-                        "temperature": temperature,
-                        "top_p": top_p
-                    }
+                    headers=trace_headers(),
+                    json=payload
                 ) as response:
                     if response.status == 200:
-                        result = await response.json()
-                        return result["response"]
+                        return await response.json()
+                    elif response.status == 429:
+                        error = await response.text()
+                        logger.warning(f"Генерация отклонена по лимиту токенов: {error}")
+                        raise TokenLimitExceeded(error)
                     else:
                         error = await response.text()
                         logger.error(f"Ошибка генерации: {error}")
                         return None
+        except TokenLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при обращении к сервису: {e}")
             return None
@@ -56,6 +101,7 @@ class LLMClient:
             async with aiohttp.ClientSession(timeout=self._timeout) as session:
                 async with session.post(
                     f"{self.base_url}/embed",
+                    headers=trace_headers(),
                     json={"texts": texts}
                 ) as response:
                     if response.status == 200:
@@ -67,4 +113,23 @@ class LLMClient:
                         return None
         except Exception as e:
             logger.error(f"Ошибка при обращении к сервису: {e}")
-            return None 
\ No newline at end of file
+            return None 
+    async def profile(self, seconds: int, admin_token: str) -> Optional[bytes]:
+        """Профиль model_service за seconds секунд (collapsed stacks)"""
+        try:
+            timeout = aiohttp.ClientTimeout(total=seconds + 30)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(
+                    f"{self.base_url}/admin/profile",
+                    params={"seconds": seconds},
+                    headers={"X-Admin-Token": admin_token, **trace_headers()}
+                ) as response:
+                    if response.status == 200:
+                        return await response.read()
+                    else:
+                        error = await response.text()
+                        logger.error(f"Ошибка профилирования сервиса: {error}")
+                        return None
+        except Exception as e:
+            logger.error(f"Ошибка при обращении к сервису: {e}")
+            return None
@@ -1,8 +1,8 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from bot import bot, periodic_sync, setup_handlers
-from database import init_db, populate_test_data
+from aiogram import Dispatcher
+from bot import bot, STATE, SLOW_CAPTURE, progress_manager, periodic_sync, periodic_unanswered_clustering, periodic_state_sweep, setup_handlers
+from database import init_db, populate_test_data, close_db, close_db_pools, periodic_rollups, periodic_retention
 
 # Настройка логирования (подробная настройка в bot.py)
 logging.basicConfig(
@@ -18,6 +18,10 @@ async def main():
         logger.info("Инициализация базы данных...")
         await init_db()
         await populate_test_data()
+        # Подписка на изменения состояния от других реплик
+        STATE.start()
+        # Фоновый сэмплинг стеков для профилей медленных вопросов
+        SLOW_CAPTURE.start()
         
         # Создаем диспетчер
         dp = Dispatcher()
@@ -27,6 +31,14 @@ async def main():
         
         # Запуск периодической синхронизации
         asyncio.create_task(periodic_sync())
+        # Фоновое обновление агрегатов аналитики
+        asyncio.create_task(periodic_rollups())
+        # Архивация и удаление старых логов
+        asyncio.create_task(periodic_retention())
+        # Группировка неотвеченных вопросов по смыслу
+        asyncio.create_task(periodic_unanswered_clustering())
+        # Очистка просроченного состояния пользователей
+        asyncio.create_task(periodic_state_sweep())
         
         # Запуск бота
         logger.info("Запуск бота...")
@@ -34,6 +46,11 @@ async def main():
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
     finally:
+        SLOW_CAPTURE.stop()
+        await progress_manager.close()
+        await STATE.close()
+        await close_db_pools()
+        await close_db()
         await bot.session.close()
 
 if __name__ == '__main__':
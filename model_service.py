@@ -1,7 +1,15 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+import asyncio
 import logging
+import signal
+import subprocess
+import sys
+import tempfile
+import time
 import uvicorn
 from datetime import datetime
 from sentence_transformers import SentenceTransformer, util, CrossEncoder
@@ -9,15 +17,32 @@ import numpy as np
 import os
 import pickle
 import hashlib
+import hmac
 import re
-from config import GGUF_MODEL_PATH, LOGS_DIR
+from config import (ensure_directories, GGUF_MODEL_PATH, LOGS_DIR, MODELS_DIR, ADMIN_API_TOKEN, PROFILE_MAX_SEC,
+                    PROFILES_DIR, SLOW_REQUEST_THRESHOLD_SEC, PROFILER_SAMPLE_INTERVAL_MS, MODEL_WARMUP, WARMUP_QUERIES,
+                    LLAMA_CTX, LLAMA_THREADS, LLAMA_BATCH, LLAMA_GPU_LAYERS, MODEL_SERVICE_WORKERS, LLM_SOCKET_PATH,
+                    LLM_CONNECT_TIMEOUT_SEC, SQLITE_BUSY_TIMEOUT_MS, USAGE_DB_PATH, USAGE_FLUSH_MS,
+                    USAGE_ROLLUP_INTERVAL_SEC, USER_MONTHLY_TOKEN_LIMIT, DEPARTMENT_MONTHLY_TOKEN_LIMIT,
+                    CONTEXT_TOKEN_BUDGET)
 
 # llama-cpp-python для GGUF
 from llama_cpp import Llama
 
-# Дополнительно: FAISS и BM25
-import faiss  # type: ignore
-from rank_bm25 import BM25Okapi
+# Индекс поиска (dense + BM25) в файлах, общих для всех воркеров через mmap
+import shared_index
+from inference_server import RemoteLlama
+import usage_ledger
+import context_packer
+
+import tracing
+import profiler
+
+# Метрики Prometheus (при нескольких воркерах — через PROMETHEUS_MULTIPROC_DIR)
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+ensure_directories()
 
 # Настройка логирования
 logging.basicConfig(
@@ -32,27 +57,128 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация
 MODEL_PATH = GGUF_MODEL_PATH
-N_CTX = int(os.getenv('LLAMA_CTX', '2048'))
-N_THREADS = int(os.getenv('LLAMA_THREADS', '4'))
-N_BATCH = int(os.getenv('LLAMA_BATCH', '256'))
-N_GPU_LAYERS = int(os.getenv('LLAMA_GPU_LAYERS', '32'))
+N_CTX = LLAMA_CTX
+N_THREADS = LLAMA_THREADS
+N_BATCH = LLAMA_BATCH
+N_GPU_LAYERS = LLAMA_GPU_LAYERS
 MAX_NEW_TOKENS = int(os.getenv('MAX_NEW_TOKENS', '512'))
 EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'paraphrase-multilingual-MiniLM-L12-v2')
 CROSS_ENCODER_MODEL = os.getenv('CROSS_ENCODER_MODEL', 'cross-encoder/ms-marco-MiniLM-L-12-v2')
 # Лимит токенов в месяц для коммерческой лицензии (только выходные токены)
 MONTHLY_TOKEN_LIMIT = int(os.getenv('MONTHLY_TOKEN_LIMIT', '10000000'))
 ALERT_THRESHOLD = float(os.getenv('TOKEN_ALERT_THRESHOLD', '0.8'))  # 80%
+INDEX_DIR = os.path.join(MODELS_DIR, 'search_index')
+# Индекс в формате до mmap-каталога; при старте переводится в новый формат
+LEGACY_INDEX_PATH = os.path.join(MODELS_DIR, 'search_index.pkl')
 
 # Создаем FastAPI приложение
 app = FastAPI(title="LLM Service")
 
+# ===== Метрики =====
+STAGE_SECONDS = Histogram(
+    'model_service_stage_seconds', 'Длительность этапов обработки запроса', ['stage'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+CONTEXT_TOKENS = Histogram(
+    'model_service_context_tokens', 'Токены контекста в промпте после упаковки в бюджет',
+    buckets=(0, 64, 128, 256, 384, 512, 768, 1024, 1536, 2048)
+)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    'model_service_decode_tokens_per_second', 'Скорость генерации токенов после первого',
+    buckets=(1, 2, 4, 6, 8, 10, 15, 20, 30, 50, 80, 120)
+)
+REQUESTS_TOTAL = Counter('model_service_requests_total', 'Запросы по эндпоинтам', ['endpoint', 'status'])
+# multiprocess_mode — как сводить значения воркеров (действует только при PROMETHEUS_MULTIPROC_DIR)
+INDEX_CHUNKS = Gauge('model_service_index_chunks', 'Число чанков в поисковом индексе', multiprocess_mode='max')
+# Значение берётся из общего журнала, поэтому у всех воркеров одинаковое
+MONTHLY_COMPLETION_TOKENS = Gauge('model_service_monthly_completion_tokens', 'Выходные токены за текущий месяц',
+                                  multiprocess_mode='max')
+MONTHLY_TOKEN_LIMIT_GAUGE = Gauge('model_service_monthly_token_limit', 'Месячный лимит выходных токенов',
+                                  multiprocess_mode='max')
+MONTHLY_TOKEN_LIMIT_GAUGE.set(MONTHLY_TOKEN_LIMIT)
+COMPONENT_LOAD_SECONDS = Gauge('model_service_component_load_seconds', 'Время загрузки компонента при старте', ['component'],
+                               multiprocess_mode='max')
+COMPONENT_WARMUP_SECONDS = Gauge('model_service_component_warmup_seconds', 'Время прогрева компонента при старте', ['component'],
+                                 multiprocess_mode='max')
+COMPONENT_READY = Gauge('model_service_component_ready', 'Компонент загружен и прогрет (1/0)', ['component'],
+                        multiprocess_mode='min')
+USAGE_REJECTED = Counter('model_service_usage_rejected_total', 'Генерации, отклонённые по лимиту токенов', ['scope'])
+STARTUP_SECONDS = Gauge('model_service_startup_seconds', 'Время от старта до готовности всех компонентов',
+                        multiprocess_mode='max')
+
+STAGES = ('queue_wait', 'context_pack', 'prompt_eval', 'decode', 'generate', 'embed', 'query_encode',
+          'dense_search', 'bm25', 'fusion', 'cosine_rerank', 'rerank')
+# Дочерние серии создаются заранее, чтобы на горячем пути не искать их по меткам
+_STAGE_HISTOGRAMS = {name: STAGE_SECONDS.labels(name) for name in STAGES}
+
+# Спаны запросов (trace ID приходит от бота в заголовке X-Trace-Id)
+SPAN_LOG = tracing.SpanLog('model_service', LOGS_DIR)
+# Стеки запросов дольше SLOW_REQUEST_THRESHOLD_SEC сохраняются в logs/profiles/model_service
+SLOW_CAPTURE = profiler.SlowRequestCapture(os.path.join(PROFILES_DIR, 'model_service'),
+                                           SLOW_REQUEST_THRESHOLD_SEC, PROFILER_SAMPLE_INTERVAL_MS / 1000)
+
+def _observe(name: str, start: float, duration: float):
+    _STAGE_HISTOGRAMS[name].observe(duration)
+    tracing.record(name, start, duration)
+
+@contextmanager
+def _stage(name: str):
+    """Замер этапа: гистограмма model_service_stage_seconds + спан трассы"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(name, start, time.perf_counter() - start)
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    trace_id = tracing.new_trace(request.headers.get(tracing.TRACE_HEADER))
+    # Профилирование по запросу само длится долго — в медленные запросы его не пишем
+    watch = nullcontext() if request.url.path.startswith('/admin/') else \
+        SLOW_CAPTURE.watch(f"{request.url.path}_{trace_id}")
+    # Метка — шаблон маршрута, а не сырой путь: число серий не растёт от мусорных URL
+    try:
+        async with watch:
+            response = await call_next(request)
+    except Exception:
+        REQUESTS_TOTAL.labels(_route_label(request), '500').inc()
+        raise
+    endpoint = _route_label(request)
+    REQUESTS_TOTAL.labels(endpoint, str(response.status_code)).inc()
+    timing = tracing.server_timing_header()
+    if timing:
+        response.headers['Server-Timing'] = timing
+        SPAN_LOG.write(endpoint=endpoint, status=response.status_code)
+    response.headers[tracing.TRACE_HEADER] = trace_id
+    return response
+
+def _route_label(request: Request) -> str:
+    route = request.scope.get('route')
+    return getattr(route, 'path', 'unmatched')
+
+# Генерация идёт в отдельном потоке; модель одна, поэтому запросы выстраиваются в очередь
+_llm_lock = asyncio.Lock()
+
 # Модели данных
+class ContextChunk(BaseModel):
+    text: str
+    score: Optional[float] = None
+    # Позиция чанка в индексе (из SearchHit) — по ней берётся посчитанное при индексации число токенов
+    chunk_id: Optional[int] = None
+
 class GenerateRequest(BaseModel):
     query: str
     context: Optional[str] = ""
+    # Найденные чанки по убыванию ценности; сервис упакует их в бюджет токенов контекста
+    context_chunks: Optional[List[ContextChunk]] = None
+    # Не генерировать, если ни один из context_chunks не поместился в бюджет (ответ без опоры на документы)
+    require_context: Optional[bool] = False
     max_tokens: Optional[int] = MAX_NEW_TOKENS
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.95
+    # Кто спрашивает — для учёта токенов и лимитов по пользователю и отделу
+    telegram_id: Optional[int] = None
+    department: Optional[str] = None
 
 class EmbeddingRequest(BaseModel):
     texts: List[str]
@@ -65,6 +191,10 @@ class GenerateResponse(BaseModel):
     monthly_usage: Optional[int] = None
     monthly_limit: Optional[int] = None
     usage_ratio: Optional[float] = None
+    # Позиции в исходном context_chunks: попавшие в промпт (целиком или окном предложений) и выброшенные
+    context_used: Optional[List[int]] = None
+    context_dropped: Optional[List[int]] = None
+    context_tokens: Optional[int] = None
 
 class EmbeddingResponse(BaseModel):
     embeddings: List[List[float]]
@@ -72,46 +202,190 @@ class EmbeddingResponse(BaseModel):
 
 class IndexRequest(BaseModel):
     documents: List[str]
+    # Метаданные чанков (doc_type, department, dates, filename, sources), по одному словарю на документ
+    metadata: Optional[List[Dict[str, Any]]] = None
+
+class SearchFilters(BaseModel):
+    departments: Optional[List[str]] = None
+    doc_types: Optional[List[str]] = None
+    date_from: Optional[str] = None  # YYYY-MM-DD
+    date_to: Optional[str] = None
+    # Чанки без метки отдела (общие документы) не отсекаются фильтром по отделу
+    include_untagged: bool = True
 
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 5
+    filters: Optional[SearchFilters] = None
 
 class SearchHit(BaseModel):
     text: str
     score: float
+    sources: Optional[List[str]] = None
+    chunk_id: Optional[int] = None
 
 class SearchResponse(BaseModel):
     hits: List[SearchHit]
 
+class UsageRequest(BaseModel):
+    # Период: месяц YYYY-MM (по умолчанию текущий) или дни date_from..date_to (YYYY-MM-DD)
+    month: Optional[str] = None
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    group_by: Optional[str] = None  # user | department | day | month
+    telegram_id: Optional[int] = None
+    department: Optional[str] = None
+    limit: int = 50
+
+class UsageRow(BaseModel):
+    key: str
+    completion_tokens: int
+    requests: int
+
 class UsageResponse(BaseModel):
     month_key: str
     monthly_usage: int
     monthly_limit: int
     usage_ratio: float
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    completion_tokens: Optional[int] = None
+    requests: Optional[int] = None
+    breakdown: Optional[List[UsageRow]] = None
+
+_DATE_FORMATS = (
+    (re.compile(r'^(\d{1,2})\.(\d{1,2})\.(\d{4})$'), ('d', 'm', 'y')),
+    (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$'), ('y', 'm', 'd')),
+    (re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$'), ('d', 'm', 'y')),
+)
+
+def _date_key(value: str) -> int:
+    """Преобразует дату из метаданных в число YYYYMMDD (0, если не распознана)"""
+    for pattern, order in _DATE_FORMATS:
+        m = pattern.match((value or '').strip())
+        if m:
+            parts = dict(zip(order, (int(g) for g in m.groups())))
+            return parts['y'] * 10000 + parts['m'] * 100 + parts['d']
+    return 0
+
+class ChunkMetadataStore:
+    """Колоночное хранилище метаданных чанков для префильтрации поиска.
+
+    Категориальные поля хранятся как массивы кодов int32 (-1 — значение отсутствует)
+    со словарём значений, дата документа — как int32 YYYYMMDD. Фильтр превращается
+    в булеву маску по корпусу до подсчёта скоров.
+    """
+
+    CATEGORICAL = ('department', 'doc_type', 'filename')
+
+    def __init__(self, metadata: Optional[List[Dict[str, Any]]] = None, size: int = 0):
+        metadata = metadata or []
+        self.size = size
+        self.vocab: Dict[str, Dict[str, int]] = {field: {} for field in self.CATEGORICAL}
+        self.codes: Dict[str, np.ndarray] = {}
+        for field in self.CATEGORICAL:
+            column = np.full(size, -1, dtype=np.int32)
+            vocab = self.vocab[field]
+            for i, meta in enumerate(metadata[:size]):
+                value = (meta or {}).get(field)
+                if value:
+                    column[i] = vocab.setdefault(str(value).lower(), len(vocab))
+            self.codes[field] = column
+        self.dates = np.zeros(size, dtype=np.int32)
+        self.sources: List[List[str]] = [[] for _ in range(size)]
+        for i, meta in enumerate(metadata[:size]):
+            meta = meta or {}
+            dates = [_date_key(d) for d in meta.get('dates') or []]
+            self.dates[i] = max(dates) if dates else 0
+            self.sources[i] = list(meta.get('sources') or ([meta['filename']] if meta.get('filename') else []))
+
+    def _category_mask(self, field: str, values: List[str], include_missing: bool) -> np.ndarray:
+        column = self.codes[field]
+        wanted = [self.vocab[field][v.lower()] for v in values if v and v.lower() in self.vocab[field]]
+        mask = np.isin(column, np.array(wanted, dtype=np.int32))
+        if include_missing:
+            mask |= column == -1
+        return mask
+
+    def mask(self, filters: Optional['SearchFilters']) -> Optional[np.ndarray]:
+        """Булева маска допустимых чанков или None, если фильтр пустой"""
+        if filters is None or self.size == 0:
+            return None
+        mask = np.ones(self.size, dtype=bool)
+        active = False
+        if filters.departments:
+            mask &= self._category_mask('department', filters.departments, filters.include_untagged)
+            active = True
+        if filters.doc_types:
+            mask &= self._category_mask('doc_type', filters.doc_types, False)
+            active = True
+        date_from = _date_key(filters.date_from) if filters.date_from else 0
+        date_to = _date_key(filters.date_to) if filters.date_to else 0
+        if date_from:
+            mask &= self.dates >= date_from
+            active = True
+        if date_to:
+            mask &= (self.dates > 0) & (self.dates <= date_to)
+            active = True
+        return mask if active else None
+
+    def to_files(self) -> Tuple[Dict[str, np.ndarray], Dict[str, List[List[str]]]]:
+        """Массивы и списки для shared_index.write_index (словари значений идут в meta.json)"""
+        arrays = {f'meta_{field}': self.codes[field] for field in self.CATEGORICAL}
+        arrays['meta_dates'] = self.dates
+        return arrays, {'meta_sources': self.sources}
+
+    @classmethod
+    def from_files(cls, files: shared_index.IndexFiles, size: int) -> 'ChunkMetadataStore':
+        """Колонки через mmap из каталога индекса"""
+        store = cls([], 0)
+        store.size = size
+        store.vocab = files.info['metadata_vocab']
+        store.codes = {field: files.array(f'meta_{field}') for field in cls.CATEGORICAL}
+        store.dates = files.array('meta_dates')
+        store.sources = files.lists('meta_sources')
+        return store
+
+    @classmethod
+    def from_dict(cls, data: Optional[dict], size: int) -> 'ChunkMetadataStore':
+        if not data or data.get('size') != size:
+            return cls([], size)
+        store = cls([], 0)
+        store.size = size
+        store.vocab = data['vocab']
+        store.codes = data['codes']
+        store.dates = data['dates']
+        store.sources = data['sources']
+        return store
 
 # Глобальные переменные для моделей
 llm: Optional[Llama] = None
 embedding_model: Optional[SentenceTransformer] = None
 cross_encoder: Optional[CrossEncoder] = None
 
-# Индексы для поиска
-faiss_index = None
-dense_embeddings = None
-bm25_index: Optional[BM25Okapi] = None
-bm25_corpus_tokens: List[List[str]] = []
-corpus_texts: List[str] = []
+# Индексы для поиска; после загрузки с диска — поверх mmap, общие для всех воркеров
+dense_index: Optional[shared_index.FlatIndex] = None
+dense_embeddings = None  # нормированные векторы чанков
+bm25_index: Optional[shared_index.BM25Index] = None
+corpus_texts: Sequence[str] = []
+chunk_metadata = ChunkMetadataStore()
+# Токены каждого чанка по токенизатору LLM (-1 — LLM не была готова при индексации)
+chunk_token_counts: Optional[np.ndarray] = None
+# Поколение открытого индекса: другой воркер мог переиндексировать корпус
+index_generation: Optional[int] = None
 
-# Учёт токенов
-token_month_key = datetime.now().strftime('%Y-%m')
-monthly_completion_tokens = 0
+# Учёт токенов: журнал в SQLite, общий для всех воркеров и переживающий перезапуск
+token_ledger = usage_ledger.UsageLedger(USAGE_DB_PATH, MONTHLY_TOKEN_LIMIT, USER_MONTHLY_TOKEN_LIMIT,
+                                        DEPARTMENT_MONTHLY_TOKEN_LIMIT, USAGE_FLUSH_MS / 1000,
+                                        USAGE_ROLLUP_INTERVAL_SEC, SQLITE_BUSY_TIMEOUT_MS)
 
-def _reset_usage_if_needed():
-    global token_month_key, monthly_completion_tokens
-    now_key = datetime.now().strftime('%Y-%m')
-    if now_key != token_month_key:
-        token_month_key = now_key
-        monthly_completion_tokens = 0
+def _usage_ratio(used: int) -> float:
+    return (used / MONTHLY_TOKEN_LIMIT) if MONTHLY_TOKEN_LIMIT else 0.0
+
+def _seconds_to_next_month() -> int:
+    now = datetime.now()
+    next_month = datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+    return max(1, int((next_month - now).total_seconds()))
 
 def clean_response(text: str) -> str:
     """Очищает ответ от артефактов форматирования"""
@@ -146,96 +420,304 @@ def get_index_hash() -> str:
     content = f"{EMBEDDING_MODEL_NAME}_{len(corpus_texts)}_{hash(tuple(corpus_texts)) if corpus_texts else 0}"
     return hashlib.md5(content.encode()).hexdigest()
 
-async def save_index_to_disk():
-    """Сохраняет FAISS индекс и метаданные на диск"""
+def _save_index_sync() -> bool:
+    """Пишет индекс в каталог models/search_index (новое поколение, атомарная замена)"""
+    try:
+        with shared_index.index_lock(INDEX_DIR):
+            return _write_index_files()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения индекса: {e}")
+        return False
+
+def _write_index_files() -> bool:
+    """Запись поколения индекса; вызывается под shared_index.index_lock"""
     try:
-        if faiss_index is None or not corpus_texts:
+        if dense_index is None or not corpus_texts:
             return False
-            
-        os.makedirs('models', exist_ok=True)
-        
-        index_data = {
-            'faiss_index_bytes': faiss.serialize_index(faiss_index),
-            'dense_embeddings': dense_embeddings,
-            'corpus_texts': corpus_texts,
-            'bm25_tokens': bm25_corpus_tokens,
-            'timestamp': datetime.now(),
+        metadata_arrays, metadata_lists = chunk_metadata.to_files()
+        info = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
             'model_hash': get_index_hash(),
-            'embedding_model': EMBEDDING_MODEL_NAME
+            'embedding_model': EMBEDDING_MODEL_NAME,
+            'size': len(corpus_texts),
+            'bm25': bm25_index.params(),
+            'metadata_vocab': chunk_metadata.vocab,
         }
-        
-        with open('models/search_index.pkl', 'wb') as f:
-            pickle.dump(index_data, f)
-        
+        arrays = dict(bm25_index.arrays(), vectors=dense_embeddings, **metadata_arrays)
+        if chunk_token_counts is not None:
+            arrays['token_counts'] = chunk_token_counts
+        shared_index.write_index(INDEX_DIR, info, arrays, {'texts': corpus_texts}, metadata_lists)
         logger.info(f"Индекс сохранён: {len(corpus_texts)} документов")
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения индекса: {e}")
         return False
 
-async def load_index_from_disk() -> bool:
-    """Загружает сохранённый индекс с диска"""
-    try:
-        if not os.path.exists('models/search_index.pkl'):
-            return False
-            
-        with open('models/search_index.pkl', 'rb') as f:
+async def save_index_to_disk() -> bool:
+    """Сохраняет индекс на диск, не блокируя event loop"""
+    return await asyncio.to_thread(_save_index_sync)
+
+def _open_index() -> bool:
+    """Открывает каталог индекса через mmap и подменяет глобальные структуры поиска"""
+    global dense_index, dense_embeddings, bm25_index, corpus_texts, chunk_metadata, index_generation
+    global chunk_token_counts
+    files = shared_index.open_index(INDEX_DIR)
+    if files is None:
+        return False
+    # Проверяем актуальность модели
+    if files.info.get('embedding_model') != EMBEDDING_MODEL_NAME:
+        logger.info("Модель эмбеддингов изменилась, переиндексация необходима")
+        return False
+    size = int(files.info['size'])
+    vectors = files.array('vectors')
+    bm25 = shared_index.BM25Index({name: files.array(name) for name in shared_index.BM25Index.ARRAYS},
+                                  **files.info['bm25'])
+    metadata = ChunkMetadataStore.from_files(files, size)
+    dense_index, dense_embeddings, bm25_index = shared_index.FlatIndex(vectors), vectors, bm25
+    corpus_texts, chunk_metadata = files.texts('texts'), metadata
+    chunk_token_counts = files.array('token_counts') if files.has_array('token_counts') else None
+    index_generation = files.generation
+    INDEX_CHUNKS.set(size)
+    return True
+
+def _convert_legacy_index() -> bool:
+    """Переводит models/search_index.pkl (FAISS + BM25 в pickle) в каталог с mmap-файлами"""
+    global dense_index, dense_embeddings, bm25_index, corpus_texts, chunk_metadata, chunk_token_counts
+    if not os.path.exists(LEGACY_INDEX_PATH):
+        return False
+    # Воркеры стартуют одновременно: переводит первый, остальные открывают готовый индекс
+    with shared_index.index_lock(INDEX_DIR):
+        if not os.path.exists(LEGACY_INDEX_PATH):
+            return _open_index()
+        with open(LEGACY_INDEX_PATH, 'rb') as f:
             data = pickle.load(f)
-        
-        # Проверяем актуальность модели
         if data.get('embedding_model') != EMBEDDING_MODEL_NAME:
-            logger.info("Модель эмбеддингов изменилась, переиндексация необходима")
             return False
-            
-        global faiss_index, dense_embeddings, corpus_texts, bm25_corpus_tokens, bm25_index
-        
-        faiss_index = faiss.deserialize_index(data['faiss_index_bytes'])
-        dense_embeddings = data['dense_embeddings']
+        logger.info("Перевод индекса из search_index.pkl в формат с mmap...")
         corpus_texts = data['corpus_texts']
-        bm25_corpus_tokens = data['bm25_tokens']
-        bm25_index = BM25Okapi(bm25_corpus_tokens)
-        
+        dense_embeddings = shared_index.normalize(data['dense_embeddings'])
+        dense_index = shared_index.FlatIndex(dense_embeddings)
+        bm25_index = shared_index.BM25Index.build(data['bm25_tokens'])
+        chunk_metadata = ChunkMetadataStore.from_dict(data.get('chunk_metadata'), len(corpus_texts))
+        # LLM при старте ещё не загружена — токены таких чанков считаются при генерации
+        chunk_token_counts = None
+        if not _write_index_files():
+            return False
+        os.replace(LEGACY_INDEX_PATH, LEGACY_INDEX_PATH + '.bak')
+    return _open_index()
+
+def _load_index_sync() -> bool:
+    """Открывает сохранённый индекс (блокирующая часть load_index_from_disk)"""
+    try:
+        # Восстанавливает ссылку на поколение после сбоя и переводит каталог прежнего формата
+        with shared_index.index_lock(INDEX_DIR):
+            shared_index.recover(INDEX_DIR)
+        if not _open_index() and not _convert_legacy_index():
+            return False
         logger.info(f"Индекс загружен: {len(corpus_texts)} документов")
         return True
     except Exception as e:
         logger.error(f"Ошибка загрузки индекса: {e}")
         return False
 
+def _refresh_index():
+    """Переоткрывает индекс, если другой воркер записал новое поколение"""
+    generation = shared_index.read_generation(INDEX_DIR)
+    if generation is not None and generation != index_generation:
+        try:
+            if _open_index():
+                logger.info(f"Индекс переоткрыт: поколение {generation}, {len(corpus_texts)} документов")
+        except Exception as e:
+            logger.error(f"Ошибка переоткрытия индекса: {e}")
+
+async def load_index_from_disk() -> bool:
+    """Загружает сохранённый индекс с диска, не блокируя event loop"""
+    return await asyncio.to_thread(_load_index_sync)
+
+# ===== Загрузка при старте =====
+# Компоненты грузятся параллельно в потоках; эндпоинт открывается, как только готовы
+# нужные ему компоненты (поиск — эмбеддер и индекс, не дожидаясь LLM)
+COMPONENTS = ('llm', 'embedder', 'cross_encoder', 'index')
+component_state: Dict[str, Dict[str, Any]] = {
+    name: {'status': 'pending', 'load_sec': None, 'warmup_sec': None, 'error': None} for name in COMPONENTS
+}
+_startup_task: Optional[asyncio.Task] = None
+
+def _load_llm():
+    global llm
+    if LLM_SOCKET_PATH:
+        # Модель живёт в inference_server — ждём, пока он её загрузит
+        client = RemoteLlama(LLM_SOCKET_PATH)
+        client.wait_ready(LLM_CONNECT_TIMEOUT_SEC)
+        llm = client
+        return
+    llm = Llama(
+        model_path=MODEL_PATH,
+        n_ctx=N_CTX,
+        n_threads=N_THREADS,
+        n_batch=N_BATCH,
+        n_gpu_layers=N_GPU_LAYERS,
+        verbose=False
+    )
+
+def _load_embedder():
+    global embedding_model
+    embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+def _load_cross_encoder():
+    global cross_encoder
+    cross_encoder = CrossEncoder(CROSS_ENCODER_MODEL)
+
+def _load_index():
+    if not _load_index_sync():
+        logger.info("Сохранённый индекс не найден или устарел")
+
+def _warmup_llm():
+    if isinstance(llm, RemoteLlama):
+        # inference_server прогревает модель сам, один раз на все воркеры
+        return
+    # Один токен: выделение KV-кэша и первый проход по весам (подкачка mmap)
+    llm(f"<s>[INST] {WARMUP_QUERIES[0]} [/INST]", max_tokens=1, echo=False)
+
+def _warmup_embedder():
+    # Одиночные запросы — как в /search, пакет — как в /index
+    for query in WARMUP_QUERIES:
+        embedding_model.encode([query], convert_to_numpy=True)
+    embedding_model.encode(WARMUP_QUERIES, convert_to_numpy=True)
+
+def _warmup_cross_encoder():
+    cross_encoder.predict([(query, doc) for query in WARMUP_QUERIES for doc in WARMUP_QUERIES])
+
+def _warmup_index():
+    # Проход по памяти индексов: BM25 по токенам запросов, FAISS — вектором первого чанка
+    if not corpus_texts:
+        return
+    for query in WARMUP_QUERIES:
+        _bm25_candidates(query, 10, None)
+    _dense_candidates(np.asarray(dense_embeddings[:1], dtype='float32'), 10, None)
+
+_LOADERS = {
+    'llm': (_load_llm, _warmup_llm),
+    'embedder': (_load_embedder, _warmup_embedder),
+    'cross_encoder': (_load_cross_encoder, _warmup_cross_encoder),
+    'index': (_load_index, _warmup_index),
+}
+
+async def _load_component(name: str) -> bool:
+    loader, warmup = _LOADERS[name]
+    state = component_state[name]
+    state['status'] = 'loading'
+    logger.info(f"Загрузка компонента {name}...")
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(loader)
+        state['load_sec'] = round(time.perf_counter() - start, 3)
+        COMPONENT_LOAD_SECONDS.labels(name).set(state['load_sec'])
+        if MODEL_WARMUP and WARMUP_QUERIES:
+            state['status'] = 'warming'
+            start = time.perf_counter()
+            if name == 'llm':
+                # Генерация уже может ждать модель — прогрев идёт через ту же очередь
+                async with _llm_lock:
+                    await asyncio.to_thread(warmup)
+            else:
+                await asyncio.to_thread(warmup)
+            state['warmup_sec'] = round(time.perf_counter() - start, 3)
+            COMPONENT_WARMUP_SECONDS.labels(name).set(state['warmup_sec'])
+    except Exception as e:
+        state['status'] = 'failed'
+        state['error'] = str(e)
+        logger.error(f"Ошибка загрузки компонента {name}: {e}")
+        return False
+    state['status'] = 'ready'
+    COMPONENT_READY.labels(name).set(1)
+    logger.info(f"Компонент {name} готов: загрузка {state['load_sec']} с, прогрев {state['warmup_sec'] or 0} с")
+    return True
+
+async def _load_all():
+    start = time.perf_counter()
+    results = await asyncio.gather(*(_load_component(name) for name in COMPONENTS))
+    elapsed = time.perf_counter() - start
+    STARTUP_SECONDS.set(elapsed)
+    if all(results):
+        logger.info(f"Модели успешно загружены за {elapsed:.1f} с")
+    else:
+        failed = [name for name, ok in zip(COMPONENTS, results) if not ok]
+        logger.error(f"Не загружены компоненты: {', '.join(failed)}")
+
 @app.on_event("startup")
 async def load_models():
-    global llm, embedding_model, cross_encoder
+    """Запускает загрузку моделей и индекса в фоне: сервер принимает запросы сразу,
+    готовность по компонентам видна в /health"""
+    global _startup_task
+    for name in COMPONENTS:
+        COMPONENT_READY.labels(name).set(0)
+    _startup_task = asyncio.create_task(_load_all())
+
+def _require(*names: str):
+    """503, пока нужные эндпоинту компоненты не загружены и не прогреты"""
+    missing = [name for name in names if component_state[name]['status'] != 'ready']
+    if missing:
+        states = ', '.join(f"{name}: {component_state[name]['status']}" for name in missing)
+        raise HTTPException(status_code=503, detail=f"Компоненты не готовы ({states})",
+                            headers={'Retry-After': '5'})
+
+@app.on_event("startup")
+async def start_slow_capture():
+    SLOW_CAPTURE.start()
+
+@app.on_event("shutdown")
+async def stop_slow_capture():
+    SLOW_CAPTURE.stop()
+
+@app.on_event("startup")
+async def start_usage_ledger():
+    await token_ledger.start()
+
+@app.on_event("shutdown")
+async def stop_usage_ledger():
+    # Несброшенные события дописываются до выхода
+    await token_ledger.stop()
+
+def _check_admin(token: Optional[str]):
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Админ-эндпоинты выключены (не задан ADMIN_API_TOKEN)")
+    if not token or not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=401, detail="Неверный токен администратора")
+
+@app.post("/admin/profile")
+async def admin_profile(seconds: float = 10, interval_ms: float = 5, x_admin_token: Optional[str] = Header(None)):
+    """Сэмплирующий профиль процесса за seconds секунд в формате collapsed stacks"""
+    _check_admin(x_admin_token)
+    seconds = min(max(seconds, 1), PROFILE_MAX_SEC)
     try:
-        logger.info("Загрузка GGUF модели через llama-cpp...")
-        llm = Llama(
-            model_path=MODEL_PATH,
-            n_ctx=N_CTX,
-            n_threads=N_THREADS,
-            n_batch=N_BATCH,
-            n_gpu_layers=N_GPU_LAYERS,
-            verbose=False
-        )
+        text = await profiler.profile_for(seconds, max(interval_ms, 1) / 1000)
+    except profiler.ProfilerBusy:
+        raise HTTPException(status_code=409, detail="Профилирование уже идёт")
+    filename = f"model_service_{datetime.now():%Y%m%d-%H%M%S}.folded"
+    return Response(text, media_type='text/plain; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
-        logger.info("Загрузка модели эмбеддингов...")
-        embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-        
-        logger.info("Загрузка Cross-Encoder модели...")
-        cross_encoder = CrossEncoder(CROSS_ENCODER_MODEL)
-        
-        # Пытаемся загрузить сохранённый индекс
-        if not await load_index_from_disk():
-            logger.info("Сохранённый индекс не найден или устарел")
-        
-        logger.info("Модели успешно загружены")
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке моделей: {e}")
-        raise
+def _service_status() -> str:
+    statuses = [state['status'] for state in component_state.values()]
+    if all(status == 'ready' for status in statuses):
+        return "ok"
+    if any(status == 'failed' for status in statuses):
+        return "error"
+    return "starting"
 
 @app.get("/health")
 async def health_check():
-    _reset_usage_if_needed()
+    monthly_usage = token_ledger.month_usage()
     return {
-        "status": "ok",
+        "status": _service_status(),
         "models_loaded": all([llm is not None, embedding_model is not None, cross_encoder is not None]),
+        "components": component_state,
+        "ready": {
+            "search": component_state['embedder']['status'] == 'ready' and component_state['index']['status'] == 'ready',
+            "rerank": component_state['cross_encoder']['status'] == 'ready',
+            "generate": component_state['llm']['status'] == 'ready',
+        },
         "model_path": MODEL_PATH,
         "embedding_model": EMBEDDING_MODEL_NAME,
         "cross_encoder_model": CROSS_ENCODER_MODEL,
@@ -243,40 +725,170 @@ async def health_check():
         "gpu_layers": N_GPU_LAYERS,
         "corpus_size": len(corpus_texts),
         "usage": {
-            "month": token_month_key,
-            "completion_tokens": monthly_completion_tokens,
+            "month": usage_ledger.month_key(),
+            "completion_tokens": monthly_usage,
             "limit": MONTHLY_TOKEN_LIMIT,
-            "ratio": (monthly_completion_tokens / MONTHLY_TOKEN_LIMIT) if MONTHLY_TOKEN_LIMIT else 0.0
+            "ratio": _usage_ratio(monthly_usage)
         }
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus"""
+    MONTHLY_COMPLETION_TOKENS.set(token_ledger.month_usage())
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # Несколько воркеров: метрики сводятся по файлам всех процессов
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.post("/usage", response_model=UsageResponse)
-async def usage():
-    _reset_usage_if_needed()
+async def usage_report(request: Optional[UsageRequest] = None):
+    """Расход токенов за месяц или диапазон дней, с разрезом по пользователям, отделам, дням или месяцам"""
+    request = request or UsageRequest()
+    if request.group_by and request.group_by not in usage_ledger.GROUP_BY:
+        raise HTTPException(status_code=400, detail=f"group_by: одно из {', '.join(usage_ledger.GROUP_BY)}")
+    month = request.month or usage_ledger.month_key()
+    date_from = request.date_from or f"{month}-01"
+    date_to = request.date_to or f"{month}-31"
+    try:
+        tokens, requests, rows = await token_ledger.report(date_from, date_to, request.group_by,
+                                                           request.telegram_id, request.department,
+                                                           max(1, request.limit))
+    except Exception as e:
+        logger.error(f"Ошибка отчёта о расходе токенов: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    monthly_usage = token_ledger.month_usage()
     return UsageResponse(
-        month_key=token_month_key,
-        monthly_usage=monthly_completion_tokens,
+        month_key=usage_ledger.month_key(),
+        monthly_usage=monthly_usage,
         monthly_limit=MONTHLY_TOKEN_LIMIT,
-        usage_ratio=(monthly_completion_tokens / MONTHLY_TOKEN_LIMIT) if MONTHLY_TOKEN_LIMIT else 0.0
+        usage_ratio=_usage_ratio(monthly_usage),
+        date_from=date_from,
+        date_to=date_to,
+        completion_tokens=tokens,
+        requests=requests,
+        breakdown=[UsageRow(key=key, completion_tokens=t, requests=r) for key, t, r in rows]
+        if request.group_by else None
     )
 
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Токены текста по токенизатору LLM (с BOS, то есть с запасом в один токен)"""
+    return len(llm.tokenize(text.encode('utf-8')))
+
+def _index_token_counts(texts: Sequence[str]) -> np.ndarray:
+    """Токены каждого чанка при индексации; -1, если LLM ещё не готова"""
+    counts = np.full(len(texts), -1, dtype=np.int32)
+    if component_state['llm']['status'] != 'ready':
+        return counts
+    try:
+        if isinstance(llm, RemoteLlama):
+            counts[:] = llm.count_tokens(list(texts))
+        else:
+            counts[:] = [len(llm.tokenize(t.encode('utf-8'))) for t in texts]
+    except Exception as e:
+        logger.error(f"Ошибка подсчёта токенов чанков: {e}")
+    return counts
+
+def _chunk_token_count(chunk: ContextChunk) -> Optional[int]:
+    """Число токенов из индекса, если чанк из текущего поколения индекса"""
+    idx = chunk.chunk_id
+    if idx is None or chunk_token_counts is None or not 0 <= idx < len(chunk_token_counts):
+        return None
+    count = int(chunk_token_counts[idx])
+    if count < 0 or corpus_texts[idx] != chunk.text:
+        return None
+    return count
+
+def _build_prompt(query: str, context: str) -> str:
+    if context:
+        return f"<s>[INST] <<SYS>>\nТы — корпоративный ассистент. Отвечай на вопросы, используя предоставленный контекст.\nЕсли информации в контексте недостаточно, так и скажи. Отвечай кратко и по делу.\n<</SYS>>\n\nКонтекст:\n{context}\n\nВопрос: {query} [/INST]"
+    return f"<s>[INST] <<SYS>>\nТы — корпоративный ассистент. Отвечай на вопросы, используя предоставленный контекст.\nЕсли информации в контексте недостаточно, так и скажи. Отвечай кратко и по делу.\n<</SYS>>\n\nВопрос: {query} [/INST]"
+
+def _pack_context(request: GenerateRequest, max_tokens: int
+                  ) -> Tuple[List[Optional[int]], List[ContextChunk], Optional[context_packer.PackedContext]]:
+    """Упаковывает найденные чанки в бюджет: окно модели минус ответ и промпт без контекста,
+    но не больше CONTEXT_TOKEN_BUDGET. Возвращает и позиции чанков в request.context_chunks
+    (пустые чанки пропускаются, у строки context позиции нет)"""
+    positions: List[Optional[int]] = []
+    chunks: List[ContextChunk] = []
+    for position, chunk in enumerate(request.context_chunks or []):
+        if chunk.text and chunk.text.strip():
+            positions.append(position)
+            chunks.append(chunk)
+    if request.context and request.context.strip():
+        positions.append(None)
+        chunks.append(ContextChunk(text=request.context))
+    if not chunks:
+        return positions, chunks, None
+    budget = N_CTX - max_tokens - _count_tokens(_build_prompt(request.query, ' '))
+    if CONTEXT_TOKEN_BUDGET > 0:
+        budget = min(budget, CONTEXT_TOKEN_BUDGET)
+    packed = context_packer.pack(request.query, [c.text for c in chunks], max(budget, 0), _count_tokens,
+                                 [_chunk_token_count(c) for c in chunks])
+    return positions, chunks, packed
+
+def _run_llm(prompt: str, max_tokens: int, temperature: float, top_p: float) -> dict:
+    """Потоковая генерация: время до первого токена — обработка промпта, дальше — скорость декодирования"""
+    start = time.perf_counter()
+    first_token_at = None
+    pieces: List[str] = []
+    for chunk in llm(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p, echo=False, stream=True):
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        pieces.append(chunk["choices"][0].get("text", ""))
+    end = time.perf_counter()
+    if first_token_at is not None:
+        _observe('prompt_eval', start, first_token_at - start)
+        _observe('decode', first_token_at, end - first_token_at)
+        if len(pieces) > 1 and end > first_token_at:
+            DECODE_TOKENS_PER_SECOND.observe((len(pieces) - 1) / (end - first_token_at))
+    # В потоковом режиме usage не приходит; каждый чанк — один токен
+    return {"choices": [{"text": "".join(pieces)}], "usage": {"completion_tokens": len(pieces)}}
+
 @app.post("/generate", response_model=GenerateResponse)
 async def generate(request: GenerateRequest):
+    _require('llm')
+    # Лимиты проверяются до генерации: отказ не тратит время модели
+    try:
+        reservation, max_tokens = token_ledger.admit(request.telegram_id, request.department,
+                                                       request.max_tokens or MAX_NEW_TOKENS)
+    except usage_ledger.UsageLimitExceeded as e:
+        USAGE_REJECTED.labels(e.scope).inc()
+        logger.warning(f"Генерация отклонена: {e}")
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={'Retry-After': str(_seconds_to_next_month())})
     try:
-        _reset_usage_if_needed()
         start_time = datetime.now()
-        if request.context:
-            prompt = f"<s>[INST] <<SYS>>\nТы — корпоративный ассистент. Отвечай на вопросы, используя предоставленный контекст.\nЕсли информации в контексте недостаточно, так и скажи. Отвечай кратко и по делу.\n<</SYS>>\n\nКонтекст:\n{request.context}\n\nВопрос: {request.query} [/INST]"
-        else:
-            prompt = f"<s>[INST] <<SYS>>\nТы — корпоративный ассистент. Отвечай на вопросы, используя предоставленный контекст.\nЕсли информации в контексте недостаточно, так и скажи. Отвечай кратко и по делу.\n<</SYS>>\n\nВопрос: {request.query} [/INST]"
-
-        result = llm(
-            prompt,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature,
-            top_p=request.top_p,
-            echo=False
-        )
+        # Токенизация идёт через модель (или сокет inference_server) — в отдельном потоке
+        with _stage('context_pack'):
+            positions, chunks, packed = await asyncio.to_thread(_pack_context, request, max_tokens)
+        context_used = context_dropped = None
+        if packed is not None:
+            CONTEXT_TOKENS.observe(packed.tokens)
+            # Что из найденного не попало в промпт — видно в трассе
+            tracing.annotate(context=packed.summary([
+                c.chunk_id if c.chunk_id is not None else f"#{p}" if p is not None else "context"
+                for p, c in zip(positions, chunks)
+            ]))
+            context_used = [positions[i] for i in packed.used if positions[i] is not None]
+            context_dropped = [positions[i] for i, _ in packed.dropped if positions[i] is not None]
+        if request.require_context and request.context_chunks and not context_used:
+            # Всё найденное выброшено бюджетом — клиент ответит «не найдено», модель не тратим
+            return GenerateResponse(response="", generation_time=0.0, completion_tokens=0,
+                                    context_used=[], context_dropped=context_dropped or [], context_tokens=0)
+        prompt = _build_prompt(request.query, packed.text if packed is not None else "")
+
+        queued_at = time.perf_counter()
+        async with _llm_lock:
+            _observe('queue_wait', queued_at, time.perf_counter() - queued_at)
+            SLOW_CAPTURE.restart()
+            with _stage('generate'):
+                result = await asyncio.to_thread(
+                    _run_llm, prompt, max_tokens, request.temperature, request.top_p
+                )
 
         text = ""
         completion_tokens = None
@@ -298,14 +910,17 @@ async def generate(request: GenerateRequest):
             except Exception:
                 completion_tokens = len(text.split())
 
-        # Учет токенов
-        global monthly_completion_tokens
-        monthly_completion_tokens += int(completion_tokens or 0)
-        ratio = (monthly_completion_tokens / MONTHLY_TOKEN_LIMIT) if MONTHLY_TOKEN_LIMIT else 0.0
+        # Учет токенов: резерв заменяется фактическим расходом
+        token_ledger.record(request.telegram_id, request.department, int(completion_tokens or 0),
+                            tracing.current_trace_id())
+        token_ledger.release(reservation)
+        monthly_usage = token_ledger.month_usage()
+        MONTHLY_COMPLETION_TOKENS.set(monthly_usage)
+        ratio = _usage_ratio(monthly_usage)
         if ratio >= ALERT_THRESHOLD:
             logger.warning(
                 f"Достигнут {int(ratio*100)}% месячного лимита выходных токенов: "
-                f"{monthly_completion_tokens}/{MONTHLY_TOKEN_LIMIT}"
+                f"{monthly_usage}/{MONTHLY_TOKEN_LIMIT}"
             )
 
         generation_time = (datetime.now() - start_time).total_seconds()
@@ -313,30 +928,29 @@ async def generate(request: GenerateRequest):
             response=text,
             generation_time=generation_time,
             completion_tokens=completion_tokens,
-            month_key=token_month_key,
-            monthly_usage=monthly_completion_tokens,
+            month_key=usage_ledger.month_key(),
+            monthly_usage=monthly_usage,
             monthly_limit=MONTHLY_TOKEN_LIMIT,
-            usage_ratio=ratio
+            usage_ratio=ratio,
+            context_used=context_used,
+            context_dropped=context_dropped,
+            context_tokens=packed.tokens if packed is not None else None
         )
     except Exception as e:
         logger.error(f"Ошибка при генерации ответа: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        token_ledger.release(reservation)
 
 @app.post("/embeddings", response_model=EmbeddingResponse)
 async def create_embeddings(request: EmbeddingRequest):
+    _require('embedder')
     try:
         start_time = datetime.now()
-        embeddings = embedding_model.encode(request.texts)
+        with _stage('embed'):
+            embeddings = embedding_model.encode(request.texts)
         embedding_time = (datetime.now() - start_time).total_seconds()
-        
-        # Добавляем отладочную информацию
-        logger.info(f"Создано эмбеддингов: {len(embeddings)}")
-        logger.info(f"Размерность: {embeddings.shape[1] if len(embeddings.shape) > 1 else len(embeddings)}")
-        
-        response = EmbeddingResponse(embeddings=embeddings.tolist(), embedding_time=embedding_time)
-        logger.info(f"Ответ содержит ключ 'embeddings': {'embeddings' in response.dict()}")
-        
-        return response
+        return EmbeddingResponse(embeddings=embeddings.tolist(), embedding_time=embedding_time)
     except Exception as e:
         logger.error(f"Ошибка при создании эмбеддингов: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -349,61 +963,89 @@ async def embed(request: EmbeddingRequest):
 @app.post("/index")
 async def index_docs(req: IndexRequest):
     """Индексация массива документов для гибридного поиска."""
-    global faiss_index, dense_embeddings, bm25_index, bm25_corpus_tokens, corpus_texts
+    global dense_index, dense_embeddings, bm25_index, corpus_texts, chunk_metadata, chunk_token_counts
+    # Индекс с диска ещё грузится — не даём ему затереть новый
+    _require('embedder', 'index')
     try:
-        corpus_texts = [t for t in req.documents if t and t.strip()]
+        metadata = req.metadata if req.metadata and len(req.metadata) == len(req.documents) else [{}] * len(req.documents)
+        pairs = [(t, m) for t, m in zip(req.documents, metadata) if t and t.strip()]
+        corpus_texts = [t for t, _ in pairs]
         if not corpus_texts:
             return {"indexed": 0}
-        # Dense
-        dense_embeddings = embedding_model.encode(corpus_texts, convert_to_numpy=True)
-        dim = dense_embeddings.shape[1]
-        faiss_index = faiss.IndexFlatIP(dim)
-        # нормируем для косинуса
-        norms = np.linalg.norm(dense_embeddings, axis=1, keepdims=True) + 1e-12
-        dense_norm = dense_embeddings / norms
-        faiss_index.add(dense_norm.astype('float32'))
+        chunk_metadata = ChunkMetadataStore([m for _, m in pairs], len(corpus_texts))
+        # Dense: нормируем для косинуса
+        dense_embeddings = shared_index.normalize(embedding_model.encode(corpus_texts, convert_to_numpy=True))
+        dense_index = shared_index.FlatIndex(dense_embeddings)
         # BM25
-        bm25_corpus_tokens = [t.lower().split() for t in corpus_texts]
-        bm25_index = BM25Okapi(bm25_corpus_tokens)
+        bm25_index = shared_index.BM25Index.build([t.lower().split() for t in corpus_texts])
+        # Токены чанков для сборки контекста: считаются один раз здесь, а не на каждый вопрос
+        chunk_token_counts = await asyncio.to_thread(_index_token_counts, corpus_texts)
+        INDEX_CHUNKS.set(len(corpus_texts))
         
-        # Сохраняем индекс на диск
-        await save_index_to_disk()
+        # Сохраняем индекс на диск и переоткрываем через mmap: память освобождается,
+        # а остальные воркеры подхватят новое поколение при следующем запросе
+        if await save_index_to_disk():
+            await asyncio.to_thread(_open_index)
         
         return {"indexed": len(corpus_texts)}
     except Exception as e:
         logger.error(f"Ошибка индексации: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _dense_candidates(q_norm: np.ndarray, k: int, mask: Optional[np.ndarray]) -> List[tuple]:
+    """Dense-кандидаты; при маске отфильтрованные чанки исключаются до выбора топа"""
+    D, I = dense_index.search(q_norm.astype('float32'), k, mask)
+    return [(int(idx), float(score)) for idx, score in zip(I[0], D[0]) if idx >= 0]
+
+def _bm25_candidates(query: str, k: int, mask: Optional[np.ndarray]) -> List[tuple]:
+    """Кандидаты BM25; отфильтрованные чанки исключаются до выбора топа"""
+    bm_scores = bm25_index.get_scores(query.lower().split())
+    if mask is not None:
+        bm_scores = np.where(mask, bm_scores, -np.inf)
+        k = min(k, int(mask.sum()))
+    bm_top = np.argsort(bm_scores)[-k:][::-1] if k > 0 else []
+    return [(int(idx), float(bm_scores[idx])) for idx in bm_top]
+
+def _hit(idx: int, score: float) -> SearchHit:
+    sources = chunk_metadata.sources[idx] if idx < chunk_metadata.size else []
+    return SearchHit(text=corpus_texts[idx], score=score, sources=sources or None, chunk_id=int(idx))
+
 @app.post("/search", response_model=SearchResponse)
 async def search(req: SearchRequest):
     """Гибридный ретривер: BM25 + FAISS, реранкинг косинусом."""
+    _require('embedder', 'index')
+    _refresh_index()
     try:
         if not corpus_texts:
             return SearchResponse(hits=[])
+        mask = chunk_metadata.mask(req.filters)
+        if mask is not None and not mask.any():
+            return SearchResponse(hits=[])
         # Dense кандидаты
-        q_emb = embedding_model.encode([req.query], convert_to_numpy=True)
-        q_norm = q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
-        D, I = faiss_index.search(q_norm.astype('float32'), min(req.top_k*3, len(corpus_texts)))
-        dense_candidates = [(int(idx), float(score)) for idx, score in zip(I[0], D[0]) if idx >= 0]
+        with _stage('query_encode'):
+            q_emb = embedding_model.encode([req.query], convert_to_numpy=True)
+            q_norm = q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
+        with _stage('dense_search'):
+            dense_candidates = _dense_candidates(q_norm, req.top_k*3, mask)
         # BM25 кандидаты
-        bm_scores = bm25_index.get_scores(req.query.lower().split())
-        bm_top = np.argsort(bm_scores)[-req.top_k*3:][::-1]
-        bm_candidates = [(int(idx), float(bm_scores[idx])) for idx in bm_top]
+        with _stage('bm25'):
+            bm_candidates = _bm25_candidates(req.query, req.top_k*3, mask)
         # Слияние
-        combined = {}
-        for idx, sc in dense_candidates:
-            combined[idx] = max(combined.get(idx, 0.0), sc)
-        for idx, sc in bm_candidates:
-            combined[idx] = max(combined.get(idx, 0.0), sc)
+        with _stage('fusion'):
+            combined = {}
+            for idx, sc in dense_candidates:
+                combined[idx] = max(combined.get(idx, 0.0), sc)
+            for idx, sc in bm_candidates:
+                combined[idx] = max(combined.get(idx, 0.0), sc)
         # Реранкинг косинусом на объединённом пуле
-        rerank = []
-        for idx, _ in combined.items():
-            doc_emb = dense_embeddings[idx]
-            score = float(util.cos_sim(q_emb, np.expand_dims(doc_emb, 0))[0][0])
-            rerank.append((idx, score))
-        rerank.sort(key=lambda x: x[1], reverse=True)
-        top_idxs = [idx for idx, _ in rerank[:req.top_k]]
-        hits = [SearchHit(text=corpus_texts[i], score=float([s for j, s in rerank if j==i][0])) for i in top_idxs]
+        with _stage('cosine_rerank'):
+            rerank = []
+            for idx, _ in combined.items():
+                doc_emb = dense_embeddings[idx]
+                score = float(util.cos_sim(q_emb, np.expand_dims(doc_emb, 0))[0][0])
+                rerank.append((idx, score))
+            rerank.sort(key=lambda x: x[1], reverse=True)
+        hits = [_hit(idx, score) for idx, score in rerank[:req.top_k]]
         return SearchResponse(hits=hits)
     except Exception as e:
         logger.error(f"Ошибка поиска: {e}")
@@ -412,39 +1054,50 @@ async def search(req: SearchRequest):
 @app.post("/search_v2", response_model=SearchResponse)
 async def search_v2(req: SearchRequest):
     """Улучшенный поиск с Cross-Encoder переранжированием."""
+    _require('embedder', 'index')
+    _refresh_index()
+    if component_state['cross_encoder']['status'] != 'ready':
+        # Cross-Encoder ещё грузится — отвечаем обычным поиском
+        return await search(req)
     try:
         if not corpus_texts:
             return SearchResponse(hits=[])
+        # Префильтр по метаданным сужает пул кандидатов до скоринга и реранкинга
+        mask = chunk_metadata.mask(req.filters)
+        if mask is not None and not mask.any():
+            return SearchResponse(hits=[])
             
         # 1. Получаем больше кандидатов для переранжирования
         candidates_count = min(req.top_k * 5, len(corpus_texts))
         
         # Dense поиск
-        q_emb = embedding_model.encode([req.query], convert_to_numpy=True)
-        q_norm = q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
-        D, I = faiss_index.search(q_norm.astype('float32'), candidates_count)
-        dense_candidates = [(int(idx), float(score)) for idx, score in zip(I[0], D[0]) if idx >= 0]
+        with _stage('query_encode'):
+            q_emb = embedding_model.encode([req.query], convert_to_numpy=True)
+            q_norm = q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
+        with _stage('dense_search'):
+            dense_candidates = _dense_candidates(q_norm, candidates_count, mask)
         
         # BM25 поиск
-        bm_scores = bm25_index.get_scores(req.query.lower().split())
-        bm_top = np.argsort(bm_scores)[-candidates_count:][::-1]
-        bm_candidates = [(int(idx), float(bm_scores[idx])) for idx in bm_top]
+        with _stage('bm25'):
+            bm_candidates = _bm25_candidates(req.query, candidates_count, mask)
         
         # Объединяем кандидатов
-        combined_scores = {}
-        for idx, score in dense_candidates:
-            combined_scores[idx] = combined_scores.get(idx, 0) + score * 0.7  # вес dense
-        for idx, score in bm_candidates:
-            combined_scores[idx] = combined_scores.get(idx, 0) + score * 0.3  # вес BM25
-            
-        # Берём топ кандидатов для Cross-Encoder
-        top_candidates = sorted(combined_scores.items(), key=lambda x: x[1], reverse=True)[:min(20, len(combined_scores))]
+        with _stage('fusion'):
+            combined_scores = {}
+            for idx, score in dense_candidates:
+                combined_scores[idx] = combined_scores.get(idx, 0) + score * 0.7  # вес dense
+            for idx, score in bm_candidates:
+                combined_scores[idx] = combined_scores.get(idx, 0) + score * 0.3  # вес BM25
+                
+            # Берём топ кандидатов для Cross-Encoder
+            top_candidates = sorted(combined_scores.items(), key=lambda x: x[1], reverse=True)[:min(20, len(combined_scores))]
         
         # 2. Cross-Encoder переранжирование
         candidate_texts = [corpus_texts[idx] for idx, _ in top_candidates]
         query_doc_pairs = [(req.query, doc) for doc in candidate_texts]
         
-        cross_scores = cross_encoder.predict(query_doc_pairs)
+        with _stage('rerank'):
+            cross_scores = cross_encoder.predict(query_doc_pairs)
         
         # 3. Финальное ранжирование по Cross-Encoder скорам
         final_ranking = []
@@ -455,7 +1108,7 @@ async def search_v2(req: SearchRequest):
         
         # Возвращаем топ результатов
         top_results = final_ranking[:req.top_k]
-        hits = [SearchHit(text=corpus_texts[idx], score=score) for idx, score in top_results]
+        hits = [_hit(idx, score) for idx, score in top_results]
         
         return SearchResponse(hits=hits)
         
@@ -464,10 +1117,40 @@ async def search_v2(req: SearchRequest):
         # Fallback на обычный поиск
         return await search(req)
 
+_SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _start_inference_server() -> subprocess.Popen:
+    """LLM для всех воркеров — в отдельном процессе за unix-сокетом"""
+    logger.info(f"Запуск inference_server ({os.environ['LLM_SOCKET_PATH']})...")
+    return subprocess.Popen([sys.executable, os.path.join(_SERVICE_DIR, 'inference_server.py')])
+
+def _start_workers(workers: int) -> subprocess.Popen:
+    """uvicorn с несколькими воркерами в отдельном процессе: воркеры стартуют через spawn и
+    заново импортируют главный модуль, а model_service не должен импортироваться дважды
+    в одном процессе (метрики Prometheus регистрируются при импорте)"""
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='model_service_metrics_')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [_SERVICE_DIR, os.getenv('PYTHONPATH')])))
+    logger.info(f"Запуск {workers} воркеров API...")
+    return subprocess.Popen([sys.executable, '-m', 'uvicorn', 'model_service:app', '--host', '0.0.0.0',
+                             '--port', '8000', '--workers', str(workers)], env=env)
+
 if __name__ == "__main__":
-    uvicorn.run(
-        "model_service:app",
-        host="0.0.0.0",
-        port=8000,
-        workers=1
-    ) 
\ No newline at end of file
+    workers = max(1, MODEL_SERVICE_WORKERS)
+    children: List[subprocess.Popen] = []
+    if workers > 1 or LLM_SOCKET_PATH:
+        # Воркеры — отдельные процессы и читают настройки из окружения
+        os.environ['LLM_SOCKET_PATH'] = LLM_SOCKET_PATH or os.path.join(MODELS_DIR, 'llm.sock')
+        children.append(_start_inference_server())
+    # docker stop и systemd шлют SIGTERM: дочерние процессы останавливаются в finally
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        if workers == 1:
+            uvicorn.run(app, host="0.0.0.0", port=8000)
+        else:
+            children.append(_start_workers(workers))
+            children[-1].wait()
+    finally:
+        for child in reversed(children):
+            child.terminate()
+            child.wait()
@@ -0,0 +1,147 @@
+"""
+Нечёткий индекс ФИО сотрудников (триграммы + Левенштейн) для проверки без обращений к БД
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_NON_LETTERS = re.compile(r"[^\w]+", re.UNICODE)
+# Ограничение на число кандидатов, которые пересчитываются точной метрикой
+_MAX_CANDIDATES = 20
+# Бюджет просмотра постингов: для отбора кандидатов берутся самые редкие триграммы
+_POSTINGS_BUDGET = 2000
+
+
+def name_tokens(text: str) -> List[str]:
+    """Токены ФИО: нижний регистр, Ё→Е, без пунктуации («Иванов И.И.» → иванов, и, и)"""
+    text = (text or "").replace('ё', 'е').replace('Ё', 'Е')
+    tokens: List[str] = []
+    for part in _NON_LETTERS.split(text):
+        if not part:
+            continue
+        # «ИИ» после «Иванов» — слитно записанные инициалы
+        if len(part) == 2 and part.isupper() and tokens:
+            tokens.extend(part.lower())
+        else:
+            tokens.append(part.lower())
+    return tokens
+
+
+def levenshtein(a: str, b: str, max_dist: Optional[int] = None) -> int:
+    """Расстояние Левенштейна; при max_dist счёт обрывается, как только оно превышено"""
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if max_dist is not None and len(a) - len(b) > max_dist:
+        return max_dist + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if max_dist is not None and min(current) > max_dist:
+            return max_dist + 1
+        previous = current
+    return previous[-1]
+
+
+def _ratio(a: str, b: str, min_score: float = 0.0) -> float:
+    if not a and not b:
+        return 1.0
+    longest = max(len(a), len(b))
+    # Эпсилон гасит ошибку округления: (1 - 0.9) * 20 = 1.999…, а допустимы 2 правки
+    max_dist = math.floor((1.0 - min_score) * longest + 1e-9) if min_score > 0 else None
+    dist = levenshtein(a, b, max_dist)
+    if max_dist is not None and dist > max_dist:
+        return 0.0
+    return 1.0 - dist / longest
+
+
+def name_similarity(query: str, candidate: str, min_score: float = 0.0) -> float:
+    """Похожесть ФИО в [0, 1] с учётом Ё/Е, порядка слов и инициалов.
+
+    При min_score > 0 результаты ниже порога не уточняются и возвращаются как 0.
+    """
+    q, c = name_tokens(query), name_tokens(candidate)
+    if not q or not c:
+        return 0.0
+    if len(q) > 1 and all(len(t) == 1 for t in q[1:]):
+        # Фамилия + инициалы: фамилия сравнивается нечётко, инициалы — по первым буквам
+        if len(c) < len(q):
+            return 0.0
+        initials_ok = all(c[i].startswith(q[i]) for i in range(1, len(q)))
+        return _ratio(q[0], c[0], min_score) if initials_ok else 0.0
+    direct = _ratio(' '.join(q), ' '.join(c), min_score)
+    if direct == 1.0:
+        return direct
+    return max(direct, _ratio(' '.join(sorted(q)), ' '.join(sorted(c)), min_score))
+
+
+def _trigrams(tokens: List[str]) -> set:
+    grams = set()
+    for token in tokens:
+        padded = f" {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+    """Триграммный индекс ФИО: отбор кандидатов по общим триграммам, затем точная метрика."""
+
+    def __init__(self):
+        self._items: List[dict] = []
+        self._names: List[str] = []
+        self._postings: Dict[str, List[int]] = {}
+
+    @classmethod
+    def build(cls, items: Iterable[dict], key: str = 'full_name') -> 'NameIndex':
+        index = cls()
+        for item in items:
+            index.add(item.get(key, ''), item)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, name: str, item: dict):
+        pos = len(self._items)
+        self._items.append(item)
+        self._names.append(name)
+        for gram in _trigrams(name_tokens(name)):
+            self._postings.setdefault(gram, []).append(pos)
+
+    def search(self, name: str, limit: int = 5, min_score: float = 0.0) -> List[Tuple[dict, float]]:
+        """Лучшие совпадения (item, score) по убыванию похожести"""
+        tokens = name_tokens(name)
+        if not tokens or not self._items:
+            return []
+        # Для запроса «Фамилия И.О.» кандидатов отбираем по фамилии
+        query_tokens = tokens[:1] if all(len(t) == 1 for t in tokens[1:]) else tokens
+        postings = sorted(
+            (self._postings[g] for g in _trigrams(query_tokens) if g in self._postings), key=len
+        )
+        counts: Counter = Counter()
+        scanned = 0
+        for posting in postings:
+            if scanned and scanned + len(posting) > _POSTINGS_BUDGET:
+                break
+            counts.update(posting)
+            scanned += len(posting)
+        results = []
+        ranked = counts.most_common(_MAX_CANDIDATES)
+        for pos, shared in ranked:
+            # Кандидаты, делящие с лучшим меньше половины триграмм, заведомо далеки
+            if shared * 2 < ranked[0][1]:
+                break
+            score = name_similarity(name, self._names[pos], min_score)
+            if score >= min_score:
+                results.append((self._items[pos], score))
+        results.sort(key=lambda r: r[1], reverse=True)
+        return results[:limit]
+
+    def best(self, name: str, min_score: float) -> Optional[Tuple[dict, float]]:
+        found = self.search(name, limit=1, min_score=min_score)
+        return found[0] if found else None
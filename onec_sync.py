@@ -1,53 +1,92 @@
 import csv
+import hashlib
 import json
 import os
 import re
-from typing import List, Dict
-from redis_client import redis_client
+from typing import Dict, Iterator, List, Optional, Tuple
+from redis_client import get_redis_client
+
+try:
+    import ijson  # потоковый JSON-парсер для больших выгрузок
+except ImportError:  # pragma: no cover - без ijson файл читается целиком
+    ijson = None
 
 UNICODE_SPACES = "\u00A0\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200A\u202F\u205F\u3000"
 
-async def load_employees_from_file(file_path: str) -> List[Dict]:
+# Размер блока при хешировании выгрузки
+_HASH_BLOCK = 1 << 20
+
+def export_fingerprint(file_path: str, previous: Optional[Tuple] = None) -> Optional[Tuple]:
+    """Отпечаток выгрузки (mtime_ns, size, sha256) или None, если файла нет.
+
+    Если mtime и размер совпадают с previous, файл не перечитывается.
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    if previous and previous[0] == st.st_mtime_ns and previous[1] == st.st_size:
+        return previous
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            digest.update(block)
+    return (st.st_mtime_ns, st.st_size, digest.hexdigest())
+
+def export_unchanged(previous: Optional[Tuple], current: Optional[Tuple]) -> bool:
+    """Выгрузка не менялась: совпал хеш (mtime мог обновиться при перезаписи тем же содержимым)"""
+    return bool(previous and current and previous[2] == current[2])
+
+def iter_employees_from_file(file_path: str) -> Iterator[Dict]:
+    """Потоково отдаёт сотрудников из выгрузки 1С, не держа весь файл в памяти"""
     if not os.path.exists(file_path):
-        return []
+        return iter(())
     _, ext = os.path.splitext(file_path.lower())
     if ext == '.csv':
-        return await _load_from_csv(file_path)
+        return _iter_csv(file_path)
     if ext == '.json':
-        return await _load_from_json(file_path)
+        return _iter_json(file_path)
     if ext == '.txt':
-        return await _load_from_txt(file_path)
-    return []
+        return _iter_txt(file_path)
+    return iter(())
 
-async def _load_from_csv(file_path: str) -> List[Dict]:
-    employees: List[Dict] = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            employees.append({
-                'employee_id': row.get('employee_id') or row.get('id') or row.get('tabnum'),
-                'full_name': row.get('full_name') or row.get('fio'),
-                'department': row.get('department') or row.get('dept') or '',
-                'position': row.get('position') or row.get('title') or ''
-            })
-    return [e for e in employees if e.get('employee_id') and e.get('full_name')]
+async def load_employees_from_file(file_path: str) -> List[Dict]:
+    return list(iter_employees_from_file(file_path))
 
-async def _load_from_json(file_path: str) -> List[Dict]:
+def _employee_from_row(row: Dict) -> Optional[Dict]:
+    emp_id = row.get('employee_id') or row.get('id') or row.get('tabnum')
+    full_name = row.get('full_name') or row.get('fio')
+    if not emp_id or not full_name:
+        return None
+    return {
+        'employee_id': str(emp_id),
+        'full_name': full_name,
+        'department': row.get('department') or row.get('dept') or '',
+        'position': row.get('position') or row.get('title') or ''
+    }
+
+def _iter_csv(file_path: str) -> Iterator[Dict]:
     with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    employees: List[Dict] = []
-    if isinstance(data, list):
-        for row in data:
-            employees.append({
-                'employee_id': row.get('employee_id') or row.get('id') or row.get('tabnum'),
-                'full_name': row.get('full_name') or row.get('fio'),
-                'department': row.get('department') or row.get('dept') or '',
-                'position': row.get('position') or row.get('title') or ''
-            })
-    return [e for e in employees if e.get('employee_id') and e.get('full_name')]
+        for row in csv.DictReader(f):
+            emp = _employee_from_row(row)
+            if emp:
+                yield emp
+
+def _iter_json(file_path: str) -> Iterator[Dict]:
+    with open(file_path, 'rb') as f:
+        if ijson is not None:
+            # Потоковый разбор верхнеуровневого массива
+            rows = ijson.items(f, 'item')
+        else:
+            data = json.load(f)
+            rows = data if isinstance(data, list) else []
+        for row in rows:
+            if isinstance(row, dict):
+                emp = _employee_from_row(row)
+                if emp:
+                    yield emp
 
-async def _load_from_txt(file_path: str) -> List[Dict]:
-    employees: List[Dict] = []
+def _iter_txt(file_path: str) -> Iterator[Dict]:
     # Разрешаем табельному буквы/цифры/дефис, минимум одна цифра
     tab_re = re.compile(r"^[0-9A-Za-zА-Яа-яЁё\-]+$")
     trans_table = str.maketrans({c: ' ' for c in UNICODE_SPACES})
@@ -79,20 +118,23 @@ async def _load_from_txt(file_path: str) -> List[Dict]:
             if not tab_re.match(tab) or not any(ch.isdigit() for ch in tab):
                 # если последний токен не похож на табельный — пропускаем
                 continue
-            employees.append({
+            yield {
                 'employee_id': tab,
                 'full_name': name,
                 'department': '',
                 'position': ''
-            })
-    return employees
+            }
 
-async def sync_onec_export_to_redis(file_path: str) -> int:
-    employees = await load_employees_from_file(file_path)
-    if not employees:
-        return 0
+async def sync_onec_export_to_redis(file_path: str, batch_size: int = 1000) -> int:
+    redis_client = get_redis_client()
+    count = 0
     pipe = redis_client.pipeline()
-    for emp in employees:
+    for emp in iter_employees_from_file(file_path):
         pipe.hset('employees_cache', emp['employee_id'], json.dumps(emp, ensure_ascii=False))
-    await pipe.execute()
-    return len(employees) 
\ No newline at end of file
+        count += 1
+        if count % batch_size == 0:
+            await pipe.execute()
+            pipe = redis_client.pipeline()
+    if count % batch_size:
+        await pipe.execute()
+    return count 
\ No newline at end of file
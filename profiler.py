@@ -0,0 +1,218 @@
+"""
+Сэмплирующий профилировщик без зависимостей: стеки всех потоков через sys._current_frames()
+в формате collapsed stacks («поток;функция (файл:строка);... число»), который читают
+flamegraph.pl, speedscope и inferno
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Кадр: (файл, функция, строка); стек — от корня к вершине
+_Stack = Tuple[Tuple[str, str, int], ...]
+
+
+class ProfilerBusy(Exception):
+    """Профилирование по запросу уже идёт"""
+
+
+def _walk(frame, max_depth: int) -> _Stack:
+    stack = []
+    while frame is not None and len(stack) < max_depth:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def format_stack(thread_name: str, stack: _Stack) -> str:
+    return ';'.join([thread_name] + [f"{name} ({os.path.basename(path)}:{line})" for path, name, line in stack])
+
+
+def collapse(samples: Iterable[Tuple[str, _Stack]]) -> str:
+    counts = Counter(format_stack(thread_name, stack) for thread_name, stack in samples)
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+class SamplingProfiler:
+    """Фоновый поток раз в interval снимает стеки всех остальных потоков.
+
+    history=None — копит все сэмплы до stop(); history=N — хранит только последние
+    N секунд (кольцевой режим для постоянного сбора). Повторяющиеся стеки хранятся
+    одним объектом, поэтому память растёт с числом разных путей в коде, а не с частотой.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64, history: Optional[float] = None):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.history = history
+        self._samples: Deque[Tuple[float, str, _Stack]] = deque()
+        self._interned: Dict[_Stack, _Stack] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            batch = []
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = _walk(frame, self.max_depth)
+                batch.append((now, names.get(ident, str(ident)), self._interned.setdefault(stack, stack)))
+            # Не держим кадры до следующего сэмпла
+            frames = frame = None
+            with self._lock:
+                self._samples.extend(batch)
+                if self.history is not None:
+                    cutoff = now - self.history
+                    while self._samples and self._samples[0][0] < cutoff:
+                        self._samples.popleft()
+            if len(self._interned) > 50000:
+                self._interned.clear()
+
+    def samples(self, since: Optional[float] = None, until: Optional[float] = None) -> List[Tuple[str, _Stack]]:
+        """Сэмплы за интервал time.monotonic() [since, until]"""
+        picked = []
+        # Сэмплы упорядочены по времени: идём с конца и копируем только окно, а не всю историю
+        with self._lock:
+            for ts, name, stack in reversed(self._samples):
+                if since is not None and ts < since:
+                    break
+                if until is None or ts <= until:
+                    picked.append((name, stack))
+        picked.reverse()
+        return picked
+
+    def collapsed(self, since: Optional[float] = None, until: Optional[float] = None) -> str:
+        return collapse(self.samples(since, until))
+
+
+# Одновременно идёт не больше одного профилирования по запросу
+_session_lock = threading.Lock()
+
+
+async def profile_for(seconds: float, interval: float = 0.005) -> str:
+    """Профилирует процесс seconds секунд, не блокируя event loop; возвращает collapsed stacks"""
+    if not _session_lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    profiler = SamplingProfiler(interval)
+    try:
+        profiler.start()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        _session_lock.release()
+    return profiler.collapsed()
+
+
+class SlowRequestCapture:
+    """Постоянный редкий сэмплинг; для запросов дольше threshold секунд стеки за время
+    запроса сохраняются в directory/*.folded (хранятся последние keep файлов).
+
+    Сэмплы берутся по всем потокам процесса, так что в профиль попадают и параллельные
+    запросы — имя потока в корне стека помогает их различить. threshold=0 — выключено.
+    Время ожидания в очереди не считается: после получения слота вызывается restart().
+    Профиль собирается и пишется в отдельном потоке, event loop не ждёт диска.
+    """
+
+    def __init__(self, directory: str, threshold: float, interval: float = 0.02,
+                 history: float = 300.0, keep: int = 200):
+        self.directory = directory
+        self.threshold = threshold
+        self.keep = keep
+        self.profiler = SamplingProfiler(interval, history=history)
+        # Начало окна текущего запроса (список, чтобы restart() из дочерней задачи был виден в watch)
+        self._window: contextvars.ContextVar[Optional[List[float]]] = \
+            contextvars.ContextVar(f'slow_window_{id(self)}', default=None)
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def start(self):
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+
+    async def check(self, start: float, label: str) -> Optional[str]:
+        """Сохраняет профиль, если с момента start (time.monotonic()) прошло не меньше threshold"""
+        end = time.monotonic()
+        if self.enabled and self.profiler.running and end - start >= self.threshold:
+            return await asyncio.to_thread(self.save, start, end, label)
+        return None
+
+    def restart(self):
+        """Переносит начало окна текущего запроса на «сейчас» (слот после очереди получен)"""
+        window = self._window.get()
+        if window is not None:
+            window[0] = time.monotonic()
+
+    @asynccontextmanager
+    async def watch(self, label: str):
+        window = [time.monotonic()]
+        token = self._window.set(window)
+        try:
+            yield
+        finally:
+            self._window.reset(token)
+            await self.check(window[0], label)
+
+    def save(self, start: float, end: float, label: str) -> Optional[str]:
+        try:
+            text = self.profiler.collapsed(start, end)
+            if not text:
+                return None
+            safe = re.sub(r'[^\w\-]+', '_', label).strip('_') or 'request'
+            name = f"{datetime.now():%Y%m%d-%H%M%S}_{safe}_{int((end - start) * 1000)}ms.folded"
+            path = os.path.join(self.directory, name)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            self._prune()
+            logger.warning(f"Медленный запрос {label}: {end - start:.1f} с, профиль {path}")
+            return path
+        except Exception as e:
+            logger.error(f"Ошибка сохранения профиля медленного запроса: {e}")
+            return None
+
+    def _prune(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith('.folded'))
+        for name in files[:-self.keep] if len(files) > self.keep else []:
+            os.remove(os.path.join(self.directory, name))
@@ -4,16 +4,122 @@
 """
 
 import asyncio
+import logging
 import time
-from typing import Optional, Callable
+from collections import OrderedDict
+from typing import Dict, Optional, Callable, Set, Tuple
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 
+logger = logging.getLogger(__name__)
+
+class EditScheduler:
+    """Единая очередь правок сообщений с ограничением частоты.
+
+    Для каждого сообщения хранится только последний ожидающий текст — промежуточные
+    кадры прогресса выбрасываются. Правки одного чата идут не чаще раза в
+    per_chat_interval секунд, всех чатов — не чаще global_rate в секунду. На 429
+    (retry_after) отправка приостанавливается, последний текст остаётся в очереди.
+    submit() не ждёт сети, поэтому обработка вопроса не тормозит на прогрессе.
+    """
+
+    def __init__(self, bot: Bot, per_chat_interval: float = 1.0, global_rate: float = 25.0):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self._pending: "OrderedDict[Tuple[int, int], Tuple[str, Optional[str]]]" = OrderedDict()
+        self._in_flight: Set[Tuple[int, int]] = set()
+        self._chat_ready_at: Dict[int, float] = {}
+        self._global_ready_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.dropped_frames = 0
+
+    def submit(self, chat_id: int, message_id: int, text: str, parse_mode: Optional[str] = "HTML"):
+        """Ставит правку; более ранний неотправленный текст того же сообщения заменяется."""
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.dropped_frames += 1
+        # Перезапись существующего ключа сохраняет его место в очереди
+        self._pending[key] = (text, parse_mode)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _next_ready(self, now: float) -> Tuple[Optional[Tuple[int, int]], float]:
+        """Первое в очереди сообщение, чей чат свободен, либо время, когда освободится ближайший."""
+        wait = None
+        for key in self._pending:
+            if key in self._in_flight:
+                continue
+            ready_at = self._chat_ready_at.get(key[0], 0.0)
+            if ready_at <= now:
+                return key, 0.0
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait if wait is not None else -1.0
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            if self._global_ready_at > now:
+                await asyncio.sleep(self._global_ready_at - now)
+                continue
+            key, wait = self._next_ready(now)
+            if key is None:
+                try:
+                    # wait < 0 — очередь пуста, ждём новых правок
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait if wait >= 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            text, parse_mode = self._pending.pop(key)
+            self._in_flight.add(key)
+            self._chat_ready_at[key[0]] = now + self.per_chat_interval
+            self._global_ready_at = now + self.global_interval
+            asyncio.create_task(self._send(key, text, parse_mode))
+
+    async def _send(self, key: Tuple[int, int], text: str, parse_mode: Optional[str]):
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode=parse_mode)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль: ждём сколько сказал Telegram; более новый текст, если пришёл, важнее
+            pause_until = time.monotonic() + e.retry_after
+            self._chat_ready_at[chat_id] = pause_until
+            self._global_ready_at = max(self._global_ready_at, pause_until)
+            self._pending.setdefault(key, (text, parse_mode))
+            logger.warning(f"Флуд-контроль Telegram: пауза правок {e.retry_after} сек")
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                logger.error(f"Ошибка правки сообщения {message_id}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка правки сообщения {message_id}: {e}")
+        finally:
+            self._in_flight.discard(key)
+            self._wakeup.set()
+
+    async def close(self, timeout: float = 5.0):
+        """Пытается дослать очередь за timeout секунд и останавливает отправку."""
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
 class ProgressBar:
     """Класс для создания и обновления прогресс-баров"""
     
-    def __init__(self, bot: Bot, chat_id: int, message_id: Optional[int] = None):
+    def __init__(self, bot: Bot, chat_id: int, message_id: Optional[int] = None,
+                 scheduler: Optional[EditScheduler] = None):
         self.bot = bot
+        self.scheduler = scheduler
         self.chat_id = chat_id
         self.message_id = message_id
         self.start_time = time.time()
@@ -36,6 +142,17 @@ class ProgressBar:
         self.message_id = message.message_id
         return self.message_id
     
+    async def _edit(self, text: str):
+        if self.scheduler is not None:
+            self.scheduler.submit(self.chat_id, self.message_id, text, "HTML")
+            return
+        await self.bot.edit_message_text(
+            chat_id=self.chat_id,
+            message_id=self.message_id,
+            text=text,
+            parse_mode="HTML"
+        )
+    
     async def update(self, progress: float, text: str = None) -> bool:
         """Обновляет прогресс-бар"""
         if not self.is_active or not self.message_id:
@@ -44,12 +161,7 @@ class ProgressBar:
         try:
             progress_text = self._create_progress_text(text or "🤖 Генерирую ответ...", progress)
             
-            await self.bot.edit_message_text(
-                chat_id=self.chat_id,
-                message_id=self.message_id,
-                text=progress_text,
-                parse_mode="HTML"
-            )
+            await self._edit(progress_text)
             return True
         except Exception as e:
             print(f"Ошибка обновления прогресс-бара: {e}")
@@ -71,12 +183,7 @@ class ProgressBar:
 🎯 Статус: Завершено
             """.strip()
             
-            await self.bot.edit_message_text(
-                chat_id=self.chat_id,
-                message_id=self.message_id,
-                text=final_message,
-                parse_mode="HTML"
-            )
+            await self._edit(final_message)
             
             self.is_active = False
             return True
@@ -99,12 +206,7 @@ class ProgressBar:
 🎯 Статус: Ошибка
             """.strip()
             
-            await self.bot.edit_message_text(
-                chat_id=self.chat_id,
-                message_id=self.message_id,
-                text=error_message,
-                parse_mode="HTML"
-            )
+            await self._edit(error_message)
             
             self.is_active = False
             return True
@@ -152,9 +254,11 @@ class ProgressBar:
 class ProgressManager:
     """Менеджер для управления прогресс-барами"""
     
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, per_chat_interval: float = 1.0, global_rate: float = 25.0):
         self.bot = bot
         self.active_bars = {}
+        # Все правки прогресса идут через общую очередь с ограничением частоты
+        self.scheduler = EditScheduler(bot, per_chat_interval, global_rate)
     
     async def start_progress(self, chat_id: int, text: str = "🤖 Генерирую ответ...") -> int:
         """Запускает новый прогресс-бар"""
@@ -162,7 +266,7 @@ class ProgressManager:
         await self.stop_progress(chat_id)
         
         # Создаем новый
-        progress_bar = ProgressBar(self.bot, chat_id)
+        progress_bar = ProgressBar(self.bot, chat_id, scheduler=self.scheduler)
         message_id = await progress_bar.start(text)
         
         self.active_bars[chat_id] = progress_bar
@@ -195,6 +299,10 @@ class ProgressManager:
             del self.active_bars[chat_id]
         return success
     
+    async def close(self):
+        """Досылает ожидающие правки (вызывается при остановке бота)."""
+        await self.scheduler.close()
+    
     async def stop_progress(self, chat_id: int) -> bool:
         """Останавливает прогресс-бар"""
         if chat_id not in self.active_bars:
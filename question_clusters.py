@@ -0,0 +1,75 @@
+"""
+Группировка неотвеченных вопросов по смыслу (эмбеддинги + косинусная близость)
+"""
+
+import math
+import operator
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+def normalize(vector: Sequence[float]) -> array:
+    """Единичный вектор float32 (нулевой возвращается как есть)"""
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        return array('f', vector)
+    return array('f', (x / norm for x in vector))
+
+
+def cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    """Косинус для уже нормированных векторов"""
+    return sum(map(operator.mul, a, b))
+
+
+class QuestionCluster:
+    """Кластер формулировок: нормированный центроид и число вопросов в нём."""
+
+    __slots__ = ('id', 'centroid', 'size', 'representative', 'dirty')
+
+    def __init__(self, cluster_id: Optional[int], centroid: array, size: int, representative: str):
+        self.id = cluster_id
+        self.centroid = centroid
+        self.size = size
+        self.representative = representative
+        self.dirty = False
+
+    @classmethod
+    def from_row(cls, cluster_id: int, centroid: bytes, size: int, representative: str) -> 'QuestionCluster':
+        vector = array('f')
+        vector.frombytes(centroid)
+        return cls(cluster_id, vector, size, representative)
+
+    def add(self, vector: array):
+        # Скользящее среднее с перенормировкой: центроид остаётся единичным
+        weight = self.size
+        self.centroid = normalize([(c * weight + v) / (weight + 1) for c, v in zip(self.centroid, vector)])
+        self.size += 1
+        self.dirty = True
+
+
+def assign_clusters(clusters: List[QuestionCluster], questions: List[Tuple[int, str]],
+                    embeddings: List[List[float]], threshold: float) -> Dict[int, QuestionCluster]:
+    """Относит каждый вопрос к ближайшему кластеру с косинусом ≥ threshold или открывает новый.
+
+    clusters дополняется новыми кластерами (id=None), у изменённых выставляется dirty.
+    Возвращает {id вопроса: кластер}.
+    """
+    assignments: Dict[int, QuestionCluster] = {}
+    for (question_id, text), embedding in zip(questions, embeddings):
+        vector = normalize(embedding)
+        best, best_score = None, threshold
+        for cluster in clusters:
+            if len(cluster.centroid) != len(vector):
+                # Эмбеддер сменился — старые центроиды несравнимы
+                continue
+            score = cosine(cluster.centroid, vector)
+            if score >= best_score:
+                best, best_score = cluster, score
+        if best is None:
+            best = QuestionCluster(None, vector, 1, text)
+            best.dirty = True
+            clusters.append(best)
+        else:
+            best.add(vector)
+        assignments[question_id] = best
+    return assignments
@@ -0,0 +1,156 @@
+"""
+Очередь вопросов к модели: лимит на пользователя, общий лимит одновременных
+генераций и справедливый порядок между пользователями
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+class QuestionRejected(Exception):
+    """Вопрос не будет обработан: reason — 'limit', 'cancelled' или 'expired'."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Ticket:
+    __slots__ = ('user_id', 'tag', 'seq', 'enqueued_at', 'future', 'cancelled')
+
+    def __init__(self, user_id: int, tag: float, seq: int, future: asyncio.Future):
+        self.user_id = user_id
+        self.tag = tag
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.future = future
+        self.cancelled = False
+
+    def __lt__(self, other: '_Ticket') -> bool:
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+
+class QuestionScheduler:
+    """Взвешенная справедливая очередь (WFQ) перед поиском и генерацией.
+
+    Каждый вопрос получает виртуальную метку max(текущее время, метка прошлого вопроса
+    пользователя) + 1/вес — так серия вопросов одного пользователя не обгоняет
+    остальных, а пользователь с весом 2 получает вдвое больше слотов. Одновременно
+    выполняется не больше max_concurrent вопросов, у пользователя не больше
+    per_user_limit ожидающих и выполняемых. Отменённые и прождавшие дольше max_wait
+    вопросы снимаются, не дойдя до модели.
+    """
+
+    def __init__(self, max_concurrent: int, per_user_limit: int, max_wait: float,
+                 weight: Optional[Callable[[int], float]] = None, position_interval: float = 2.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_user_limit = max(1, per_user_limit)
+        self.max_wait = max_wait
+        self.weight = weight or (lambda user_id: 1.0)
+        self.position_interval = position_interval
+        self._queue: List[_Ticket] = []
+        self._running = 0
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._user_tag: Dict[int, float] = {}
+        self._outstanding: Dict[int, int] = {}
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for t in self._queue if not t.cancelled)
+
+    def position(self, ticket: _Ticket) -> int:
+        """Место в очереди, начиная с 1"""
+        return 1 + sum(1 for t in self._queue if not t.cancelled and t < ticket)
+
+    def cancel_user(self, user_id: int) -> int:
+        """Снимает ожидающие вопросы пользователя (например, по /cancel)"""
+        cancelled = 0
+        for ticket in self._queue:
+            if ticket.user_id == user_id and not ticket.cancelled:
+                self._reject(ticket, 'cancelled')
+                cancelled += 1
+        return cancelled
+
+    def _reject(self, ticket: _Ticket, reason: str):
+        ticket.cancelled = True
+        if not ticket.future.done():
+            ticket.future.set_exception(QuestionRejected(reason))
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent and self._queue:
+            ticket = heapq.heappop(self._queue)
+            if ticket.cancelled:
+                continue
+            if self.max_wait and time.monotonic() - ticket.enqueued_at > self.max_wait:
+                self._reject(ticket, 'expired')
+                continue
+            self._running += 1
+            self._vtime = max(self._vtime, ticket.tag)
+            ticket.future.set_result(None)
+
+    def _release_user(self, user_id: int):
+        left = self._outstanding.get(user_id, 1) - 1
+        if left > 0:
+            self._outstanding[user_id] = left
+            return
+        self._outstanding.pop(user_id, None)
+        # Метка ушедшего пользователя не нужна: следующий его вопрос начнёт с текущего времени
+        if self._user_tag.get(user_id, 0.0) <= self._vtime:
+            self._user_tag.pop(user_id, None)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_position: Optional[Callable[[int], Awaitable]] = None):
+        """Ждёт очереди и держит слот на время блока.
+
+        on_position(n) вызывается, пока вопрос стоит в очереди и его место меняется.
+        """
+        if self._outstanding.get(user_id, 0) >= self.per_user_limit:
+            raise QuestionRejected('limit')
+        self._outstanding[user_id] = self._outstanding.get(user_id, 0) + 1
+        granted = False
+        ticket = None
+        try:
+            tag = max(self._vtime, self._user_tag.get(user_id, 0.0)) + 1.0 / max(self.weight(user_id), 1e-6)
+            self._user_tag[user_id] = tag
+            ticket = _Ticket(user_id, tag, next(self._seq), asyncio.get_running_loop().create_future())
+            heapq.heappush(self._queue, ticket)
+            self._dispatch()
+            last_position = None
+            while not ticket.future.done():
+                if self.max_wait and time.monotonic() - ticket.enqueued_at > self.max_wait:
+                    self._reject(ticket, 'expired')
+                    break
+                position = self.position(ticket)
+                if on_position is not None and position != last_position:
+                    last_position = position
+                    await on_position(position)
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.future), timeout=self.position_interval)
+                except asyncio.TimeoutError:
+                    pass
+                except QuestionRejected:
+                    break
+            ticket.future.result()
+            granted = True
+            yield
+        finally:
+            if ticket is not None and not ticket.future.done():
+                # Обработчик отменён, пока ждал
+                self._reject(ticket, 'cancelled')
+            if ticket is not None and not granted and ticket.future.done() and not ticket.future.cancelled() \
+                    and ticket.future.exception() is None:
+                # Слот выдан, но до блока дело не дошло
+                granted = True
+            if granted:
+                self._running -= 1
+            self._release_user(user_id)
+            self._dispatch()
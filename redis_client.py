@@ -1,5 +1,16 @@
-import redis.asyncio as redis
+from functools import lru_cache
 from config import REDIS_URL
 
-# Singletons for async usage across the app
-redis_client = redis.from_url(REDIS_URL, decode_responses=True) 
\ No newline at end of file
+
+@lru_cache(maxsize=None)
+def get_redis_client():
+    """Общий клиент Redis; пакет redis импортируется при первом обращении, а не при старте бота"""
+    import redis.asyncio as redis
+    return redis.from_url(REDIS_URL, decode_responses=True)
+
+
+def __getattr__(name: str):
+    # Совместимость со старым from redis_client import redis_client
+    if name == 'redis_client':
+        return get_redis_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
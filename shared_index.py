@@ -0,0 +1,366 @@
+"""
+Поисковый индекс model_service в виде файлов .npy, открываемых через mmap.
+
+Все воркеры сервиса читают одни и те же страницы из page cache, поэтому память под
+индекс не умножается на число процессов. Каталог индекса:
+
+  meta.json             — поколение, модель эмбеддингов, размер корпуса и прочие сведения
+  <имя>.npy             — массивы (векторы, BM25 в виде CSR, колонки метаданных)
+  <имя>.bin, .idx.npy   — строки (тексты чанков, источники) одним UTF-8 блобом со смещениями
+
+Каталог индекса — символическая ссылка на каталог поколения `<каталог>.gen-<поколение>`.
+Запись идёт во временный каталог, который переименовывается в каталог поколения, после
+чего ссылка подменяется одним os.replace: читатель видит либо старое, либо новое поколение
+целиком. Писатели (воркеры с /index, перевод старого pickle при старте) сериализуются
+блокировкой fcntl на файле `<каталог>.lock`. Предыдущее поколение хранится до следующей
+записи: открытые mmap старых файлов остаются валидными, пока их держат читатели.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import math
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+META_FILE = 'meta.json'
+
+
+def _term_hash(term: str) -> int:
+    # Встроенный hash() строк отличается между процессами — нужен стабильный
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class TextColumn:
+    """Список строк поверх mmap: UTF-8 блоб и массив смещений int64 (N + 1)"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    @staticmethod
+    def write(directory: str, name: str, texts: Sequence[str]):
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        with open(os.path.join(directory, f'{name}.bin'), 'wb') as f:
+            position = 0
+            for i, text in enumerate(texts):
+                data = text.encode('utf-8')
+                f.write(data)
+                position += len(data)
+                offsets[i + 1] = position
+        np.save(os.path.join(directory, f'{name}.idx.npy'), offsets)
+
+    @classmethod
+    def open(cls, directory: str, name: str) -> 'TextColumn':
+        offsets = np.load(os.path.join(directory, f'{name}.idx.npy'), mmap_mode='r')
+        path = os.path.join(directory, f'{name}.bin')
+        # np.memmap не умеет файлы нулевой длины
+        blob = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else np.zeros(0, dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._blob[int(self._offsets[i]):int(self._offsets[i + 1])].tobytes().decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ListColumn:
+    """Список списков строк (например, источники чанка) поверх TextColumn"""
+
+    SEPARATOR = '\x1f'
+
+    def __init__(self, column: TextColumn):
+        self._column = column
+
+    @classmethod
+    def write(cls, directory: str, name: str, rows: Sequence[Sequence[str]]):
+        TextColumn.write(directory, name, [cls.SEPARATOR.join(row) for row in rows])
+
+    @classmethod
+    def open(cls, directory: str, name: str) -> 'ListColumn':
+        return cls(TextColumn.open(directory, name))
+
+    def __len__(self) -> int:
+        return len(self._column)
+
+    def __getitem__(self, i: int) -> List[str]:
+        value = self._column[i]
+        return value.split(self.SEPARATOR) if value else []
+
+
+class FlatIndex:
+    """Точный поиск по скалярному произведению (как faiss.IndexFlatIP) над нормированными
+    векторами; векторы могут быть np.memmap — тогда индекс общий для всех процессов."""
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.vectors)
+
+    def search(self, queries: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(скоры, индексы) формы (число запросов, k); недостающие позиции — индекс -1"""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, self.ntotal)
+        distances = np.full((len(queries), max(k, 0)), -np.inf, dtype=np.float32)
+        labels = np.full((len(queries), max(k, 0)), -1, dtype=np.int64)
+        if k <= 0:
+            return distances, labels
+        scores = queries @ self.vectors.T
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for row in range(len(queries)):
+            ids = top[row][np.argsort(-scores[row, top[row]], kind='stable')]
+            found = ids[np.isfinite(scores[row, ids])]
+            distances[row, :len(found)] = scores[row, found]
+            labels[row, :len(found)] = found
+        return distances, labels
+
+
+class BM25Index:
+    """BM25 Okapi с теми же формулами, что rank_bm25.BM25Okapi (k1, b, epsilon для
+    отрицательных idf), но постинги хранятся в CSR-массивах: скор считается только
+    по документам, где встречается терм, а массивы можно открыть через mmap."""
+
+    ARRAYS = ('term_hashes', 'term_offsets', 'postings_docs', 'postings_tf', 'idf', 'doc_len')
+
+    def __init__(self, arrays: Dict[str, np.ndarray], avgdl: float, k1: float = 1.5, b: float = 0.75):
+        self.term_hashes = arrays['term_hashes']
+        self.term_offsets = arrays['term_offsets']
+        self.postings_docs = arrays['postings_docs']
+        self.postings_tf = arrays['postings_tf']
+        self.idf = arrays['idf']
+        self.doc_len = arrays['doc_len']
+        self.avgdl = avgdl
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def build(cls, corpus: Sequence[Sequence[str]], k1: float = 1.5, b: float = 0.75,
+              epsilon: float = 0.25) -> 'BM25Index':
+        vocab: Dict[str, int] = {}
+        terms, docs, tfs = array('q'), array('i'), array('i')
+        doc_len = np.zeros(len(corpus), dtype=np.int32)
+        for doc_id, tokens in enumerate(corpus):
+            doc_len[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                terms.append(vocab.setdefault(term, len(vocab)))
+                docs.append(doc_id)
+                tfs.append(tf)
+        terms_np = np.frombuffer(terms, dtype=np.int64) if terms else np.zeros(0, dtype=np.int64)
+        hashes = np.fromiter((_term_hash(t) for t in vocab), dtype=np.uint64, count=len(vocab))
+        # Термы упорядочены по хешу: поиск терма запроса — np.searchsorted
+        by_hash = np.argsort(hashes, kind='stable')
+        rank = np.empty_like(by_hash)
+        rank[by_hash] = np.arange(len(by_hash))
+        term_rank = rank[terms_np]
+        order = np.argsort(term_rank, kind='stable')
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_rank, minlength=len(vocab)), out=offsets[1:])
+
+        # idf считается как в rank_bm25 (math.log, сумма по словарю в порядке появления),
+        # чтобы скоры совпадали с прежним индексом
+        corpus_size = len(corpus)
+        doc_freq = np.bincount(terms_np, minlength=len(vocab)).tolist()
+        idf_list = [math.log(corpus_size - n + 0.5) - math.log(n + 0.5) for n in doc_freq]
+        if idf_list:
+            eps = epsilon * (sum(idf_list) / len(idf_list))
+            idf_list = [eps if v < 0 else v for v in idf_list]
+        idf = np.array(idf_list, dtype=np.float64)[by_hash]
+        arrays = {
+            'term_hashes': hashes[by_hash],
+            'term_offsets': offsets,
+            'postings_docs': np.frombuffer(docs, dtype=np.int32)[order] if docs else np.zeros(0, dtype=np.int32),
+            'postings_tf': np.frombuffer(tfs, dtype=np.int32)[order] if tfs else np.zeros(0, dtype=np.int32),
+            'idf': idf,
+            'doc_len': doc_len,
+        }
+        avgdl = float(doc_len.sum()) / corpus_size if corpus_size else 0.0
+        return cls(arrays, avgdl, k1, b)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def params(self) -> Dict[str, float]:
+        return {'avgdl': self.avgdl, 'k1': self.k1, 'b': self.b}
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        scores = np.zeros(len(self.doc_len))
+        if not len(self.term_hashes) or not self.avgdl:
+            return scores
+        for term in query:
+            h = np.uint64(_term_hash(term))
+            i = int(np.searchsorted(self.term_hashes, h))
+            if i >= len(self.term_hashes) or self.term_hashes[i] != h:
+                continue
+            start, end = int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end].astype(np.float64)
+            dl = self.doc_len[docs].astype(np.float64)
+            scores[docs] += float(self.idf[i]) * (tf * (self.k1 + 1) /
+                                                  (tf + self.k1 * (1 - self.b + self.b * dl / self.avgdl)))
+        return scores
+
+
+class IndexFiles:
+    """Открытый каталог индекса: сведения из meta.json, массивы и строки через mmap"""
+
+    def __init__(self, path: str, info: Dict[str, Any]):
+        self.path = path
+        self.info = info
+
+    @property
+    def generation(self) -> int:
+        return int(self.info.get('generation', 0))
+
+    def array(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def has_array(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.path, f'{name}.npy'))
+
+    def texts(self, name: str) -> TextColumn:
+        return TextColumn.open(self.path, name)
+
+    def lists(self, name: str) -> ListColumn:
+        return ListColumn.open(self.path, name)
+
+
+def read_generation(path: str) -> Optional[int]:
+    """Поколение индекса на диске (None — индекса нет); дёшево, можно звать на каждый запрос"""
+    try:
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            return int(json.load(f).get('generation', 0))
+    except (OSError, ValueError):
+        return None
+
+
+def open_index(path: str) -> Optional[IndexFiles]:
+    # Ссылка разрешается один раз: все массивы берутся из одного поколения, даже если его подменят
+    real = os.path.realpath(path)
+    try:
+        with open(os.path.join(real, META_FILE), encoding='utf-8') as f:
+            info = json.load(f)
+    except OSError:
+        return None
+    return IndexFiles(real, info)
+
+
+@contextmanager
+def index_lock(path: str):
+    """Эксклюзивная блокировка писателей индекса между процессами (не реентерабельна)"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f'{path}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _point_to(path: str, target: str):
+    """Атомарно направляет ссылку path на каталог target"""
+    link = f'{path}.link-{os.getpid()}'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(target), link)
+    os.replace(link, path)
+
+
+def _generation_dirs(path: str) -> List[str]:
+    """Полные (с meta.json) каталоги поколений, от старых к новым"""
+    dirs = [d for d in glob.glob(f'{glob.escape(path)}.gen-*') if os.path.exists(os.path.join(d, META_FILE))]
+    return sorted(dirs, key=lambda d: read_generation(d) or 0)
+
+
+def recover(path: str):
+    """Приводит каталог индекса к виду «ссылка на поколение»; вызывать под index_lock.
+
+    Обычный каталог прежнего формата переименовывается в каталог поколения. Если ссылки
+    нет (сбой посреди замены в старой версии оставил только `<каталог>.old-*`), она
+    восстанавливается на самое новое полное поколение.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        generation = read_generation(path)
+        if generation is None:
+            return
+        os.rename(path, f'{path}.gen-{generation}')
+    if os.path.exists(path):
+        return
+    for old in glob.glob(f'{glob.escape(path)}.old-*'):
+        generation = read_generation(old)
+        if generation is not None and not os.path.exists(f'{path}.gen-{generation}'):
+            os.rename(old, f'{path}.gen-{generation}')
+    dirs = _generation_dirs(path)
+    if dirs:
+        _point_to(path, dirs[-1])
+
+
+def _cleanup(path: str, keep: int = 2):
+    """Удаляет недописанные каталоги и поколения старше keep последних; вызывать под index_lock"""
+    current = os.path.realpath(path)
+    for stale in glob.glob(f'{glob.escape(path)}.tmp-*') + glob.glob(f'{glob.escape(path)}.old-*'):
+        shutil.rmtree(stale, ignore_errors=True)
+    dirs = [d for d in _generation_dirs(path) if os.path.realpath(d) != current]
+    for old in dirs[:max(0, len(dirs) - (keep - 1))]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def write_index(path: str, info: Dict[str, Any], arrays: Dict[str, np.ndarray],
+                texts: Optional[Dict[str, Sequence[str]]] = None,
+                lists: Optional[Dict[str, Sequence[Sequence[str]]]] = None) -> int:
+    """Пишет новое поколение индекса и атомарно переключает на него ссылку; возвращает поколение.
+
+    Вызывать под index_lock(path).
+    """
+    recover(path)
+    generation = time.time_ns()
+    tmp = f'{path}.tmp-{os.getpid()}-{generation}'
+    target = f'{path}.gen-{generation}'
+    os.makedirs(tmp)
+    try:
+        for name, value in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), np.ascontiguousarray(value))
+        for name, rows in (texts or {}).items():
+            TextColumn.write(tmp, name, rows)
+        for name, rows in (lists or {}).items():
+            ListColumn.write(tmp, name, rows)
+        with open(os.path.join(tmp, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(dict(info, generation=generation), f, ensure_ascii=False, default=str)
+        os.rename(tmp, target)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    _point_to(path, target)
+    _cleanup(path)
+    return generation
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+
+def disk_bytes(path: str) -> int:
+    """Размер текущего поколения индекса"""
+    path = os.path.realpath(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) if os.path.isdir(path) else 0
@@ -0,0 +1,238 @@
+"""
+Хранилище сессий бота (авторизация, шаги диалога, попытки регистрации), общее для реплик.
+
+Бэкенды: память процесса, SQLite (общий файл БД), Redis. Чтение идёт через локальный
+near-cache; об изменениях реплики оповещают друг друга через pub/sub (Redis), для
+SQLite устаревание ограничено TTL near-cache.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Iterable, Optional
+
+from state_store import TTLStore
+
+logger = logging.getLogger(__name__)
+
+# Отличает «в кэше лежит отсутствие значения» от промаха кэша
+_ABSENT = object()
+
+
+class StateBackend(ABC):
+    """Хранилище JSON-значений по (namespace, key) с необязательным TTL в секундах."""
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[int] = None):
+        ...
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: str):
+        ...
+
+    def start(self):
+        """Запускает фоновые задачи бэкенда (подписку на инвалидации), если они есть."""
+        return None
+
+    async def listen_invalidations(self, callback: Callable[[str], None]):
+        """Вызывает callback(сообщение) на каждое изменение в других репликах; по умолчанию не поддерживается."""
+        return None
+
+    async def publish_invalidation(self, message: str):
+        return None
+
+    async def purge_expired(self) -> int:
+        return 0
+
+    async def close(self):
+        return None
+
+
+class MemoryStateBackend(StateBackend):
+    """Состояние в памяти процесса (одна реплика, сбрасывается при перезапуске)."""
+
+    def __init__(self, max_size: Optional[int] = None, unbounded: Iterable[str] = ()):
+        self.max_size = max_size
+        self.unbounded = set(unbounded)
+        self._stores = {}
+
+    def _store(self, namespace: str) -> TTLStore:
+        store = self._stores.get(namespace)
+        if store is None:
+            max_size = None if namespace in self.unbounded else self.max_size
+            store = self._stores[namespace] = TTLStore(f'state:{namespace}', max_size=max_size)
+        return store
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return self._store(namespace).get(key)
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[int] = None):
+        self._store(namespace).set(key, value, ttl)
+
+    async def delete(self, namespace: str, key: str):
+        self._store(namespace).pop(key, None)
+
+    async def purge_expired(self) -> int:
+        return sum(store.sweep() for store in self._stores.values())
+
+
+class SQLiteStateBackend(StateBackend):
+    """Состояние в таблице bot_state основной SQLite БД (реплики на одном хосте)."""
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        from database import state_get
+        raw = await state_get(namespace, key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[int] = None):
+        from database import state_set
+        expires_at = time.time() + ttl if ttl else None
+        await state_set(namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+
+    async def delete(self, namespace: str, key: str):
+        from database import state_delete
+        await state_delete(namespace, key)
+
+    async def purge_expired(self) -> int:
+        from database import state_purge_expired
+        return await state_purge_expired()
+
+
+class RedisStateBackend(StateBackend):
+    """Состояние в Redis; client можно передать явно (например, fakeredis для тестов)."""
+
+    def __init__(self, client=None, prefix: str = 'tgbot'):
+        if client is None:
+            from redis_client import get_redis_client
+            client = get_redis_client()
+        self.client = client
+        self.prefix = prefix
+        self.channel = f"{prefix}:state:invalidate"
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:state:{namespace}:{key}"
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        raw = await self.client.get(self._key(namespace, key))
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[int] = None):
+        await self.client.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False), ex=ttl or None)
+
+    async def delete(self, namespace: str, key: str):
+        await self.client.delete(self._key(namespace, key))
+
+    async def publish_invalidation(self, message: str):
+        await self.client.publish(self.channel, message)
+
+    async def listen_invalidations(self, callback: Callable[[str], None]):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.channel)
+        try:
+            async for message in pubsub.listen():
+                if message.get('type') != 'message':
+                    continue
+                data = message['data']
+                callback(data.decode('utf-8') if isinstance(data, bytes) else data)
+        finally:
+            await pubsub.unsubscribe(self.channel)
+
+    async def close(self):
+        await self.client.close()
+
+
+class CachedStateBackend(StateBackend):
+    """Near-cache поверх общего бэкенда.
+
+    Записи идут сквозь кэш в бэкенд, после чего остальным репликам рассылается
+    инвалидация. Свои же сообщения узнаются по origin и игнорируются. Без pub/sub
+    (SQLite) чужие изменения видны не позже чем через cache_ttl секунд.
+    """
+
+    def __init__(self, backend: StateBackend, cache_ttl: float = 30, max_size: Optional[int] = None):
+        self.backend = backend
+        self.origin = uuid.uuid4().hex[:12]
+        self._cache = TTLStore('state_near_cache', ttl=cache_ttl, max_size=max_size)
+        self._listener: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _cache_key(namespace: str, key: str) -> str:
+        return f"{namespace}|{key}"
+
+    def _on_invalidation(self, message: str):
+        origin, _, cache_key = message.partition(' ')
+        if origin != self.origin:
+            self._cache.pop(cache_key, None)
+
+    async def _listen(self):
+        while True:
+            try:
+                await self.backend.listen_invalidations(self._on_invalidation)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Пока подписка потеряна, кэш мог пропустить изменения — сбрасываем его
+                logger.error(f"Подписка на инвалидации состояния прервана: {e}")
+                self._cache.clear()
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        cache_key = self._cache_key(namespace, key)
+        cached = self._cache.get(cache_key, _ABSENT)
+        if cached is not _ABSENT:
+            return cached
+        value = await self.backend.get(namespace, key)
+        self._cache[cache_key] = value
+        return value
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[int] = None):
+        await self.backend.set(namespace, key, value, ttl)
+        cache_key = self._cache_key(namespace, key)
+        self._cache.set(cache_key, value, min(ttl, self._cache.ttl) if ttl else None)
+        await self.backend.publish_invalidation(f"{self.origin} {cache_key}")
+
+    async def delete(self, namespace: str, key: str):
+        await self.backend.delete(namespace, key)
+        cache_key = self._cache_key(namespace, key)
+        self._cache[cache_key] = None
+        await self.backend.publish_invalidation(f"{self.origin} {cache_key}")
+
+    async def purge_expired(self) -> int:
+        return await self.backend.purge_expired()
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self.backend.close()
+
+
+def create_state_backend(kind: str, max_size: Optional[int] = None, cache_ttl: float = 30,
+                         redis_prefix: str = 'tgbot', unbounded: Iterable[str] = ()) -> StateBackend:
+    """memory | sqlite | redis; общие бэкенды оборачиваются near-cache."""
+    kind = (kind or 'memory').lower()
+    if kind == 'memory':
+        return MemoryStateBackend(max_size=max_size, unbounded=unbounded)
+    if kind == 'sqlite':
+        backend = SQLiteStateBackend()
+    elif kind == 'redis':
+        backend = RedisStateBackend(prefix=redis_prefix)
+    else:
+        raise ValueError(f"Неизвестный STATE_BACKEND: {kind}")
+    return CachedStateBackend(backend, cache_ttl=cache_ttl, max_size=max_size)
@@ -0,0 +1,132 @@
+"""
+Ограниченное хранилище состояния в памяти: TTL на ключ + вытеснение по LRU
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+_MISSING = object()
+
+
+class _Entry:
+    __slots__ = ('value', 'expires')
+
+    def __init__(self, value: Any, expires: Optional[float]):
+        self.value = value
+        self.expires = expires
+
+
+class TTLStore:
+    """Словарь с истечением записей и ограничением размера.
+
+    Просроченная запись не возвращается и удаляется при обращении или в sweep().
+    При превышении max_size вытесняется давно не использовавшаяся запись.
+    ttl=None / max_size=None — без соответствующего ограничения.
+    """
+
+    def __init__(self, name: str, ttl: Optional[float] = None, max_size: Optional[int] = None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.evicted = 0
+        self.expired = 0
+        self._data: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        STORES.append(self)
+
+    def _live_entry(self, key: Hashable) -> Optional[_Entry]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry.expires is not None and entry.expires <= time.monotonic():
+            del self._data[key]
+            self.expired += 1
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._live_entry(key)
+        return default if entry is None else entry.value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = _Entry(value, time.monotonic() + ttl if ttl else None)
+        self._data.move_to_end(key)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evicted += 1
+
+    def pop(self, key: Hashable, default: Any = _MISSING) -> Any:
+        entry = self._live_entry(key)
+        if entry is not None:
+            del self._data[key]
+            return entry.value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def clear(self):
+        self._data.clear()
+
+    def __getitem__(self, key: Hashable) -> Any:
+        entry = self._live_entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry.value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.set(key, value)
+
+    def __delitem__(self, key: Hashable):
+        del self._data[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._live_entry(key) is not None
+
+    def __len__(self) -> int:
+        # Просроченные записи не считаются: сначала убираем их (O(n), как и sweep)
+        self.sweep()
+        return len(self._data)
+
+    def sweep(self) -> int:
+        """Удаляет все просроченные записи, возвращает их число"""
+        now = time.monotonic()
+        stale = [k for k, e in self._data.items() if e.expires is not None and e.expires <= now]
+        for key in stale:
+            del self._data[key]
+        self.expired += len(stale)
+        return len(stale)
+
+    def memory_usage(self) -> int:
+        """Приблизительный объём в байтах: контейнер, записи, ключи и значения (один уровень вглубь)"""
+        total = sys.getsizeof(self._data)
+        for key, entry in self._data.items():
+            total += sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry.value)
+            if isinstance(entry.value, dict):
+                total += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in entry.value.items())
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'bytes': self.memory_usage(),
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+# Все созданные хранилища — для периодической очистки и отчёта о памяти
+STORES: List[TTLStore] = []
+
+
+def sweep_all() -> int:
+    return sum(store.sweep() for store in STORES)
+
+
+def memory_report() -> List[Dict[str, Any]]:
+    return [store.stats() for store in STORES]
@@ -0,0 +1,122 @@
+"""
+Сквозная трассировка запроса: trace ID в contextvars, замеры этапов (спаны) и компактный JSONL-лог
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# Заголовок, в котором trace ID передаётся от бота в model_service
+TRACE_HEADER = 'X-Trace-Id'
+
+
+class _Trace:
+    __slots__ = ('trace_id', 'started', 'spans', 'attrs')
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.started = time.perf_counter()
+        # (имя, начало от старта трассы в мс, длительность в мс)
+        self.spans: List[tuple] = []
+        # Дополнительные поля строки трассы (что отброшено, размеры и т.п.)
+        self.attrs: Dict[str, Any] = {}
+
+
+_current: contextvars.ContextVar[Optional[_Trace]] = contextvars.ContextVar('trace', default=None)
+
+
+def new_trace(trace_id: Optional[str] = None) -> str:
+    """Начинает трассу в текущем контексте (задаче); возвращает её ID"""
+    trace = _Trace(trace_id or uuid.uuid4().hex[:16])
+    _current.set(trace)
+    return trace.trace_id
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current.get()
+    return trace.trace_id if trace else None
+
+
+def trace_headers() -> Dict[str, str]:
+    """Заголовки для исходящего HTTP-запроса (пусто вне трассы)"""
+    trace = _current.get()
+    return {TRACE_HEADER: trace.trace_id} if trace else {}
+
+
+def record(name: str, start: float, duration: float):
+    """Добавляет спан по уже измеренным perf_counter-отметкам (секунды)"""
+    trace = _current.get()
+    if trace is not None:
+        trace.spans.append((name, round((start - trace.started) * 1000, 1), round(duration * 1000, 1)))
+
+
+def annotate(**fields):
+    """Добавляет поля в строку текущей трассы в span-логе"""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(fields)
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter() - start)
+
+
+def spans() -> List[tuple]:
+    trace = _current.get()
+    return list(trace.spans) if trace else []
+
+
+def stage_timings() -> Dict[str, float]:
+    """Суммарное время по этапам текущей трассы, мс"""
+    totals: Dict[str, float] = {}
+    for name, _, duration in spans():
+        totals[name] = round(totals.get(name, 0.0) + duration, 1)
+    return totals
+
+
+def server_timing_header() -> str:
+    """Значение заголовка Server-Timing по спанам текущей трассы"""
+    return ', '.join(f"{name};dur={duration}" for name, duration in stage_timings().items())
+
+
+class SpanLog:
+    """Одна JSON-строка на трассу: {"trace", "service", "ts", "spans": [[имя, старт_мс, длит_мс], ...]}.
+
+    Пишется через отдельный logger с ротацией по размеру; склеить бот и сервис
+    можно по полю trace.
+    """
+
+    def __init__(self, service: str, directory: str, max_bytes: int = 10 * 1024 * 1024, backups: int = 5):
+        self.service = service
+        self._logger = logging.getLogger(f'trace_spans.{service}')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            os.makedirs(directory, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(directory, f'traces_{service}.jsonl'), maxBytes=max_bytes,
+                backupCount=backups, encoding='utf-8'
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+
+    def write(self, **extra):
+        trace = _current.get()
+        if trace is None or not trace.spans:
+            return
+        entry = {'trace': trace.trace_id, 'service': self.service, 'ts': round(time.time(), 3),
+                 'spans': [list(s) for s in trace.spans]}
+        entry.update(trace.attrs)
+        entry.update(extra)
+        self._logger.info(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
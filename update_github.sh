@@ -40,8 +40,9 @@ models/*.bin
 models/*.safetensors
 
 # Индексы поиска
-models/search_index.pkl
-models/faiss_index/
+models/search_index*
+models/*.sock
+models/usage.db*
 
 # Документы
 documents/
@@ -0,0 +1,376 @@
+"""
+Журнал расхода выходных токенов model_service в SQLite.
+
+Каждая генерация — строка usage_events (только добавление): время, день, кто спросил
+(telegram_id, отдел), сколько токенов. Дневные агрегаты usage_daily дополняются
+инкрементально по водяной отметке (последний учтённый id), отчёты /usage читают
+агрегаты и короткий хвост неучтённых событий. Файл общий для всех воркеров сервиса,
+поэтому месячный счётчик переживает перезапуск и одинаков во всех процессах.
+
+Запись отложенная: события копятся в памяти и сбрасываются пакетом раз в
+USAGE_FLUSH_MS. Лимиты проверяются до генерации (admit) по снимку месячных сумм,
+который после каждого сброса дочитывает новые события всех воркеров, плюс ещё не
+записанные события и токены, зарезервированные генерациями этого процесса.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS usage_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        day TEXT NOT NULL,
+        telegram_id INTEGER NOT NULL DEFAULT 0,
+        department TEXT NOT NULL DEFAULT '',
+        completion_tokens INTEGER NOT NULL,
+        trace TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS usage_daily (
+        day TEXT NOT NULL,
+        telegram_id INTEGER NOT NULL,
+        department TEXT NOT NULL,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        requests INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, telegram_id, department)
+    )""",
+    """CREATE TABLE IF NOT EXISTS usage_state (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    )""",
+)
+
+# Разрезы отчёта /usage -> выражение группировки
+GROUP_BY = {
+    'user': 'telegram_id',
+    'department': 'department',
+    'day': 'day',
+    'month': 'substr(day, 1, 7)',
+}
+
+# (ts, day, telegram_id, department, completion_tokens, trace)
+Event = Tuple[float, str, int, str, int, Optional[str]]
+
+
+class UsageLimitExceeded(Exception):
+    """Месячный лимит выходных токенов исчерпан (scope: total | user | department)"""
+
+    def __init__(self, scope: str, used: int, limit: int):
+        super().__init__(f"Исчерпан месячный лимит токенов ({scope}): {used}/{limit}")
+        self.scope = scope
+        self.used = used
+        self.limit = limit
+
+
+def month_key(day: Optional[str] = None) -> str:
+    return (day or datetime.now().strftime('%Y-%m-%d'))[:7]
+
+
+class UsageLedger:
+    def __init__(self, path: str, total_limit: int = 0, user_limit: int = 0, department_limit: int = 0,
+                 flush_interval: float = 1.0, rollup_interval: float = 60, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.total_limit = total_limit
+        self.user_limit = user_limit
+        self.department_limit = department_limit
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self.busy_timeout_ms = busy_timeout_ms
+        self._conn: Optional[sqlite3.Connection] = None
+        # Соединение одно на процесс, запросы идут из пула потоков
+        self._db_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._pending: List[Event] = []
+        # Пакет, который сейчас пишется: учитывается в лимитах, пока его не дочитает снимок
+        self._flushing: List[Event] = []
+        self._reservations: Dict[int, Tuple[int, str, int]] = {}
+        self._reservation_ids = itertools.count(1)
+        # Снимок месячных сумм по БД: месяц, последний прочитанный id, итог и разрезы
+        self._month = ''
+        self._seen_id = 0
+        self._total = 0
+        self._by_user: Counter = Counter()
+        self._by_department: Counter = Counter()
+        self._task: Optional[asyncio.Task] = None
+
+    # ===== SQLite =====
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            self._conn = conn
+        return self._conn
+
+    def _watermark(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT last_id FROM usage_state WHERE name = 'usage_events'").fetchone()
+        return row[0] if row else 0
+
+    def _write(self, events: List[Event]):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "INSERT INTO usage_events (ts, day, telegram_id, department, completion_tokens, trace) "
+                "VALUES (?, ?, ?, ?, ?, ?)", events)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _load_month(self, month: str) -> Tuple[int, List[Tuple[int, str, int]]]:
+        """Суммы месяца по (telegram_id, отдел): агрегаты + хвост после водяной отметки"""
+        conn = self._connect()
+        # Одна читающая транзакция: агрегаты и водяная отметка согласованы
+        conn.execute('BEGIN')
+        try:
+            last_id = self._watermark(conn)
+            rows = conn.execute(
+                """SELECT telegram_id, department, SUM(completion_tokens) FROM (
+                    SELECT telegram_id, department, completion_tokens FROM usage_daily
+                    WHERE day >= ? AND day < ?
+                    UNION ALL
+                    SELECT telegram_id, department, completion_tokens FROM usage_events
+                    WHERE id > ? AND day >= ? AND day < ?
+                ) GROUP BY telegram_id, department""",
+                (month, month + '~', last_id, month, month + '~')).fetchall()
+            seen_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM usage_events").fetchone()[0]
+        finally:
+            conn.execute('COMMIT')
+        return seen_id, rows
+
+    def _read_new(self, after_id: int) -> List[Tuple[int, str, int, str, int]]:
+        return self._connect().execute(
+            "SELECT id, day, telegram_id, department, completion_tokens FROM usage_events WHERE id > ? ORDER BY id",
+            (after_id,)).fetchall()
+
+    def _sync(self, events: List[Event], month: str, seen_id: int) -> tuple:
+        """Записывает пакет и возвращает, чем обновить снимок"""
+        with self._db_lock:
+            if events:
+                self._write(events)
+            if month != self._month:
+                return ('load',) + self._load_month(month)
+            return ('new', self._read_new(seen_id))
+
+    def _rollup_sync(self, batch: int) -> int:
+        with self._db_lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                last_id = self._watermark(conn)
+                upper = conn.execute(
+                    "SELECT MAX(id) FROM (SELECT id FROM usage_events WHERE id > ? ORDER BY id LIMIT ?)",
+                    (last_id, batch)).fetchone()[0]
+                if upper is None:
+                    conn.execute('COMMIT')
+                    return 0
+                conn.execute(
+                    """INSERT INTO usage_daily (day, telegram_id, department, completion_tokens, requests)
+                    SELECT day, telegram_id, department, SUM(completion_tokens), COUNT(*)
+                    FROM usage_events WHERE id > ? AND id <= ?
+                    GROUP BY day, telegram_id, department
+                    ON CONFLICT(day, telegram_id, department) DO UPDATE SET
+                        completion_tokens = completion_tokens + excluded.completion_tokens,
+                        requests = requests + excluded.requests""",
+                    (last_id, upper))
+                conn.execute(
+                    "INSERT INTO usage_state (name, last_id) VALUES ('usage_events', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id", (upper,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return upper - last_id
+
+    def _report_sync(self, date_from: str, date_to: str, group_by: Optional[str], telegram_id: Optional[int],
+                     department: Optional[str], limit: int) -> Tuple[int, int, List[Tuple[str, int, int]]]:
+        where, params = ['day >= ?', 'day <= ?'], [date_from, date_to]
+        if telegram_id is not None:
+            where.append('telegram_id = ?')
+            params.append(telegram_id)
+        if department is not None:
+            where.append('department = ?')
+            params.append(department)
+        condition = ' AND '.join(where)
+        with self._db_lock:
+            conn = self._connect()
+            conn.execute('BEGIN')
+            try:
+                last_id = self._watermark(conn)
+                source = (f"SELECT day, telegram_id, department, completion_tokens, requests FROM usage_daily "
+                          f"WHERE {condition} UNION ALL "
+                          f"SELECT day, telegram_id, department, completion_tokens, 1 FROM usage_events "
+                          f"WHERE id > ? AND {condition}")
+                args = params + [last_id] + params
+                tokens, requests = conn.execute(
+                    f"SELECT COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(requests), 0) FROM ({source})",
+                    args).fetchone()
+                rows = []
+                if group_by:
+                    rows = conn.execute(
+                        f"SELECT {GROUP_BY[group_by]} AS key, SUM(completion_tokens) AS tokens, SUM(requests) "
+                        f"FROM ({source}) GROUP BY key ORDER BY tokens DESC LIMIT ?",
+                        args + [limit]).fetchall()
+            finally:
+                conn.execute('COMMIT')
+        return tokens, requests, [(str(key), int(t), int(r)) for key, t, r in rows]
+
+    # ===== Снимок и лимиты =====
+
+    def _apply(self, result: tuple, month: str):
+        if result[0] == 'load':
+            _, seen_id, rows = result
+            self._month = month
+            self._total = 0
+            self._by_user = Counter()
+            self._by_department = Counter()
+            for telegram_id, department, tokens in rows:
+                self._add(telegram_id, department, tokens)
+        else:
+            seen_id = self._seen_id
+            for event_id, day, telegram_id, department, tokens in result[1]:
+                seen_id = event_id
+                if month_key(day) == self._month:
+                    self._add(telegram_id, department, tokens)
+        self._seen_id = seen_id
+
+    def _add(self, telegram_id: int, department: str, tokens: int):
+        self._total += tokens
+        if telegram_id:
+            self._by_user[telegram_id] += tokens
+        if department:
+            self._by_department[department] += tokens
+
+    def used(self, telegram_id: int = 0, department: str = '') -> Tuple[int, int, int]:
+        """Расход за текущий месяц: (всего, пользователь, отдел), включая резервы генераций в работе"""
+        month = month_key()
+        if month == self._month:
+            total, user, dept = self._total, self._by_user[telegram_id], self._by_department[department]
+        else:
+            total = user = dept = 0
+        for _, day, event_user, event_dept, tokens, _ in itertools.chain(self._flushing, self._pending):
+            if month_key(day) == month:
+                total += tokens
+                user += tokens if event_user == telegram_id else 0
+                dept += tokens if event_dept == department else 0
+        for event_user, event_dept, tokens in self._reservations.values():
+            total += tokens
+            user += tokens if event_user == telegram_id else 0
+            dept += tokens if event_dept == department else 0
+        return total, user, dept
+
+    def month_usage(self) -> int:
+        return self.used()[0]
+
+    def admit(self, telegram_id: Optional[int], department: Optional[str], max_tokens: int) -> Tuple[int, int]:
+        """Проверка лимитов до генерации: (id резерва, разрешённое число токенов).
+        Если остаток меньше max_tokens, генерация укорачивается до остатка."""
+        telegram_id, department = telegram_id or 0, (department or '').strip()
+        total, user, dept = self.used(telegram_id, department)
+        checks = [('total', total, self.total_limit)]
+        if telegram_id:
+            checks.append(('user', user, self.user_limit))
+        if department:
+            checks.append(('department', dept, self.department_limit))
+        allowed = max_tokens
+        for scope, used, limit in checks:
+            if not limit:
+                continue
+            if used >= limit:
+                raise UsageLimitExceeded(scope, used, limit)
+            allowed = min(allowed, limit - used)
+        reservation = next(self._reservation_ids)
+        self._reservations[reservation] = (telegram_id, department, allowed)
+        return reservation, allowed
+
+    def release(self, reservation: int):
+        self._reservations.pop(reservation, None)
+
+    def record(self, telegram_id: Optional[int], department: Optional[str], completion_tokens: int,
+               trace: Optional[str] = None):
+        now = time.time()
+        self._pending.append((now, datetime.fromtimestamp(now).strftime('%Y-%m-%d'), telegram_id or 0,
+                              (department or '').strip(), int(completion_tokens), trace))
+
+    # ===== Фоновая запись =====
+
+    async def flush(self):
+        """Пишет накопленные события и дочитывает в снимок расход остальных воркеров"""
+        async with self._flush_lock:
+            self._flushing, self._pending = self._pending, []
+            month = month_key()
+            try:
+                result = await asyncio.to_thread(self._sync, self._flushing, month, self._seen_id)
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала токенов: {e}")
+                # События не теряем: вернутся в следующий сброс
+                self._pending[:0] = self._flushing
+                self._flushing = []
+                return
+            self._apply(result, month)
+            self._flushing = []
+
+    async def rollup(self, batch: int = 50000) -> int:
+        """Дополняет дневные агрегаты новыми событиями. Возвращает их число."""
+        total = 0
+        try:
+            while True:
+                processed = await asyncio.to_thread(self._rollup_sync, batch)
+                total += processed
+                if processed == 0:
+                    return total
+        except Exception as e:
+            logger.error(f"Ошибка обновления агрегатов журнала токенов: {e}")
+            return total
+
+    async def report(self, date_from: str, date_to: str, group_by: Optional[str] = None,
+                     telegram_id: Optional[int] = None, department: Optional[str] = None,
+                     limit: int = 50) -> Tuple[int, int, List[Tuple[str, int, int]]]:
+        """(токены, запросы, разрез [(ключ, токены, запросы)]) за дни date_from..date_to включительно"""
+        await self.flush()
+        return await asyncio.to_thread(self._report_sync, date_from, date_to, group_by, telegram_id,
+                                       department, limit)
+
+    async def _run(self):
+        last_rollup = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_rollup >= self.rollup_interval:
+                last_rollup = time.monotonic()
+                processed = await self.rollup()
+                if processed:
+                    logger.debug(f"Агрегаты журнала токенов обновлены: {processed} событий")
+
+    async def start(self):
+        await self.flush()
+        await self.rollup()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()